@@ -3,19 +3,23 @@ Public facing API views
 """
 from django.conf import settings
 from django.views.generic import View
-from django.contrib.contenttypes.models import ContentType
 from rest_framework import routers, status, viewsets
+from rest_framework.decorators import list_route
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 
 from opal.models import (
-    Episode, Synonym, Patient, PatientRecordAccess, PatientSubrecord
+    Episode, Patient, PatientRecordAccess, PatientSubrecord
+)
+from opal.core import (
+    application, exceptions, lookuplists, metadata, plugins, schemas
 )
-from opal.core import application, exceptions, metadata, plugins, schemas
-from opal.core.lookuplists import LookupList
 from opal.utils import stringport, camelcase_to_underscore
 from opal.core.subrecords import subrecords
-from opal.core.views import _get_request_data, _build_json_response
+from opal.core.views import (
+    _get_request_data, _build_json_response, _build_cached_json_response,
+    _encode_json
+)
 from opal.core.patient_lists import (
     PatientList, TaggedPatientListMetadata, FirstListMetadata
 )
@@ -57,6 +61,29 @@ def episode_from_pk(fn):
 class LoginRequiredViewset(viewsets.ViewSet):
     permission_classes = (IsAuthenticated,)
 
+
+SCHEMA_MAX_AGE = 60 * 60 * 24 * 365
+
+
+def _build_schema_response(request, schema):
+    """
+    Return a response for the EncodedSchema SCHEMA.
+
+    The index page requests the schema with ?v=<etag>. Those clients are
+    asking for that exact version, so can keep it for as long as they like.
+    Everyone else must revalidate with their ETag.
+    """
+    if request.GET.get('v') == schema.etag:
+        cache_control = 'private, max-age={0}, immutable'.format(
+            SCHEMA_MAX_AGE
+        )
+    else:
+        cache_control = 'private, no-cache'
+    return _build_cached_json_response(
+        request, schema.content, schema.etag, cache_control=cache_control
+    )
+
+
 class RecordViewSet(LoginRequiredViewset):
     """
     Return the serialization of all active record types ready to
@@ -65,7 +92,7 @@ class RecordViewSet(LoginRequiredViewset):
     base_name = 'record'
 
     def list(self, request):
-        return Response(schemas.list_records())
+        return _build_schema_response(request, schemas.records.get())
 
 
 class ExtractSchemaViewSet(LoginRequiredViewset):
@@ -75,7 +102,7 @@ class ExtractSchemaViewSet(LoginRequiredViewset):
     base_name = 'extract-schema'
 
     def list(self, request):
-        return Response(schemas.extract_schema())
+        return _build_schema_response(request, schemas.extract.get())
 
 
 class ReferenceDataViewSet(LoginRequiredViewset):
@@ -85,40 +112,16 @@ class ReferenceDataViewSet(LoginRequiredViewset):
     base_name = 'referencedata'
 
     def list(self, request):
-        data = {}
-        subclasses = LookupList.__subclasses__()
-        for model in subclasses:
-            options = list(model.objects.all().values_list("name", flat=True))
-            data[model.get_api_name()] = options
-
-        model_to_ct = ContentType.objects.get_for_models(
-            *subclasses
+        reference_data = lookuplists.reference_data.get()
+        return _build_cached_json_response(
+            request, reference_data.content, reference_data.etag
         )
 
-        for model, ct in model_to_ct.iteritems():
-            synonyms = Synonym.objects.filter(content_type=ct).values_list(
-                "name", flat=True
-            )
-            data[model.get_api_name()].extend(synonyms)
-
-        for name in data:
-            data[name].sort()
-        return Response(data)
-
     def retrieve(self, request, pk=None):
-        the_list = None
-        for lookuplist in LookupList.__subclasses__():
-            if lookuplist.get_api_name() == pk:
-                the_list = lookuplist
-                break
-        if the_list:
-            values = list(the_list.objects.all().values_list('name', flat=True))
-            ct = ContentType.objects.get_for_model(the_list)
-            synonyms = Synonym.objects.filter(content_type=ct).values_list(
-                'name', flat=True
-            )
-            values += list(synonyms)
-            return Response(values)
+        reference_data = lookuplists.reference_data.get()
+        if pk in reference_data.lists:
+            content, etag = reference_data.lists[pk]
+            return _build_cached_json_response(request, content, etag)
 
         return Response({'error': 'Item does not exist'}, status=status.HTTP_404_NOT_FOUND)
 
@@ -132,15 +135,21 @@ class MetadataViewSet(LoginRequiredViewset):
     def list(self, request):
         data = {}
         for meta in metadata.Metadata.list():
-            data.update(meta.to_dict(user=request.user))
-        return Response(data)
+            data.update(meta.cached_to_dict(user=request.user))
+        return _build_cached_json_response(
+            request, *_encode_json(data), cache_control='private, no-cache'
+        )
 
     def retrieve(self, request, pk=None):
         try:
             meta = metadata.Metadata.get(pk)
-            return Response(meta.to_dict(user=request.user))
         except ValueError:
             return Response({'error': 'Metadata does not exist'}, status=status.HTTP_404_NOT_FOUND)
+        return _build_cached_json_response(
+            request,
+            *_encode_json(meta.cached_to_dict(user=request.user)),
+            cache_control='private, no-cache'
+        )
 
 
 class SubrecordViewSet(LoginRequiredViewset):
@@ -201,6 +210,51 @@ class SubrecordViewSet(LoginRequiredViewset):
         item.delete()
         return Response('deleted', status=status.HTTP_202_ACCEPTED)
 
+    @list_route(methods=['post'])
+    def bulk(self, request):
+        """
+        * Create or update a list of subrecords in one transaction
+        * Render the saved subrecords back to the requester
+
+        Raise appropriate errors for:
+
+        * Data that isn't a list of subrecords
+        * Nonexistant episodes or subrecords
+        * Unexpected fields being passed in
+        * Items that have changed
+        """
+        list_of_dicts = request.data
+        if not isinstance(list_of_dicts, list) or not all(
+            isinstance(a_dict, dict) for a_dict in list_of_dicts
+        ):
+            return Response({'error': 'Expected a list of subrecords'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if issubclass(self.model, PatientSubrecord):
+            episode_ids = [d['episode_id'] for d in list_of_dicts if 'episode_id' in d]
+            patient_ids = dict(Episode.objects.filter(
+                id__in=episode_ids
+            ).values_list('id', 'patient_id'))
+            for a_dict in list_of_dicts:
+                if 'episode_id' in a_dict:
+                    episode_id = a_dict.pop('episode_id')
+                    a_dict['patient_id'] = patient_ids.get(episode_id)
+
+        try:
+            saved = self.model.bulk_write_from_dicts(
+                list_of_dicts, request.user
+            )
+        except exceptions.APIError as e:
+            return Response({'error': str(e)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        except exceptions.ConsistencyError:
+            return Response({'error': 'Item has changed'}, status=status.HTTP_409_CONFLICT)
+
+        return _build_json_response(
+            [subrecord.to_dict(request.user) for subrecord in saved],
+            status_code=status.HTTP_202_ACCEPTED
+        )
+
 
 class UserProfileViewSet(LoginRequiredViewset):
     """
@@ -21,9 +21,27 @@ Flow
 By registering episode category, plugins and applications can achieve a huge degree of
 flexibility over the behaviour of their episodes.
 """
+from django.db.models import Q
+
 from opal.core.discoverable import DiscoverableFeature
 
 
+def _restricted_only(user):
+    """
+    Return the restricted_only flag from USER's profile, which Django
+    caches on the instance. Without a user, we assume the worst.
+    """
+    from opal.models import UserProfile # Avoid circular import from opal.models
+
+    if user is None:
+        return True
+    try:
+        profile = user.profile
+    except UserProfile.DoesNotExist:
+        profile, _ = UserProfile.objects.get_or_create(user=user)
+    return profile.restricted_only
+
+
 class EpisodeCategory(DiscoverableFeature):
     module_name     = "episode_categories"
     display_name    = None
@@ -46,6 +64,40 @@ class EpisodeCategory(DiscoverableFeature):
 
         return True
 
+    @classmethod
+    def _overrides_episode_visible_to(kls):
+        return kls.episode_visible_to.__func__ is not \
+            EpisodeCategory.episode_visible_to.__func__
+
+    @classmethod
+    def visibility_filter(kls, user):
+        """
+        Return a Q object that selects the Episodes of this category that
+        USER can see, or None if we can only tell by asking
+        episode_visible_to about each episode.
+
+        Categories that override episode_visible_to should override this
+        as well, otherwise searches fall back to checking each episode.
+        """
+        if kls._overrides_episode_visible_to():
+            return None
+        if _restricted_only(user):
+            return Q(pk__in=[])
+        return Q()
+
+    @classmethod
+    def visibility_key(kls, user):
+        """
+        Return a hashable value such that any users with the same key
+        can see the same episodes of this category.
+
+        Categories that override episode_visible_to should override this
+        as well, otherwise every user is keyed separately.
+        """
+        if kls._overrides_episode_visible_to():
+            return ('user', getattr(user, 'id', None))
+        return _restricted_only(user)
+
     def __init__(self, episode):
         self.episode = episode
 
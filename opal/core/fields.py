@@ -1,6 +1,6 @@
 from opal.utils import camelcase_to_underscore
+from opal.core import lookuplists
 from django.db.models import ForeignKey, CharField
-from django.contrib.contenttypes.models import ContentType
 
 class ForeignKeyOrFreeText(property):
     """Field-like object that stores either foreign key or free text.
@@ -45,30 +45,26 @@ class ForeignKeyOrFreeText(property):
     def __set__(self, inst, val):
         if val is None:
             return
-        # This is totally not the right place to look up synonyms...
-        vals = []
-        content_type = ContentType.objects.get_for_model(self.foreign_model)
-        for val in val.split(','):
-            val = val.strip()
-            try:
-                from opal.models import Synonym
-                synonym = Synonym.objects.get(content_type=content_type, name=val)
-                vals.append(synonym.content_object.name)
-            except Synonym.DoesNotExist:
-                vals.append(val)
+        # Resolves synonyms as well as names
+        resolved = [
+            lookuplists.cache.resolve(self.foreign_model, v.strip())
+            for v in val.split(',')
+        ]
 
-        if len(vals) > 1:
-            setattr(inst, self.ft_field_name, ', '.join(vals))
+        if len(resolved) > 1:
+            names = [name for name, _ in resolved]
+            setattr(inst, self.ft_field_name, ', '.join(names))
             setattr(inst, self.fk_field_name, None)
         else:
-            val = vals[0]
-            try:
-                foreign_obj = self.foreign_model.objects.get(name=val)
+            name, pk = resolved[0]
+            if pk is None:
+                setattr(inst, self.ft_field_name, name)
+                setattr(inst, self.fk_field_name, None)
+            else:
+                foreign_obj = self.foreign_model(id=pk, name=name)
+                foreign_obj._state.adding = False
                 setattr(inst, self.fk_field_name, foreign_obj)
                 setattr(inst, self.ft_field_name, '')
-            except self.foreign_model.DoesNotExist:
-                setattr(inst, self.ft_field_name, val)
-                setattr(inst, self.fk_field_name, None)
 
     def __get__(self, inst, cls):
         if inst is None:
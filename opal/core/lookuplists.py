@@ -1,11 +1,20 @@
 """
 OPAL Lookuplists
 """
+import collections
 import logging
+import threading
 
+from django.conf import settings
 from django.contrib.contenttypes.fields import GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+
+from opal.core import versions
+from opal.core.views import _encode_json
+from opal.core.signals import connect_subclasses
 
 
 def load_lookuplist_item(model, item):
@@ -92,3 +101,240 @@ class LookupList(models.Model):
             class_name = self.__class__.__name__
             raise ValueError(err_str.format(class_name, self.name))
         return super(LookupList, self).save(*args, **kwargs)
+
+
+class LookupListCache(object):
+    """
+    A bounded, process local cache that resolves a lookup list value
+    (either a name or a synonym) to the canonical (name, id) of the
+    lookup list entry it refers to.
+
+    Values that do not match an entry resolve to (value, None).
+
+    Entries are evicted least recently used first once we hold more than
+    settings.OPAL_LOOKUPLIST_CACHE_SIZE of them, and are invalidated for a
+    lookup list whenever an instance of it, or one of its synonyms, is
+    saved or deleted. Other processes see those changes through the
+    shared lookup list version, and drop all of their entries when it
+    changes. Bulk QuerySet.update() calls do not send signals, so callers
+    doing those should call invalidate() and bump_version() themselves.
+    """
+    DEFAULT_SIZE = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.generation = 0
+        self.version = None
+
+    @property
+    def max_size(self):
+        return getattr(
+            settings, 'OPAL_LOOKUPLIST_CACHE_SIZE', self.DEFAULT_SIZE
+        )
+
+    def _lookup(self, model, values):
+        """
+        Return a dict of value: (name, id) for VALUES from the lookup
+        list MODEL with two queries, however many VALUES there are.
+        """
+        from opal.models import Synonym
+
+        content_type = ContentType.objects.get_for_model(model)
+        synonyms = dict(Synonym.objects.filter(
+            content_type=content_type, name__in=values
+        ).values_list('name', 'object_id'))
+        names = [v for v in values if v not in synonyms]
+
+        entries = model.objects.filter(
+            Q(id__in=synonyms.values()) | Q(name__in=names)
+        ).values_list('name', 'id')
+        by_id = {pk: (name, pk) for name, pk in entries}
+        by_name = {name: (name, pk) for name, pk in entries}
+
+        results = {}
+        for value in values:
+            if value in synonyms:
+                found = by_id.get(synonyms[value])
+            else:
+                found = by_name.get(value)
+            results[value] = found or (value, None)
+        return results
+
+    def resolve_many(self, model, values):
+        """
+        Return a dict of value: (name, id) for each of VALUES from the
+        lookup list MODEL, looking up any we don't have cached together.
+        """
+        version = get_version()
+        results = {}
+        missing = []
+        with self.lock:
+            if version != self.version:
+                # Lookup lists have changed, perhaps in another process
+                self.generation += 1
+                self.entries.clear()
+                self.version = version
+            for value in values:
+                key = (model, value)
+                if key in self.entries:
+                    results[value] = self.entries.pop(key)
+                    self.entries[key] = results[value]
+                else:
+                    missing.append(value)
+            generation = self.generation
+
+        if not missing:
+            return results
+
+        found = self._lookup(model, missing)
+
+        with self.lock:
+            # Don't cache results if we were invalidated mid lookup
+            if generation == self.generation:
+                for value, result in found.items():
+                    self.entries[(model, value)] = result
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        results.update(found)
+        return results
+
+    def resolve(self, model, value):
+        """
+        Return the (name, id) that VALUE resolves to for the lookup
+        list MODEL.
+        """
+        return self.resolve_many(model, [value])[value]
+
+    def invalidate(self, model):
+        """
+        Drop all cached values for the lookup list MODEL.
+        """
+        with self.lock:
+            self.generation += 1
+            for key in [k for k in self.entries if k[0] == model]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+
+cache = LookupListCache()
+
+
+VERSION_CACHE_KEY = 'opal.lookuplists.version'
+
+
+def get_version():
+    """
+    Return the current version of our lookup list data.
+    """
+    return versions.get_version(VERSION_CACHE_KEY)
+
+
+def bump_version():
+    """
+    Mark our lookup list data as having changed.
+    """
+    versions.bump_version(VERSION_CACHE_KEY)
+
+
+EncodedReferenceData = collections.namedtuple(
+    'EncodedReferenceData', ['version', 'etag', 'content', 'lists']
+)
+
+
+class ReferenceData(object):
+    """
+    The JSON encoded names and synonyms of every lookup list, as served
+    by the reference data API.
+
+    We hold the encoded payload for all lists, and for each list by API
+    name, rebuilding them only when the lookup list version changes.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.encoded = None
+
+    def build(self):
+        subclasses = LookupList.__subclasses__()
+        data = {}
+        for model in subclasses:
+            data[model.get_api_name()] = list(
+                model.objects.all().values_list("name", flat=True)
+            )
+
+        model_to_ct = ContentType.objects.get_for_models(*subclasses)
+        ct_to_name = {
+            ct.id: model.get_api_name() for model, ct in model_to_ct.items()
+        }
+
+        from opal.models import Synonym
+        synonyms = Synonym.objects.filter(
+            content_type_id__in=ct_to_name.keys()
+        ).values_list("content_type_id", "name")
+
+        for content_type_id, name in synonyms:
+            data[ct_to_name[content_type_id]].append(name)
+
+        for name in data:
+            data[name].sort()
+        return data
+
+    def get(self):
+        """
+        Return the current EncodedReferenceData.
+        """
+        version = get_version()
+        encoded = self.encoded
+        if encoded is not None and encoded.version == version:
+            return encoded
+
+        with self.lock:
+            if self.encoded is None or self.encoded.version != version:
+                data = self.build()
+                content, etag = _encode_json(data)
+                lists = {name: _encode_json(values) for name, values in data.items()}
+                self.encoded = EncodedReferenceData(
+                    version=version, etag=etag, content=content, lists=lists
+                )
+            return self.encoded
+
+
+reference_data = ReferenceData()
+
+
+def invalidate_cache(sender, instance=None, **kwargs):
+    """
+    Signal handler to invalidate our lookup list cache and bump the
+    reference data version when lookup list entries or their synonyms
+    change.
+    """
+    from opal.models import Synonym
+
+    if sender is Synonym:
+        content_type = ContentType.objects.get_for_id(instance.content_type_id)
+        cache.invalidate(content_type.model_class())
+    else:
+        cache.invalidate(sender)
+    bump_version()
+
+
+connect_subclasses(
+    post_save, invalidate_cache, LookupList,
+    dispatch_uid='OPAL.lookuplist_cache_save'
+)
+connect_subclasses(
+    post_delete, invalidate_cache, LookupList,
+    dispatch_uid='OPAL.lookuplist_cache_delete'
+)
+post_save.connect(
+    invalidate_cache, sender='opal.Synonym',
+    dispatch_uid='OPAL.lookuplist_cache_save'
+)
+post_delete.connect(
+    invalidate_cache, sender='opal.Synonym',
+    dispatch_uid='OPAL.lookuplist_cache_delete'
+)
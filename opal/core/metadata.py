@@ -7,13 +7,101 @@ better places for.
 
 These should eventually be moved out.
 """
-from opal.core import discoverable
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_save, post_delete
+
+from opal.core import discoverable, versions
+
+# Map of 'app_label.ModelName' to the Metadata it invalidates
+_INVALIDATED_BY = {}
+
+
+def invalidate_metadata(sender, action=None, **kwargs):
+    """
+    Signal handler to invalidate cached Metadata when a model it
+    declares in invalidated_by changes.
+    """
+    if action is not None and not action.startswith('post_'):
+        return
+    label = '{0}.{1}'.format(sender._meta.app_label, sender._meta.object_name)
+    for meta in _INVALIDATED_BY.get(label, []):
+        meta.invalidate()
+
+
+class MetadataMeta(discoverable.DiscoverableMeta):
+    """
+    Connect invalidate_metadata to the models each Metadata subclass
+    declares in invalidated_by, rather than to every model.
+    """
+    def __new__(cls, name, bases, dct):
+        meta = super(MetadataMeta, cls).__new__(cls, name, bases, dct)
+        for label in meta.invalidated_by:
+            _INVALIDATED_BY.setdefault(label, []).append(meta)
+            post_save.connect(
+                invalidate_metadata, sender=label,
+                dispatch_uid='OPAL.metadata_save'
+            )
+            post_delete.connect(
+                invalidate_metadata, sender=label,
+                dispatch_uid='OPAL.metadata_delete'
+            )
+            m2m_changed.connect(
+                invalidate_metadata, sender=label,
+                dispatch_uid='OPAL.metadata_m2m'
+            )
+        return meta
+
 
 class Metadata(discoverable.DiscoverableFeature):
+    __metaclass__ = MetadataMeta
     module_name = 'metadata'
 
+    GLOBAL   = 'global'
+    PER_USER = 'per_user'
+
+    # How the output of to_dict() may be cached. One of None (never
+    # cache), GLOBAL (the same for every user) or PER_USER.
+    cache_scope = None
+
+    # Models whose saves or deletes invalidate our cached output, as
+    # 'app_label.ModelName' strings. Many to many fields are given by
+    # their through model e.g. 'opal.UserProfile_roles'.
+    invalidated_by = ()
+
+    @classmethod
+    def get_version_key(klass):
+        return 'opal.metadata.{0}.version'.format(klass.get_slug())
+
+    @classmethod
+    def invalidate(klass):
+        versions.bump_version(klass.get_version_key())
+
+    @classmethod
+    def cached_to_dict(klass, user=None):
+        """
+        Return to_dict() for USER, from the cache if our CACHE_SCOPE
+        allows it.
+        """
+        if klass.cache_scope is None:
+            return klass.to_dict(user=user)
+
+        key = 'opal.metadata.{0}.{1}'.format(
+            klass.get_slug(), versions.get_version(klass.get_version_key())
+        )
+        if klass.cache_scope == klass.PER_USER:
+            key += '.{0}'.format(user.id)
+
+        data = cache.get(key)
+        if data is None:
+            data = klass.to_dict(user=user)
+            cache.set(key, data)
+        return data
+
+
 class MacrosMetadata(Metadata):
     slug = 'macros'
+    cache_scope = Metadata.GLOBAL
+    invalidated_by = ('opal.Macro',)
 
     @classmethod
     def to_dict(klass, **kw):
@@ -25,6 +113,7 @@ class MacrosMetadata(Metadata):
 
 class MicroTestDefaultsMetadata(Metadata):
     slug = 'micro_test_defaults'
+    cache_scope = Metadata.GLOBAL
 
     @classmethod
     def to_dict(klass, **kw):
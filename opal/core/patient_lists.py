@@ -119,8 +119,17 @@ class TaggedPatientList(PatientList, utils.AbstractBase):
         return possible
 
 
+# The models PatientList.visible_to() reads. Applications whose lists
+# check anything else should add it to their own invalidated_by.
+PER_USER_INVALIDATED_BY = (
+    'opal.UserProfile', 'opal.UserProfile_roles', 'auth.User'
+)
+
+
 class FirstListMetadata(metadata.Metadata):
     slug = 'first_list_slug'
+    cache_scope = metadata.Metadata.PER_USER
+    invalidated_by = PER_USER_INVALIDATED_BY
 
     @classmethod
     def to_dict(klass, user=None, **kw):
@@ -135,6 +144,8 @@ class FirstListMetadata(metadata.Metadata):
 
 class TaggedPatientListMetadata(metadata.Metadata):
     slug = 'tagging'
+    cache_scope = metadata.Metadata.PER_USER
+    invalidated_by = PER_USER_INVALIDATED_BY
 
     @classmethod
     def to_dict(klass, user=None, **kw):
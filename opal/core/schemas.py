@@ -1,8 +1,12 @@
 """
 Utilities for dealing with OPAL Schemas
 """
+import collections
 import itertools
+import threading
+
 from opal.core.subrecords import subrecords
+from opal.core.views import _encode_json
 from opal import models
 
 
@@ -47,3 +51,39 @@ def list_records():
 
 def extract_schema():
     return serialize_schema(itertools.chain([models.Tagging], subrecords()))
+
+
+EncodedSchema = collections.namedtuple('EncodedSchema', ['content', 'etag'])
+
+
+class PrecomputedSchema(object):
+    """
+    The JSON encoded output of BUILD, and an ETag of its content.
+
+    Schemas only change when the code does, so we build them the first
+    time they are asked for in a process and hold onto the bytes.
+    """
+    def __init__(self, build):
+        self.build = build
+        self.lock = threading.Lock()
+        self.encoded = None
+
+    def get(self):
+        """
+        Return the EncodedSchema, building it if we have not yet.
+        """
+        encoded = self.encoded
+        if encoded is not None:
+            return encoded
+
+        with self.lock:
+            if self.encoded is None:
+                self.encoded = EncodedSchema(*_encode_json(self.build()))
+            return self.encoded
+
+    def clear(self):
+        self.encoded = None
+
+
+records = PrecomputedSchema(lambda: list_records())
+extract = PrecomputedSchema(lambda: extract_schema())
@@ -2,6 +2,8 @@
 OPAL core search package
 """
 from opal.core.search import urls
+# Connects the signal handlers that keep our search indexes current
+from opal.core.search import fulltext, inverted # noqa
 from opal.core import plugins
 
 class SearchPlugin(plugins.OpalPlugin):
@@ -1,134 +1,918 @@
 """
 Utilities for extracting data from OPAL
 """
+import collections
 import datetime
 import csv
+import decimal
+import errno
+import itertools
+import json
+import multiprocessing
 import os
+import shutil
+import sqlite3
 import tempfile
-import zipfile
-import functools
 import logging
+import uuid
+from multiprocessing.pool import ThreadPool
 
-from opal.models import Episode
-from opal.core.subrecords import episode_subrecords, patient_subrecords
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, transaction
+from django.db.models import Max, Q, QuerySet
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
+from opal.models import (ChangedRecord, DeletedRecord, Episode,
+                         ExtractedEpisode, ExtractWatermark, PatientSubrecord,
+                         Tagging)
+from opal.core.search import queries, zipstream
+from opal.core.subrecords import (episode_subrecords, patient_subrecords,
+                                  get_subrecord_from_api_name)
 
-def subrecord_csv(episodes, subrecord, file_name):
+CHUNK_SIZE = 500
+
+# Incremental extracts include rows saved this long before the last one
+# started, as their transactions may not have committed when it ran
+WATERMARK_MARGIN = datetime.timedelta(minutes=5)
+
+# What an incremental extract includes: rows changed SINCE a given time,
+# and everything for episodes that weren't in the last extract with the
+# ExtractWatermark WATERMARK_ID
+Changes = collections.namedtuple('Changes', ['since', 'watermark_id'])
+
+# File suffix and content type of each archive format
+FORMATS = {
+    'zip': ('.zip', 'application/zip'),
+    'sqlite': ('.sqlite3', 'application/x-sqlite3'),
+}
+
+# SQLite column types for Django's internal field types, anything else
+# is TEXT
+SQLITE_TYPES = {
+    'AutoField': 'INTEGER',
+    'BigIntegerField': 'INTEGER',
+    'IntegerField': 'INTEGER',
+    'PositiveIntegerField': 'INTEGER',
+    'PositiveSmallIntegerField': 'INTEGER',
+    'SmallIntegerField': 'INTEGER',
+    'ForeignKey': 'INTEGER',
+    'OneToOneField': 'INTEGER',
+    'BooleanField': 'BOOLEAN',
+    'NullBooleanField': 'BOOLEAN',
+    'DateField': 'DATE',
+    'DateTimeField': 'TIMESTAMP',
+    'TimeField': 'TIME',
+    'FloatField': 'REAL',
+    'DecimalField': 'NUMERIC',
+}
+
+
+class _Echo(object):
+    """
+    A file like object for csv writers that hands back each row rather
+    than storing it, so that we can yield rows as they are written.
+    """
+    def write(self, value):
+        return value
+
+
+def _write_lines(file_name, lines):
+    with open(file_name, "w") as csv_file:
+        for line in lines:
+            csv_file.write(line)
+
+
+def _episode_ids(episodes):
+    """
+    Return EPISODES as something we can filter episode ids with: a
+    subquery if they are a QuerySet, so that we never send the database
+    a list of every episode in the extract.
+    """
+    if isinstance(episodes, QuerySet):
+        return episodes.values('id')
+    return [e.id for e in episodes]
+
+
+def _columns(subrecord, field_names):
+    """
+    Return a list of (field name, lookups) for FIELD_NAMES of SUBRECORD,
+    where lookups are the values_list() lookups we read that field from,
+    or None for many to many fields, which we read separately.
+    """
+    plan = subrecord._get_field_plan()
+    columns = []
+    for name in field_names:
+        planned = plan.get(name)
+        if planned is not None and planned.fk_or_ft:
+            # Join to the lookup list rather than fetching each entry
+            columns.append((name, (name + '_fk__name', name + '_ft')))
+        elif planned is not None and planned.many_to_many:
+            columns.append((name, None))
+        else:
+            columns.append((name, (name,)))
+    return columns
+
+
+def _many_to_many_names(model, name, pks):
+    """
+    Return a dict of pk: [names] for the many to many field NAME of
+    the instances of MODEL with PKS.
+    """
+    names = collections.defaultdict(list)
+    related = model.objects.filter(pk__in=pks, **{name + '__isnull': False})
+    for pk, value in related.values_list('pk', name + '__name').order_by(
+        'pk', name + '__name'
+    ):
+        names[pk].append(value)
+    return names
+
+
+def _chunks(queryset, columns):
+    """
+    Yield lists of the values of COLUMNS for the rows of QUERYSET, reading
+    CHUNK_SIZE rows at a time in primary key order, so that we only ever
+    hold one chunk however many rows there are.
+    """
+    lookups = [l for _, field_lookups in columns if field_lookups
+               for l in field_lookups]
+    many_to_manys = [name for name, field_lookups in columns
+                     if field_lookups is None]
+    queryset = queryset.order_by('pk')
+    last = None
+
+    while True:
+        chunk = queryset
+        if last is not None:
+            chunk = chunk.filter(pk__gt=last)
+        rows = list(chunk.values_list('pk', *lookups)[:CHUNK_SIZE])
+        if not rows:
+            return
+
+        pks = [row[0] for row in rows]
+        related = {
+            name: _many_to_many_names(queryset.model, name, pks)
+            for name in many_to_manys
+        }
+
+        values = []
+        for row in rows:
+            cells = iter(row[1:])
+            row_values = []
+            for name, field_lookups in columns:
+                if field_lookups is None:
+                    row_values.append(u';'.join(related[name][row[0]]))
+                elif len(field_lookups) == 2:
+                    fk_name, free_text = next(cells), next(cells)
+                    row_values.append(
+                        free_text if fk_name is None else fk_name
+                    )
+                else:
+                    row_values.append(next(cells))
+            values.append(row_values)
+        yield values
+
+        if len(rows) < CHUNK_SIZE:
+            return
+        last = rows[-1][0]
+
+
+def _changed_since(since, api_name):
+    """
+    Return a Q object matching the rows with API_NAME that have been
+    saved since SINCE.
+    """
+    changed = ChangedRecord.objects.filter(
+        api_name=api_name, changed__gte=since
+    )
+    return Q(id__in=changed.values('record_id'))
+
+
+def _previous_episodes(changes):
+    """
+    Return the ExtractedEpisodes of the last extract for CHANGES.
+    """
+    return ExtractedEpisode.objects.filter(watermark_id=changes.watermark_id)
+
+
+def _added_episodes(episodes, changes):
+    """
+    Return the EPISODES that weren't in the last extract for CHANGES,
+    which are extracted in full.
+    """
+    return Episode.objects.filter(id__in=_episode_ids(episodes)).exclude(
+        id__in=_previous_episodes(changes).values('episode_id')
+    )
+
+
+def _encode(values):
+    return [unicode(v).encode('UTF-8') for v in values]
+
+
+def _subrecord_chunks(episodes, subrecord, field_names, changes=None):
+    """
+    Return an iterable of chunks of the values of FIELD_NAMES for the
+    SUBRECORDs of EPISODES, or of their patients for patient subrecords.
+
+    If CHANGES is set, only include rows saved since then, and the rows
+    of episodes that weren't in the last extract.
+    """
+    episode_ids = _episode_ids(episodes)
+    if issubclass(subrecord, PatientSubrecord):
+        extracted = Episode.objects.filter(id__in=episode_ids)
+        rows = subrecord.objects.filter(
+            patient_id__in=extracted.values('patient_id')
+        )
+        if changes is not None:
+            added = _added_episodes(episodes, changes)
+            rows = rows.filter(
+                _changed_since(changes.since, subrecord.get_api_name()) |
+                Q(patient_id__in=added.values('patient_id'))
+            )
+    else:
+        rows = subrecord.objects.filter(episode_id__in=episode_ids)
+        if changes is not None:
+            added = _added_episodes(episodes, changes)
+            rows = rows.filter(
+                _changed_since(changes.since, subrecord.get_api_name()) |
+                Q(episode_id__in=added.values('id'))
+            )
+    return _chunks(rows, _columns(subrecord, field_names))
+
+
+def subrecord_csv_lines(episodes, subrecord, changes=None):
     """
     Given an iterable of EPISODES, the SUBRECORD we want to serialise,
-    write a csv file for the data in this subrecord for these episodes.
+    yield the lines of a csv file for the data in this subrecord for
+    these episodes.
+
+    If CHANGES is set, only include rows saved since then, and the rows
+    of episodes that weren't in the last extract.
     """
     logging.info("writing for %s" % subrecord)
-    with open(file_name, "w") as csv_file:
-        writer = csv.writer(csv_file)
-        field_names = subrecord._get_fieldnames_to_extract()
+    writer = csv.writer(_Echo())
+    field_names = subrecord._get_fieldnames_to_extract()
 
-        for fname in ['consistency_token', 'id']:
-            if fname in field_names:
-                field_names.remove(fname)
+    for fname in ['consistency_token', 'id']:
+        if fname in field_names:
+            field_names.remove(fname)
 
-        writer.writerow(field_names)
-        subrecords = subrecord.objects.filter(episode__in=episodes)
-        for sub in subrecords:
-            writer.writerow([unicode(getattr(sub, f)).encode('UTF-8') for f in field_names])
+    yield writer.writerow(field_names)
+    for chunk in _subrecord_chunks(episodes, subrecord, field_names, changes):
+        for values in chunk:
+            yield writer.writerow(_encode(values))
     logging.info("finished writing for %s" % subrecord)
 
 
-def episode_csv(episodes, user, file_name):
+def subrecord_csv(episodes, subrecord, file_name):
     """
-    Given an iterable of EPISODES, create a CSV file containing Episode details.
+    Given an iterable of EPISODES, the SUBRECORD we want to serialise,
+    write a csv file for the data in this subrecord for these episodes.
+    """
+    _write_lines(file_name, subrecord_csv_lines(episodes, subrecord))
+
+
+def _tag_names(episode_ids, user):
+    """
+    Return a dict of episode id: [tag names] for EPISODE_IDS, including
+    historic tags, as Episode.get_tag_names(USER, historic=True) would.
+    """
+    tags = collections.defaultdict(list)
+    taggings = Tagging.objects.filter(
+        Q(user=user) | Q(user=None), episode_id__in=episode_ids
+    ).order_by('episode_id', 'id').values_list('episode_id', 'value')
+    for episode_id, value in taggings:
+        tags[episode_id].append(value)
+    return tags
+
+
+def _episode_chunks(episodes, fieldnames, changes=None):
+    """
+    Yield chunks of (id, [values of FIELDNAMES]) for EPISODES, reading
+    CHUNK_SIZE episodes at a time with their start and end computed by
+    the database.
+
+    If CHANGES is set, only include episodes that have been saved, or had
+    their tags changed, since then, or that weren't in the last extract.
+    """
+    extracted = Episode.objects.filter(
+        id__in=_episode_ids(episodes)
+    ).annotate(
+        start=Coalesce('date_of_episode', 'date_of_admission'),
+        end=Coalesce('date_of_episode', 'discharge_date'),
+    )
+    if changes is not None:
+        previous = _previous_episodes(changes).values('episode_id')
+        extracted = extracted.filter(
+            _changed_since(changes.since, 'episode') | ~Q(id__in=previous)
+        )
+    columns = [('id', ('id',)), ('category_name', ('category_name',))]
+    columns.extend(_columns(Episode, fieldnames))
+    dates = fieldnames.index('start'), fieldnames.index('end')
+    overrides = {}
+
+    for chunk in _chunks(extracted, columns):
+        # Categories with their own start and end need an instance
+        for category_name in set(values[1] for values in chunk):
+            if category_name not in overrides:
+                overrides[category_name] = queries.overrides_dates(
+                    category_name
+                )
+        instances = {}
+        overridden = [values[0] for values in chunk if overrides[values[1]]]
+        if overridden:
+            instances = Episode.objects.in_bulk(overridden)
+
+        rows = []
+        for values in chunk:
+            row = values[2:]
+            if values[0] in instances:
+                episode = instances[values[0]]
+                row[dates[0]], row[dates[1]] = episode.start, episode.end
+            rows.append((values[0], row))
+        yield rows
+
+
+def _episode_fieldnames():
+    fieldnames = Episode._get_fieldnames_to_serialize()
+    fieldnames.remove('consistency_token')
+    return fieldnames
+
+
+def episode_csv_lines(episodes, user, changes=None):
+    """
+    Given an iterable of EPISODES, yield the lines of a CSV file
+    containing Episode details.
+
+    We read CHUNK_SIZE episodes at a time, with their start and end
+    computed by the database, and the tags for each chunk in one query.
+
+    If CHANGES is set, only include episodes that have been saved, or had
+    their tags changed, since then, or that weren't in the last extract.
     """
     logging.info("writing eposides")
-    with open(file_name, "w") as csv_file:
-        fieldnames = Episode._get_fieldnames_to_serialize()
-        fieldnames.remove('consistency_token')
-        headers = list(fieldnames)
-        headers.append("tagging")
-        writer = csv.DictWriter(csv_file, fieldnames=headers)
-        writer.writeheader()
-
-        for episode in episodes:
-            row = {h: unicode(getattr(episode, h)).encode('UTF-8') for h in fieldnames}
-            row["tagging"] = ';'.join(episode.get_tag_names(user, historic=True))
-            writer.writerow(row)
+    fieldnames = _episode_fieldnames()
+    headers = list(fieldnames)
+    headers.append("tagging")
+    writer = csv.writer(_Echo())
+    yield writer.writerow(headers)
+
+    for chunk in _episode_chunks(episodes, fieldnames, changes):
+        tags = _tag_names([episode_id for episode_id, _ in chunk], user)
+        for episode_id, values in chunk:
+            row = _encode(values)
+            row.append(u';'.join(tags[episode_id]).encode('UTF-8'))
+            yield writer.writerow(row)
     logging.info("finished writing episodes")
 
 
-def patient_subrecord_csv(episodes, subrecord, file_name):
+def episode_csv(episodes, user, file_name):
+    """
+    Given an iterable of EPISODES, create a CSV file containing Episode details.
+    """
+    _write_lines(file_name, episode_csv_lines(episodes, user))
+
+
+def patient_subrecord_csv_lines(episodes, subrecord, changes=None):
     """
     Given an iterable of EPISODES, and the patient SUBRECORD we want to
-    create a CSV file for the data in this subrecord for these episodes.
+    yield the lines of a CSV file for the data in this subrecord for
+    these episodes.
+
+    Each row is labelled with the latest of its patient's EPISODES. If
+    CHANGES is set, only include rows saved since then, and the rows of
+    patients with episodes that weren't in the last extract.
     """
     logging.info("writing patient subrecord %s" % subrecord)
-    with open(file_name, "w") as csv_file:
-        field_names = subrecord._get_fieldnames_to_extract()
-        writer = csv.writer(csv_file)
+    field_names = subrecord._get_fieldnames_to_extract()
+    writer = csv.writer(_Echo())
 
-        for fname in ['consistency_token', 'patient_id', 'id']:
-            if fname in field_names:
-                field_names.remove(fname)
+    for fname in ['consistency_token', 'patient_id', 'id']:
+        if fname in field_names:
+            field_names.remove(fname)
 
-        patient_to_episode = {e.patient_id: e.id for e in episodes}
-        subs = subrecord.objects.filter(patient__in=patient_to_episode.keys())
+    headers = list(field_names)
+    headers.insert(0, "episode_id")
+    yield writer.writerow(headers)
 
-        headers = list(field_names)
-        headers.insert(0, "episode_id")
-        writer.writerow(headers)
+    extracted = Episode.objects.filter(id__in=_episode_ids(episodes))
+    chunks = _subrecord_chunks(
+        episodes, subrecord, ['patient_id'] + field_names, changes
+    )
 
-        for sub in subs:
-            row = [patient_to_episode[sub.patient_id]]
-            row.extend(unicode(getattr(sub, f)).encode('UTF-8') for f in field_names)
-            writer.writerow(row)
+    for chunk in chunks:
+        patient_to_episode = dict(
+            extracted.filter(
+                patient_id__in=set(values[0] for values in chunk)
+            ).order_by().values_list('patient_id').annotate(Max('id'))
+        )
+        for values in chunk:
+            row = [patient_to_episode[values[0]]]
+            row.extend(_encode(values[1:]))
+            yield writer.writerow(row)
     logging.info("finished patient subrecord %s" % subrecord)
 
 
+def patient_subrecord_csv(episodes, subrecord, file_name):
+    """
+    Given an iterable of EPISODES, and the patient SUBRECORD we want to
+    create a CSV file for the data in this subrecord for these episodes.
+    """
+    _write_lines(file_name, patient_subrecord_csv_lines(episodes, subrecord))
+
+
+def archive_file_names(changes=None):
+    """
+    Return the names of the CSV files in an extract, in the order they
+    appear in the archive. Incremental extracts of CHANGES end with a
+    manifest of deleted records.
+    """
+    file_names = ["episodes.csv"]
+    for subrecord in itertools.chain(episode_subrecords(), patient_subrecords()):
+        if getattr(subrecord, '_exclude_from_extract', False):
+            continue
+        file_names.append('{0}.csv'.format(subrecord.get_api_name()))
+    if changes is not None:
+        file_names.append("deleted.csv")
+    return file_names
+
+
+def deleted_csv_lines(episodes, changes):
+    """
+    Yield the lines of a CSV file of the Episodes and Subrecords of the
+    last extract for CHANGES that have been deleted since then, followed
+    by the episodes of that extract which are no longer in EPISODES.
+    """
+    writer = csv.writer(_Echo())
+    yield writer.writerow(['api_name', 'id', 'deleted', 'reason'])
+    previous = _previous_episodes(changes)
+    deleted = DeletedRecord.objects.filter(
+        Q(episode_id__in=previous.values('episode_id')) |
+        Q(episode_id=None, patient_id__in=previous.values('patient_id')),
+        deleted__gte=changes.since
+    )
+    columns = [(f, (f,)) for f in ('api_name', 'record_id', 'deleted')]
+    for chunk in _chunks(deleted, columns):
+        for values in chunk:
+            yield writer.writerow(_encode(values) + ['deleted'])
+
+    # Deleted episodes are listed above
+    left = previous.exclude(
+        episode_id__in=_episode_ids(episodes)
+    ).filter(episode_id__in=Episode.objects.values('id'))
+    for chunk in _chunks(left, [('episode_id', ('episode_id',))]):
+        for values in chunk:
+            yield writer.writerow(['episode', values[0], '', 'left_filter'])
+
+
+def file_lines(file_name, episodes, user, changes=None):
+    """
+    Return an iterable of the lines of the extract file FILE_NAME for
+    EPISODES, extracted for USER, optionally only with CHANGES.
+    """
+    if file_name == "episodes.csv":
+        return episode_csv_lines(episodes, user, changes=changes)
+    if file_name == "deleted.csv":
+        return deleted_csv_lines(episodes, changes)
+
+    subrecord = get_subrecord_from_api_name(file_name[:-len('.csv')])
+    if issubclass(subrecord, PatientSubrecord):
+        return patient_subrecord_csv_lines(episodes, subrecord, changes=changes)
+    return subrecord_csv_lines(episodes, subrecord, changes=changes)
+
+
+def write_file(directory, file_name, episodes, user, changes=None):
+    """
+    Write the extract file FILE_NAME for EPISODES into DIRECTORY, and
+    return its path.
+    """
+    path = os.path.join(directory, file_name)
+    _write_lines(path, file_lines(file_name, episodes, user, changes=changes))
+    return path
+
+
+def _description_lines(description):
+    if isinstance(description, unicode):
+        description = description.encode('UTF-8')
+    return [description]
+
+
+def archive_entries(episodes, description, user, changes=None):
+    """
+    Given an iterable of EPISODES, the DESCRIPTION of this set of episodes,
+    and the USER for which we are extracting, yield the name and an
+    iterable of the lines of each file in an extract.
+    """
+    for file_name in archive_file_names(changes):
+        yield file_name, file_lines(file_name, episodes, user, changes=changes)
+    yield 'filter.txt', _description_lines(description)
+
+
+def _portable(episodes):
+    """
+    Return EPISODES in a form we can hand to another thread or process
+    without evaluating them.
+    """
+    if isinstance(episodes, QuerySet):
+        return episodes.query.clone()
+    return [e.id for e in episodes]
+
+
+def _from_portable(portable):
+    if isinstance(portable, list):
+        return Episode.objects.filter(id__in=portable)
+    episodes = Episode.objects.all()
+    episodes.query = portable
+    return episodes
+
+
+def _forget_connections():
+    """
+    Processes in our pool inherit their parent's database connections,
+    which they must not use, so make them open their own.
+    """
+    for connection in connections.all():
+        connection.connection = None
+
+
+def _write_file_in_worker(job):
+    directory, file_name, portable, user, changes = job
+    try:
+        return write_file(
+            directory, file_name, _from_portable(portable), user, changes=changes
+        )
+    finally:
+        # Each worker thread or process has its own connections
+        connections.close_all()
+
+
+def _make_pool(workers):
+    if getattr(settings, 'OPAL_EXTRACT_POOL', 'thread') == 'process':
+        return multiprocessing.Pool(workers, initializer=_forget_connections)
+    return ThreadPool(workers)
+
+
+def _read_file(paths):
+    """
+    Yield the contents of the next of PATHS in chunks, removing it once
+    it has been read.
+    """
+    path = next(paths)
+    try:
+        with open(path, 'rb') as extract_file:
+            for chunk in iter(lambda: extract_file.read(zipstream.CHUNK_SIZE), b''):
+                yield chunk
+    finally:
+        os.remove(path)
+
+
+def _stream_archive_in_parallel(episodes, description, user, changes,
+                                zipfolder, workers):
+    """
+    Write the files of an extract concurrently with a pool of WORKERS,
+    and yield the chunks of an archive of them in the usual order as
+    each is finished.
+    """
+    directory = tempfile.mkdtemp()
+    pool = _make_pool(workers)
+    try:
+        file_names = archive_file_names(changes)
+        paths = pool.imap(_write_file_in_worker, [
+            (directory, file_name, _portable(episodes), user, changes)
+            for file_name in file_names
+        ])
+        stream = zipstream.ZipStream()
+        for file_name in file_names:
+            stream.add(os.path.join(zipfolder, file_name), _read_file(paths))
+        stream.add(
+            os.path.join(zipfolder, 'filter.txt'),
+            _description_lines(description)
+        )
+        for chunk in stream:
+            yield chunk
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def stream_archive(episodes, description, user, changes=None):
+    """
+    Given an iterable of EPISODES, the DESCRIPTION of this set of episodes,
+    and the USER for which we are extracting, return an iterable of the
+    chunks of a zip archive with all of these episodes as CSVs.
+
+    Each CSV is written straight into the archive as its rows are read,
+    so the memory this takes doesn't grow with the size of the extract.
+
+    If settings.OPAL_EXTRACT_WORKERS is more than 1, we instead write the
+    CSVs concurrently to temporary files with a pool of that many
+    threads, or processes if settings.OPAL_EXTRACT_POOL is 'process'.
+
+    If CHANGES is set, we only extract those changes, along with a
+    manifest of deleted records and episodes that have left the search.
+    """
+    zipfolder = '{0}.{1}'.format(user.username, datetime.date.today())
+    workers = getattr(settings, 'OPAL_EXTRACT_WORKERS', 1)
+    if workers > 1:
+        return _stream_archive_in_parallel(
+            episodes, description, user, changes, zipfolder, workers
+        )
+
+    stream = zipstream.ZipStream()
+    for file_name, lines in archive_entries(episodes, description, user, changes):
+        stream.add(os.path.join(zipfolder, file_name), lines)
+    return iter(stream)
+
+
+def assemble_archive(paths, description, user):
+    """
+    Given the PATHS of extract files written by write_file(), in order,
+    and the DESCRIPTION and USER of the extract, create a zip archive of
+    them, removing them as we go, and return its path.
+    """
+    zipfolder = '{0}.{1}'.format(user.username, datetime.date.today())
+    paths = iter(paths)
+    stream = zipstream.ZipStream()
+    for file_name in archive_file_names():
+        stream.add(os.path.join(zipfolder, file_name), _read_file(paths))
+    stream.add(
+        os.path.join(zipfolder, 'filter.txt'), _description_lines(description)
+    )
+    return _save(stream)
+
+
+def _save(chunks):
+    handle, target = tempfile.mkstemp(suffix='.zip')
+    with os.fdopen(handle, 'wb') as archive:
+        for chunk in chunks:
+            archive.write(chunk)
+    return target
+
+
 def zip_archive(episodes, description, user):
     """
     Given an iterable of EPISODES, the DESCRIPTION of this set of episodes,
     and the USER for which we are extracting, create a zip archive suitable
-    for download with all of these episodes as CSVs.
+    for download with all of these episodes as CSVs, returning its path.
     """
-    target_dir = tempfile.mkdtemp()
-    target = os.path.join(target_dir, 'extract.zip')
+    return _save(stream_archive(episodes, description, user))
 
-    with zipfile.ZipFile(target, mode='w') as z:
-        zipfolder = '{0}.{1}'.format(user.username, datetime.date.today())
-        os.mkdir(os.path.join(target_dir, zipfolder))
-        make_file_path = functools.partial(os.path.join, target_dir, zipfolder)
-        zip_relative_file_path = functools.partial(os.path.join, zipfolder)
 
-        file_name = "episodes.csv"
-        full_file_name = make_file_path(file_name)
-        episode_csv(episodes, user, full_file_name)
-        z.write(full_file_name, zip_relative_file_path(file_name))
+def _sqlite_type(model, name):
+    """
+    Return the SQLite column type for the field of MODEL with attname NAME.
+    ForeignKeyOrFreeText and many to many fields are extracted as TEXT.
+    """
+    for field in model._meta.concrete_fields:
+        if field.attname == name:
+            return SQLITE_TYPES.get(field.get_internal_type(), 'TEXT')
+    return 'TEXT'
 
-        for subrecord in episode_subrecords():
-            if getattr(subrecord, '_exclude_from_extract', False):
-                continue
-            file_name = '{0}.csv'.format(subrecord.get_api_name())
-            full_file_name = make_file_path(file_name)
-            subrecord_csv(episodes, subrecord, full_file_name)
-            z.write(full_file_name, zip_relative_file_path(file_name))
 
-        for subrecord in patient_subrecords():
+def _quote(name):
+    return '"{0}"'.format(name.replace('"', '""'))
+
+
+def _write_table(db, table, columns, chunks):
+    """
+    Create TABLE in the sqlite3 connection DB with COLUMNS, a list of
+    (name, type), and insert the rows in CHUNKS, one executemany per
+    chunk. We index the episode_id and patient_id columns once the rows
+    are in, as that's cheaper than keeping the indexes up to date.
+    """
+    definitions = []
+    for name, column_type in columns:
+        definition = u'{0} {1}'.format(_quote(name), column_type)
+        if name == 'id':
+            definition += u' PRIMARY KEY'
+        elif name == 'episode_id' and table != 'episodes':
+            definition += u' REFERENCES "episodes" ("id")'
+        definitions.append(definition)
+    db.execute(u'CREATE TABLE {0} ({1})'.format(
+        _quote(table), u', '.join(definitions)
+    ))
+
+    insert = u'INSERT INTO {0} VALUES ({1})'.format(
+        _quote(table), u', '.join(u'?' for _ in columns)
+    )
+    # sqlite3 can't adapt Decimals, so we store their text
+    decimals = [i for i, (_, column_type) in enumerate(columns)
+                if column_type == 'NUMERIC']
+    for chunk in chunks:
+        for row in chunk:
+            for i in decimals:
+                if isinstance(row[i], decimal.Decimal):
+                    row[i] = str(row[i])
+        db.executemany(insert, chunk)
+
+    for name, _ in columns:
+        if name in ('episode_id', 'patient_id'):
+            db.execute(u'CREATE INDEX {0} ON {1} ({2})'.format(
+                _quote(u'{0}_{1}'.format(table, name)),
+                _quote(table), _quote(name)
+            ))
+
+
+def sqlite_archive(episodes, description, user):
+    """
+    Given an iterable of EPISODES, the DESCRIPTION of this set of episodes,
+    and the USER for which we are extracting, create a SQLite database
+    with a table each for the episodes, their tagging and every subrecord,
+    returning its path.
+
+    Columns have the types of their fields, subrecord tables reference
+    the episodes table, and episode_id and patient_id are indexed, so
+    the extract can be queried and joined as it is.
+    """
+    handle, target = tempfile.mkstemp(suffix='.sqlite3')
+    os.close(handle)
+    db = sqlite3.connect(target)
+    try:
+        # The file is thrown away if we fail, so skip the safety nets
+        db.execute('PRAGMA journal_mode = OFF')
+        db.execute('PRAGMA synchronous = OFF')
+
+        fieldnames = _episode_fieldnames()
+        date_fields = {'start': 'DATE', 'end': 'DATE'}
+        _write_table(db, 'episodes', [
+            (name, date_fields.get(name) or _sqlite_type(Episode, name))
+            for name in fieldnames
+        ], (
+            [values for _, values in chunk]
+            for chunk in _episode_chunks(episodes, fieldnames)
+        ))
+
+        tag_names = [field.attname for field in Tagging._meta.concrete_fields]
+        taggings = Tagging.objects.filter(
+            Q(user=user) | Q(user=None), episode_id__in=_episode_ids(episodes)
+        )
+        _write_table(
+            db, 'tagging',
+            [(name, _sqlite_type(Tagging, name)) for name in tag_names],
+            _chunks(taggings, [(name, (name,)) for name in tag_names])
+        )
+
+        for subrecord in itertools.chain(episode_subrecords(), patient_subrecords()):
             if getattr(subrecord, '_exclude_from_extract', False):
                 continue
-            file_name = '{0}.csv'.format(subrecord.get_api_name())
-            full_file_name = make_file_path(file_name)
-            patient_subrecord_csv(episodes, subrecord, full_file_name)
-            z.write(full_file_name, zip_relative_file_path(file_name))
-
-        file_name = 'filter.txt'
-        full_file_name = make_file_path(file_name)
-        with open(full_file_name, 'w') as description_file:
-            description_file.write(description)
-        z.write(full_file_name, zip_relative_file_path(file_name))
+            field_names = subrecord._get_fieldnames_to_extract()
+            if 'consistency_token' in field_names:
+                field_names.remove('consistency_token')
+            _write_table(
+                db, subrecord.get_api_name(),
+                [(name, _sqlite_type(subrecord, name)) for name in field_names],
+                _subrecord_chunks(episodes, subrecord, field_names)
+            )
 
+        if isinstance(description, str):
+            description = description.decode('UTF-8')
+        _write_table(
+            db, 'filter', [('description', 'TEXT')], [[[description]]]
+        )
+        db.commit()
+    except:
+        db.close()
+        os.remove(target)
+        raise
+    db.close()
     return target
 
-def async_extract(user, criteria):
+
+def create_archive(episodes, description, user, format='zip'):
+    """
+    Given an iterable of EPISODES, the DESCRIPTION of this set of episodes,
+    the USER for which we are extracting and the FORMAT, one of FORMATS,
+    create an extract suitable for download, returning its path.
+    """
+    if format == 'sqlite':
+        return sqlite_archive(episodes, description, user)
+    return zip_archive(episodes, description, user)
+
+
+def read_and_remove(path):
+    """
+    Yield the contents of the extract at PATH in chunks, removing it
+    once it has been read.
+    """
+    return _read_file(iter([path]))
+
+
+def incremental_archive(saved_filter, user):
+    """
+    Given a SAVED_FILTER and the USER for which we are extracting, return
+    an iterable of the chunks of a zip archive of the changes to its
+    episodes since USER last extracted it, with a manifest of deleted
+    records. The first extract of a filter includes everything, as do
+    later ones for episodes that have newly matched it.
+
+    We only move the watermark on once the whole archive has been read,
+    so an interrupted download is included again next time. It moves to
+    WATERMARK_MARGIN before we started, so that rows from transactions
+    that were still open are included next time.
+    """
+    watermark, _ = ExtractWatermark.objects.get_or_create(
+        user=user, filter=saved_filter
+    )
+    started = timezone.now()
+    query = queries.create_query(user, json.loads(saved_filter.criteria))
+    episodes = query.get_episodes()
+    changes = None
+    if watermark.watermark is not None:
+        changes = Changes(watermark.watermark, watermark.id)
+    chunks = stream_archive(
+        episodes, query.description(), user, changes=changes
+    )
+    for chunk in chunks:
+        yield chunk
+
+    extracted = Episode.objects.filter(
+        id__in=_episode_ids(episodes)
+    ).values_list('id', 'patient_id')
+    with transaction.atomic():
+        watermark.watermark = started - WATERMARK_MARGIN
+        watermark.save()
+        ExtractedEpisode.objects.filter(watermark=watermark).delete()
+        ExtractedEpisode.objects.bulk_create(
+            ExtractedEpisode(
+                watermark=watermark, episode_id=episode_id,
+                patient_id=patient_id
+            ) for episode_id, patient_id in extracted
+        )
+
+
+def incremental_zip_archive(saved_filter, user):
+    """
+    Given a SAVED_FILTER and the USER for which we are extracting, create
+    a zip archive of the changes since USER last extracted it, returning
+    its path.
+    """
+    return _save(incremental_archive(saved_filter, user))
+
+
+def extract_directory(name):
+    """
+    Return the path of the directory that the extract files of the
+    subtask extract NAME are written to.
+
+    This is under settings.OPAL_EXTRACT_DIR, which every worker must be
+    able to reach.
+    """
+    root = getattr(settings, 'OPAL_EXTRACT_DIR', None)
+    if not root:
+        raise ImproperlyConfigured(
+            'OPAL_EXTRACT_SUBTASKS needs an OPAL_EXTRACT_DIR that every '
+            'worker can reach'
+        )
+    return os.path.join(root, 'opal-extract-{0}'.format(name))
+
+
+def make_extract_directory(name):
+    """
+    Create the directory for the subtask extract NAME, if another
+    subtask hasn't already, and return its path.
+    """
+    directory = extract_directory(name)
+    try:
+        os.makedirs(directory)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    return directory
+
+
+def async_extract(user, criteria, format='zip'):
+    """
+    Given the user, the criteria and the format, let's run an async
+    extract.
+
+    If settings.OPAL_EXTRACT_SUBTASKS is set, each file of a zip extract
+    is written by its own task, which finds the episodes that match
+    CRITERIA itself, and we return the id of the task that assembles
+    them. If any of these fail, we remove the files.
+    """
+    from celery import chord, group
+    from opal.core.search import tasks
+    if format == 'zip' and getattr(settings, 'OPAL_EXTRACT_SUBTASKS', False):
+        name = uuid.uuid4().hex
+        # Fail here rather than in the workers if there is nowhere to write
+        extract_directory(name)
+        files = group(
+            tasks.extract_file.s(user, criteria, name, file_name)
+            for file_name in archive_file_names()
+        )
+        assemble = tasks.assemble_extract.s(user, criteria, name)
+        # Also called if any of the files fail
+        assemble.link_error(tasks.remove_extract.si(name))
+        return chord(files, assemble).apply_async().id
+    return tasks.extract.delay(user, criteria, format).id
+
+
+def async_incremental_extract(user, filter_id):
     """
-    Given the user and the criteria, let's run an async extract.
+    Given the user and the id of a saved filter, run an async
+    incremental extract.
     """
-    from opal.core.search import queries, tasks
-    return tasks.extract.delay(user, criteria).id
+    from opal.core.search import tasks
+    return tasks.incremental_extract.delay(user, filter_id).id
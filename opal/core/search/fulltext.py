@@ -0,0 +1,391 @@
+"""
+A full text search backend for OPAL's fuzzy patient search.
+
+Rather than running icontains against every Demographics row for every
+token, we keep a tokenised index of patient names and hospital numbers
+in a table that the database can search and rank for us.
+
+To use it set:
+
+    OPAL_SEARCH_BACKEND = 'opal.core.search.fulltext.FullTextQuery'
+"""
+import collections
+import sqlite3
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models.signals import post_save, post_delete
+
+from opal import models
+from opal.core import subrecords
+from opal.core.signals import connect_subclasses, subrecords_bulk_saved
+from opal.core.search.queries import DatabaseQuery, PatientSummaryPages
+from opal.utils import stringport
+
+INDEX_FIELDS = ["first_name", "surname", "hospital_number"]
+
+
+def get_demographics_model():
+    return subrecords.get_subrecord_from_model_name("Demographics")
+
+
+# Whether the database with each alias has an index. We look once per
+# process, as the index is built by the rebuild_search_index command
+# rather than while we are serving requests.
+_BUILT = {}
+
+# Whether the SQLite database with each alias can create FTS5 trigram
+# tables
+_FTS5 = {}
+
+
+def forget_built():
+    """
+    Look for the index again next time, e.g. after a test database has
+    been rolled back.
+    """
+    _BUILT.clear()
+
+
+def _like(token):
+    """
+    Return a LIKE pattern that matches TOKEN anywhere in a document.
+    """
+    for char in "\\%_":
+        token = token.replace(char, "\\" + char)
+    return "%{0}%".format(token)
+
+
+class PatientSearchIndex(object):
+    """
+    Base class for a database specific index of Demographics.
+
+    We store one lower cased DOCUMENT per Demographics row, made
+    of the fields in INDEX_FIELDS, and a patient matches a query if
+    every token in the query appears somewhere in one of its documents.
+    """
+    table = "opal_patient_search_index"
+
+    @classmethod
+    def is_supported(klass):
+        return True
+
+    def exists(self):
+        raise NotImplementedError()
+
+    def create(self):
+        raise NotImplementedError()
+
+    def where(self, tokens):
+        """
+        Return a tuple of (sql, params) for a WHERE clause that selects
+        the rows of our table that match all of TOKENS.
+        """
+        raise NotImplementedError()
+
+    def rank(self, tokens):
+        """
+        Return a tuple of (sql, params) for an expression to ORDER BY
+        for the best matching patients to come first.
+        """
+        raise NotImplementedError()
+
+    def document(self, values):
+        return u" ".join(v for v in values if v).lower()
+
+    def is_built(self):
+        """
+        Predicate function to determine whether our index exists, only
+        asking the database the first time.
+        """
+        if connection.alias not in _BUILT:
+            _BUILT[connection.alias] = self.exists()
+        return _BUILT[connection.alias]
+
+    def build(self):
+        """
+        Create the index if it doesn't exist, and fill it from the
+        Demographics we have.
+        """
+        with transaction.atomic():
+            self.create()
+            self.rebuild()
+        _BUILT[connection.alias] = True
+
+    def rebuild(self):
+        rows = get_demographics_model().objects.values_list(
+            "id", "patient_id", *INDEX_FIELDS
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM {0}".format(self.table))
+            cursor.executemany(
+                "INSERT INTO {0} (demographics_id, patient_id, document) "
+                "VALUES (%s, %s, %s)".format(self.table),
+                [(r[0], r[1], self.document(r[2:])) for r in rows]
+            )
+
+    def update(self, demographics):
+        """
+        Reindex a list of DEMOGRAPHICS instances.
+
+        If the index has not been built yet there is nothing to do, as
+        it will include these when it is.
+        """
+        if not self.is_built():
+            return
+        self.delete([d.id for d in demographics])
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO {0} (demographics_id, patient_id, document) "
+                "VALUES (%s, %s, %s)".format(self.table),
+                [(
+                    d.id,
+                    d.patient_id,
+                    self.document(getattr(d, f) for f in INDEX_FIELDS)
+                ) for d in demographics]
+            )
+
+    def delete(self, demographics_ids):
+        if not demographics_ids or not self.is_built():
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM {0} WHERE demographics_id IN ({1})".format(
+                    self.table, ", ".join(["%s"] * len(demographics_ids))
+                ),
+                demographics_ids
+            )
+
+    def matching_patients_sql(self, tokens):
+        where, params = self.where(tokens)
+        sql = "SELECT patient_id FROM {0} WHERE {1}".format(self.table, where)
+        return sql, params
+
+    def search(self, tokens):
+        """
+        Return the ids of the patients that match TOKENS, best match first.
+        """
+        where, params = self.where(tokens)
+        rank, rank_params = self.rank(tokens)
+        sql = (
+            "SELECT patient_id FROM {0} WHERE {1} "
+            "GROUP BY patient_id ORDER BY {2}, patient_id"
+        ).format(self.table, where, rank)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + rank_params)
+            return [row[0] for row in cursor.fetchall()]
+
+
+class SqliteSearchIndex(PatientSearchIndex):
+    """
+    An FTS5 table with the trigram tokenizer, so that we can match
+    substrings of names and hospital numbers, ranked by bm25.
+
+    The trigram tokenizer can't match tokens shorter than three
+    characters, so we fall back to LIKE for those.
+    """
+
+    @classmethod
+    def is_supported(klass):
+        """
+        Predicate function to determine whether this SQLite was built
+        with FTS5 and has the trigram tokenizer, trying it on a temporary
+        table the first time we ask.
+        """
+        if connection.alias not in _FTS5:
+            _FTS5[connection.alias] = klass._probe()
+        return _FTS5[connection.alias]
+
+    @classmethod
+    def _probe(klass):
+        if sqlite3.sqlite_version_info < (3, 34, 0):
+            return False
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "CREATE VIRTUAL TABLE temp.opal_fts5_probe "
+                        "USING fts5(document, tokenize='trigram')"
+                    )
+                    cursor.execute("DROP TABLE temp.opal_fts5_probe")
+        except DatabaseError:
+            return False
+        return True
+
+    def exists(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name=%s",
+                [self.table]
+            )
+            return cursor.fetchone() is not None
+
+    def create(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS {0} USING fts5("
+                "document, demographics_id UNINDEXED, patient_id UNINDEXED, "
+                "tokenize='trigram')".format(self.table)
+            )
+
+    def _phrases(self, tokens):
+        return [
+            u'"{0}"'.format(t.replace('"', '""')) for t in tokens if len(t) >= 3
+        ]
+
+    def where(self, tokens):
+        clauses, params = [], []
+        phrases = self._phrases(tokens)
+        if phrases:
+            clauses.append("{0} MATCH %s".format(self.table))
+            params.append(u" AND ".join(phrases))
+        for token in tokens:
+            if len(token) < 3:
+                clauses.append("document LIKE %s ESCAPE '\\'")
+                params.append(_like(token))
+        return " AND ".join(clauses), params
+
+    def rank(self, tokens):
+        if self._phrases(tokens):
+            return "MIN(rank)", []
+        return "MIN(length(document))", []
+
+
+class PostgresSearchIndex(PatientSearchIndex):
+    """
+    A table with a pg_trgm GIN index on the document, which makes our
+    substring LIKE queries indexed, ranked by trigram similarity.
+    """
+
+    def exists(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [self.table])
+            return cursor.fetchone()[0]
+
+    def create(self):
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS {0} ("
+                "demographics_id integer PRIMARY KEY, "
+                "patient_id integer NOT NULL, "
+                "document text NOT NULL)".format(self.table)
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS {0}_document ON {0} "
+                "USING gin (document gin_trgm_ops)".format(self.table)
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS {0}_patient_id "
+                "ON {0} (patient_id)".format(self.table)
+            )
+
+    def where(self, tokens):
+        clauses = " AND ".join(["document LIKE %s"] * len(tokens))
+        return clauses, [_like(t) for t in tokens]
+
+    def rank(self, tokens):
+        return "MAX(similarity(document, %s)) DESC", [u" ".join(tokens)]
+
+
+INDEXES = {
+    'sqlite': SqliteSearchIndex,
+    'postgresql': PostgresSearchIndex,
+}
+
+
+def get_index():
+    """
+    Return the search index for our database, or None if we don't
+    have one for this database.
+    """
+    index = INDEXES.get(connection.vendor)
+    if index is None or not index.is_supported():
+        return None
+    return index()
+
+
+class FullTextQuery(DatabaseQuery):
+    """
+    A query backend that answers fuzzy queries from a full text index,
+    ranked by how well each patient matches rather than by the number
+    of episodes they have. Only the page of patients we ask for is
+    summarised.
+
+    Everything else is the DatabaseQuery. Databases without an index
+    implementation, or whose index hasn't been built with the
+    rebuild_search_index command, fall back to it entirely.
+    """
+
+    def fuzzy_query(self):
+        tokens = self.query.lower().split()
+        index = get_index()
+        if index is None or not tokens or not index.is_built():
+            return super(FullTextQuery, self).fuzzy_query()
+
+        matching_sql, params = index.matching_patients_sql(tokens)
+        episodes = models.Episode.objects.extra(
+            where=["{0}.patient_id IN ({1})".format(
+                models.Episode._meta.db_table, matching_sql
+            )],
+            params=params
+        )
+        patient_episodes = collections.defaultdict(list)
+        for patient_id, episode_id in episodes.values_list("patient_id", "id"):
+            patient_episodes[patient_id].append(episode_id)
+
+        return PatientSummaryPages([
+            (patient_id, patient_episodes[patient_id])
+            for patient_id in index.search(tokens)
+            if patient_id in patient_episodes
+        ])
+
+
+def is_enabled():
+    backend = getattr(settings, "OPAL_SEARCH_BACKEND", None)
+    return backend is not None and issubclass(stringport(backend), FullTextQuery)
+
+
+def _is_demographics(sender):
+    return sender.__name__ == "Demographics" and issubclass(
+        sender, models.PatientSubrecord
+    )
+
+
+def index_demographics(sender, instance=None, **kwargs):
+    """
+    Signal handler to keep the search index up to date as Demographics
+    are saved.
+    """
+    if _is_demographics(sender) and is_enabled():
+        index = get_index()
+        if index is not None:
+            index.update([instance])
+
+
+def bulk_index_demographics(sender, created=None, updated=None, **kwargs):
+    if _is_demographics(sender) and is_enabled():
+        index = get_index()
+        if index is not None:
+            index.update(list(created or []) + list(updated or []))
+
+
+def unindex_demographics(sender, instance=None, **kwargs):
+    if _is_demographics(sender) and is_enabled():
+        index = get_index()
+        if index is not None:
+            index.delete([instance.id])
+
+
+connect_subclasses(
+    post_save, index_demographics, models.PatientSubrecord,
+    dispatch_uid='OPAL.search_index_demographics_save'
+)
+connect_subclasses(
+    post_delete, unindex_demographics, models.PatientSubrecord,
+    dispatch_uid='OPAL.search_index_demographics_delete'
+)
+subrecords_bulk_saved.connect(
+    bulk_index_demographics,
+    dispatch_uid='OPAL.search_index_demographics_bulk_save'
+)
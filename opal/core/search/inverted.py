@@ -0,0 +1,385 @@
+"""
+An in process search backend for OPAL's fuzzy patient search.
+
+Each process keeps an inverted index of Demographics in memory, mapping
+the trigrams of patient names, hospital numbers and dates of birth to
+the Demographics that contain them, so that we can find matching
+patients without asking the database.
+
+To use it set:
+
+    OPAL_SEARCH_BACKEND = 'opal.core.search.inverted.InvertedIndexQuery'
+"""
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+
+from opal import models
+from opal.core import subrecords
+from opal.core.signals import connect_subclasses, subrecords_bulk_saved
+from opal.core.search.queries import DatabaseQuery, PatientSummaries
+from opal.utils import stringport
+
+# The change log is a counter at LOG_KEY, and an entry of
+# (demographics id, time) for each change at LOG_KEY.<number>
+LOG_KEY = 'opal.core.search.inverted.log'
+LOG_TIMEOUT = 24 * 60 * 60
+
+# Changes this recent are read again on every search, as we may have
+# read them before their transaction committed, or it may roll back
+SETTLE_SECONDS = 30
+
+# We read log entries and changed rows this many at a time
+CHUNK_SIZE = 500
+
+# Searches that match more patients than we can pass to the database as
+# parameters are left to the database
+MAX_PATIENT_IDS = 500
+
+
+def _log_key(number):
+    return '{0}.{1}'.format(LOG_KEY, number)
+
+
+def log_changes(demographics_ids):
+    """
+    Add the Demographics with DEMOGRAPHICS_IDS to the change log, so
+    that every process reads them again before its next search.
+    """
+    if not demographics_ids:
+        return
+    cache.add(LOG_KEY, 0, None)
+    try:
+        head = cache.incr(LOG_KEY, len(demographics_ids))
+    except ValueError:
+        # The counter was evicted, which makes everyone rebuild
+        head = len(demographics_ids)
+        cache.set(LOG_KEY, head, None)
+    now = time.time()
+    first = head - len(demographics_ids) + 1
+    cache.set_many({
+        _log_key(first + i): (demographics_id, now)
+        for i, demographics_id in enumerate(demographics_ids)
+    }, LOG_TIMEOUT)
+
+
+def _log_head():
+    return cache.get(LOG_KEY) or 0
+
+
+def get_demographics_model():
+    return subrecords.get_subrecord_from_model_name("Demographics")
+
+
+def _document(first_name, surname, hospital_number, date_of_birth):
+    """
+    Return the lower cased text we match queries against.
+    """
+    values = [first_name, surname, hospital_number]
+    if date_of_birth:
+        values.append(date_of_birth.isoformat())
+        values.append("{0:02d}/{1:02d}/{2}".format(
+            date_of_birth.day, date_of_birth.month, date_of_birth.year
+        ))
+    return u" ".join(v for v in values if v).lower()
+
+
+def _trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def _add_posting(postings, value):
+    position = bisect_left(postings, value)
+    if position == len(postings) or postings[position] != value:
+        postings.insert(position, value)
+
+
+def _remove_posting(postings, value):
+    position = bisect_left(postings, value)
+    if position < len(postings) and postings[position] == value:
+        postings.pop(position)
+
+
+def _contains(postings, value):
+    position = bisect_left(postings, value)
+    return position < len(postings) and postings[position] == value
+
+
+class Entry(object):
+    __slots__ = ["patient_id", "document", "hospital_number"]
+
+    def __init__(self, patient_id, document, hospital_number):
+        self.patient_id = patient_id
+        self.document = document
+        self.hospital_number = hospital_number
+
+
+class InvertedIndex(object):
+    """
+    An inverted index from trigrams to the sorted ids of the
+    Demographics whose document contains them, plus an exact index of
+    hospital numbers.
+
+    Posting lists are arrays of machine integers rather than lists or
+    sets of Python ints, which keeps the index compact.
+
+    The index is built from the database the first time it is used.
+    Writes in any process add the ids they changed to a change log in
+    the Django cache, and before each search we read the rows logged
+    since we last looked, so a write costs every process one query by
+    primary key rather than a rebuild. Rows stay pending for
+    SETTLE_SECONDS after they were logged and are read again on each
+    search until then, which picks up transactions that hadn't
+    committed when we first read them and undoes those that rolled back.
+    """
+    fields = ["first_name", "surname", "hospital_number", "date_of_birth"]
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.built = False
+            self.seen = 0
+            self.pending = {}
+            self.entries = {}
+            self.postings = defaultdict(lambda: array('l'))
+            self.hospital_numbers = defaultdict(lambda: array('l'))
+
+    def _log_entries(self, first, last):
+        """
+        Return the change log entries numbered FIRST to LAST, or None if
+        any have expired.
+        """
+        keys = [_log_key(n) for n in range(first, last + 1)]
+        found = cache.get_many(keys)
+        if len(found) < len(keys):
+            return None
+        return [found[k] for k in keys]
+
+    def _recent_entries(self, head):
+        """
+        Return the entries at the end of the change log up to HEAD that
+        were logged within SETTLE_SECONDS.
+        """
+        recent = []
+        since = time.time() - SETTLE_SECONDS
+        last = head
+        while last > 0:
+            first = max(1, last - CHUNK_SIZE + 1)
+            entries = self._log_entries(first, last) or []
+            for entry in reversed(entries):
+                if entry[1] < since:
+                    return recent
+                recent.append(entry)
+            if len(entries) < last - first + 1:
+                return recent
+            last = first - 1
+        return recent
+
+    def _build(self, head):
+        self.clear()
+        rows = get_demographics_model().objects.order_by("id").values_list(
+            "id", "patient_id", *self.fields
+        )
+        for row in rows:
+            self._add(row[0], row[1], *row[2:])
+        self.built = True
+        self.seen = head
+        for demographics_id, logged in self._recent_entries(head):
+            self.pending[demographics_id] = max(
+                logged, self.pending.get(demographics_id, 0)
+            )
+
+    def _refresh(self):
+        """
+        Read the pending rows again, then forget those that have settled.
+        """
+        demographics_ids = sorted(self.pending)
+        model = get_demographics_model()
+        for start in range(0, len(demographics_ids), CHUNK_SIZE):
+            chunk = demographics_ids[start:start + CHUNK_SIZE]
+            rows = model.objects.filter(id__in=chunk).values_list(
+                "id", "patient_id", *self.fields
+            )
+            for demographics_id in chunk:
+                self._remove(demographics_id)
+            for row in rows:
+                self._add(row[0], row[1], *row[2:])
+
+        since = time.time() - SETTLE_SECONDS
+        self.pending = {
+            demographics_id: logged
+            for demographics_id, logged in self.pending.items()
+            if logged >= since
+        }
+
+    def ensure(self):
+        """
+        Build the index if we haven't, or bring it up to date with the
+        change log.
+        """
+        head = _log_head()
+        with self.lock:
+            if not self.built or head < self.seen:
+                self._build(head)
+                return
+            if head > self.seen:
+                entries = self._log_entries(self.seen + 1, head)
+                if entries is None:
+                    self._build(head)
+                    return
+                for demographics_id, logged in entries:
+                    self.pending[demographics_id] = max(
+                        logged, self.pending.get(demographics_id, 0)
+                    )
+                self.seen = head
+            if self.pending:
+                self._refresh()
+
+    def _add(self, demographics_id, patient_id, first_name, surname,
+             hospital_number, date_of_birth):
+        document = _document(first_name, surname, hospital_number, date_of_birth)
+        hospital_number = (hospital_number or u"").lower()
+        self.entries[demographics_id] = Entry(
+            patient_id, document, hospital_number
+        )
+        for trigram in _trigrams(document):
+            _add_posting(self.postings[trigram], demographics_id)
+        if hospital_number:
+            _add_posting(self.hospital_numbers[hospital_number], demographics_id)
+
+    def _remove(self, demographics_id):
+        entry = self.entries.pop(demographics_id, None)
+        if entry is None:
+            return
+        for trigram in _trigrams(entry.document):
+            _remove_posting(self.postings[trigram], demographics_id)
+        if entry.hospital_number:
+            _remove_posting(
+                self.hospital_numbers[entry.hospital_number], demographics_id
+            )
+
+    def _candidates(self, token):
+        """
+        Return the ids of the Demographics that contain all trigrams of
+        TOKEN, which is a superset of those that contain TOKEN.
+        """
+        trigrams = _trigrams(token)
+        if not trigrams:
+            return self.entries.keys()
+        postings = sorted(
+            (self.postings.get(t, ()) for t in trigrams), key=len
+        )
+        return [
+            i for i in postings[0] if all(_contains(p, i) for p in postings[1:])
+        ]
+
+    def search(self, tokens):
+        """
+        Return the set of ids of patients with Demographics that contain
+        every one of TOKENS.
+        """
+        self.ensure()
+        with self.lock:
+            if not tokens:
+                return set()
+            tokens = sorted(tokens, key=len, reverse=True)
+            return set(
+                self.entries[i].patient_id for i in self._candidates(tokens[0])
+                if all(t in self.entries[i].document for t in tokens)
+            )
+
+    def hospital_number(self, hospital_number):
+        """
+        Return the ids of patients with exactly this HOSPITAL_NUMBER,
+        ignoring case.
+        """
+        self.ensure()
+        with self.lock:
+            return list(set(
+                self.entries[i].patient_id for i in
+                self.hospital_numbers.get(hospital_number.lower(), ())
+            ))
+
+
+index = InvertedIndex()
+
+
+def _is_hospital_number_lookup(criteria):
+    return (
+        criteria['queryType'] == 'Equals' and
+        criteria['column'].lower() == 'demographics' and
+        criteria['field'].replace(' ', '_').lower() == 'hospital_number'
+    )
+
+
+class InvertedIndexQuery(DatabaseQuery):
+    """
+    A query backend that finds patients for fuzzy queries and hospital
+    number lookups from an in memory inverted index.
+
+    Everything else is the DatabaseQuery.
+    """
+
+    def fuzzy_query(self):
+        patient_ids = index.search(self.query.lower().split())
+        if len(patient_ids) > MAX_PATIENT_IDS:
+            # Too many to pass as parameters, the database can do this
+            return super(InvertedIndexQuery, self).fuzzy_query()
+        episodes = models.Episode.objects.filter(patient_id__in=patient_ids)
+        return PatientSummaries(episodes, order_by=("-count", "patient_id"))
+
+    def episodes_for_criteria(self, criteria):
+        if _is_hospital_number_lookup(criteria):
+            patient_ids = index.hospital_number(criteria['query'])
+            if len(patient_ids) <= MAX_PATIENT_IDS:
+                return models.Episode.objects.filter(patient_id__in=patient_ids)
+        return super(InvertedIndexQuery, self).episodes_for_criteria(criteria)
+
+
+def is_enabled():
+    backend = getattr(settings, "OPAL_SEARCH_BACKEND", None)
+    return backend is not None and issubclass(
+        stringport(backend), InvertedIndexQuery
+    )
+
+
+def _is_demographics(sender):
+    return sender.__name__ == "Demographics" and issubclass(
+        sender, models.PatientSubrecord
+    ) and is_enabled()
+
+
+def index_demographics(sender, instance=None, **kwargs):
+    """
+    Signal handler to log changes to Demographics for the index.
+    """
+    if _is_demographics(sender):
+        log_changes([instance.id])
+
+
+def bulk_index_demographics(sender, created=None, updated=None, **kwargs):
+    if _is_demographics(sender):
+        log_changes([d.id for d in list(created or []) + list(updated or [])])
+
+
+connect_subclasses(
+    post_save, index_demographics, models.PatientSubrecord,
+    dispatch_uid='OPAL.inverted_index_demographics_save'
+)
+connect_subclasses(
+    post_delete, index_demographics, models.PatientSubrecord,
+    dispatch_uid='OPAL.inverted_index_demographics_delete'
+)
+subrecords_bulk_saved.connect(
+    bulk_index_demographics,
+    dispatch_uid='OPAL.inverted_index_demographics_bulk_save'
+)
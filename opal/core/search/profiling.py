@@ -0,0 +1,145 @@
+"""
+Profiling for OPAL's advanced search
+
+When a search is slow we want to know which part of it is responsible,
+so here we run each criterion, the step that combines them and the
+visibility filter in turn, recording the SQL, number of queries, rows
+and time each took, along with the database's plan for the combined
+query.
+"""
+import logging
+import time
+
+from django.db import connection
+from django.db.models import QuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+
+from opal.core.search.queries import episodes_for_user
+
+logger = logging.getLogger('opal.search.slow')
+
+EXPLAIN = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+
+
+def explain(queryset):
+    """
+    Return the database's query plan for QUERYSET as a list of lines,
+    or None if we don't know how to ask this database.
+    """
+    prefix = EXPLAIN.get(connection.vendor)
+    if prefix is None:
+        return None
+    try:
+        sql, params = queryset.query.sql_with_params()
+    except EmptyResultSet:
+        # Django knows there can't be any rows, so doesn't ask the database
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return [
+            u" ".join(unicode(column) for column in row)
+            for row in cursor.fetchall()
+        ]
+
+
+class QueryCounter(object):
+    """
+    Context manager that counts the queries run on CONNECTION while it
+    is active, like django.test.utils.CaptureQueriesContext but without
+    importing test utilities into production code.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        self.force_debug_cursor = self.connection.force_debug_cursor
+        self.connection.force_debug_cursor = True
+        self.initial = len(self.connection.queries_log)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.force_debug_cursor = self.force_debug_cursor
+        self.count = len(self.connection.queries_log) - self.initial
+
+
+def _sql(episodes):
+    if isinstance(episodes, QuerySet):
+        try:
+            return unicode(episodes.query)
+        except EmptyResultSet:
+            return None
+    return None
+
+
+def _measure(step):
+    """
+    Call STEP, which should return an iterable of episodes, and return
+    a dict describing what it cost.
+
+    We only fetch the ids of a QuerySet, so that we measure the query
+    rather than building Episode instances.
+    """
+    with QueryCounter(connection) as captured:
+        started = time.time()
+        episodes = step()
+        if isinstance(episodes, QuerySet):
+            rows = len(episodes.values_list('id', flat=True))
+        else:
+            rows = len(list(episodes))
+        elapsed = time.time() - started
+    return {
+        'sql': _sql(episodes),
+        'queries': len(captured),
+        'rows': rows,
+        'seconds': elapsed,
+    }
+
+
+def profile(query):
+    """
+    Given a DatabaseQuery QUERY, return a report of what each step of
+    finding its episodes costs.
+    """
+    criteria = []
+    for criterion in query.query:
+        measured = _measure(lambda: query.episodes_for_criteria(criterion))
+        measured['criteria'] = criterion
+        criteria.append(measured)
+
+    combined = _measure(query._episodes_without_restrictions)
+    composed = query._episodes_without_restrictions()
+    visibility = _measure(lambda: episodes_for_user(composed, query.user))
+
+    return {
+        'criteria': criteria,
+        'combine': combined,
+        'visibility': visibility,
+        'explain': explain(episodes_for_user(composed, query.user)),
+    }
+
+
+def log_slow_search(query, seconds):
+    """
+    Log a search that took SECONDS, with the plan for the episodes it
+    searched, if it ran a search rather than using cached results.
+
+    We only ask the database to explain that QuerySet, so we don't run
+    the search again.
+    """
+    plan = None
+    episodes = getattr(query, 'searched', None)
+    if isinstance(episodes, QuerySet):
+        plan = explain(episodes)
+
+    logger.warning(
+        u"Slow search by %s took %.2fs\nCriteria: %s\nPlan:\n%s",
+        query.user.username, seconds, query.query, u"\n".join(plan or [])
+    )
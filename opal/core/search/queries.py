@@ -1,18 +1,21 @@
 """
 Allow us to make search queries
 """
+import collections
 import datetime
 import operator
 import itertools
 from collections import Counter
 
-from django.contrib.contenttypes.models import ContentType
 from django.db import models as djangomodels
 from django.conf import settings
-from django.db.models import Q
+from django.db.models import Count, Max, Min, Q
+from django.db.models.functions import Coalesce
 
 from opal import models
-from opal.core import fields, subrecords
+from opal.core import fields, lookuplists, subrecords
+from opal.core.episodes import EpisodeCategory
+from opal.core.search import results
 from opal.utils import stringport
 
 
@@ -27,38 +30,182 @@ def get_model_from_api_name(column_name):
         return subrecords.get_subrecord_from_api_name(column_name)
 
 
-class PatientSummary(object):
-    def __init__(self, episode):
-        self.start = episode.start
-        self.end = episode.end
-        self.episode_ids = set([episode.id])
-        self.patient_id = episode.patient.id
-        self.categories = set([episode.category_name])
-        self.id = episode.patient.demographics_set.get().id
-
-    def update(self, episode):
-        if not self.start:
-            self.start = episode.start
-        elif episode.start:
-            if self.start > episode.start:
-                self.start = episode.start
-
-        if not self.end:
-            self.end = episode.end
-        elif episode.end:
-            if self.end < episode.end:
-                self.end = episode.end
-
-        self.episode_ids.add(episode.id)
-        self.categories.add(episode.category_name)
-
-    def to_dict(self):
-        result = {k: getattr(self, k) for k in [
-            "patient_id", "start", "end", "id"
-        ]}
-        result["categories"] = sorted(self.categories)
-        result["count"] = len(self.episode_ids)
-        return result
+def overrides_dates(category_name):
+    """
+    Predicate function to determine whether episodes of CATEGORY_NAME
+    have a start or end we can't compute in the database.
+    """
+    try:
+        category = EpisodeCategory.get(category_name.lower())
+    except ValueError:
+        return False
+    return category.start is not EpisodeCategory.start or \
+        category.end is not EpisodeCategory.end
+
+
+class PatientSummaries(object):
+    """
+    A lazy, sliceable sequence of patient summaries for a QuerySet of
+    EPISODES, one summary per patient.
+
+    Start, end and episode count are aggregated by the database with one
+    grouped query, and we only ever fetch the slice we ask for, so this
+    can be passed straight to a Paginator. Patients with episodes of
+    categories that override their start or end have them worked out
+    from their episodes instead.
+    """
+    DEMOGRAPHICS_FIELDS = [
+        "first_name", "surname", "hospital_number", "date_of_birth"
+    ]
+
+    def __init__(self, episodes, order_by=("patient_id",)):
+        self.episodes = episodes
+        fields = ["patient_id", "patient__demographics__id"] + [
+            "patient__demographics__" + f for f in self.DEMOGRAPHICS_FIELDS
+        ]
+        self.summaries = episodes.order_by().values(*fields).annotate(
+            start=Min(Coalesce("date_of_episode", "date_of_admission")),
+            end=Max(Coalesce("date_of_episode", "discharge_date")),
+            count=Count("id")
+        ).order_by(*order_by)
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.summaries.count()
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._to_dicts(list(self.summaries[key]))
+        return self._to_dicts([self.summaries[key]])[0]
+
+    def _to_dicts(self, rows):
+        categories = collections.defaultdict(set)
+        patient_categories = self.episodes.filter(
+            patient_id__in=[row["patient_id"] for row in rows]
+        ).order_by().values_list("patient_id", "category_name").distinct()
+
+        for patient_id, category_name in patient_categories:
+            categories[patient_id].add(category_name)
+        dates = self._overridden_dates(categories)
+
+        results = []
+        for row in rows:
+            result = {
+                f: row["patient__demographics__" + f]
+                for f in self.DEMOGRAPHICS_FIELDS
+            }
+            result.update({
+                "id": row["patient__demographics__id"],
+                "patient_id": row["patient_id"],
+                "start": row["start"],
+                "end": row["end"],
+                "count": row["count"],
+                "categories": sorted(categories[row["patient_id"]]),
+            })
+            if row["patient_id"] in dates:
+                result["start"], result["end"] = dates[row["patient_id"]]
+            results.append(result)
+        return results
+
+    def _overridden_dates(self, categories):
+        """
+        Return a dict of patient id: (start, end) for the patients in
+        CATEGORIES, a dict of patient id: category names, who have
+        episodes of categories that override their start or end.
+        """
+        overrides = {}
+        patient_ids = []
+        for patient_id, category_names in categories.items():
+            for category_name in category_names:
+                if category_name not in overrides:
+                    overrides[category_name] = overrides_dates(category_name)
+            if any(overrides[c] for c in category_names):
+                patient_ids.append(patient_id)
+        if not patient_ids:
+            return {}
+
+        starts = collections.defaultdict(list)
+        ends = collections.defaultdict(list)
+        episodes = self.episodes.filter(patient_id__in=patient_ids)
+        for episode in episodes.order_by():
+            if episode.start:
+                starts[episode.patient_id].append(episode.start)
+            if episode.end:
+                ends[episode.patient_id].append(episode.end)
+        return {
+            patient_id: (
+                min(starts[patient_id]) if starts[patient_id] else None,
+                max(ends[patient_id]) if ends[patient_id] else None,
+            )
+            for patient_id in patient_ids
+        }
+
+
+class PatientSummaryPages(object):
+    """
+    A sliceable sequence of patient summaries for PATIENT_EPISODES, an
+    ordered list of (patient_id, [episode_ids]) we have already worked
+    out, e.g. from the search result cache.
+
+    We know how many patients there are without asking the database, and
+    only summarise the patients in the slice we ask for.
+    """
+
+    def __init__(self, patient_episodes):
+        self.patient_episodes = patient_episodes
+
+    def count(self):
+        return len(self.patient_episodes)
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1 or None][0]
+        page = self.patient_episodes[key]
+        summaries = PatientSummaries(models.Episode.objects.filter(
+            id__in=[i for _, episode_ids in page for i in episode_ids]
+        ))[:]
+        by_patient = {s["patient_id"]: s for s in summaries}
+        return [by_patient[patient_id] for patient_id, _ in page]
+
+
+def visibility_filter(episodes, user):
+    """
+    Return a Q object that selects the Episodes in the QuerySet
+    EPISODES that USER can see.
+
+    Categories that can tell us which of their episodes are visible
+    with a Q object are filtered by the database. We only check the
+    episodes of any others one at a time.
+    """
+    visible = Q(pk__in=[])
+    fallback = []
+    for category in EpisodeCategory.list():
+        category_filter = category.visibility_filter(user)
+        if category_filter is None:
+            fallback.append(category.get_slug())
+        else:
+            visible |= Q(category_name__iexact=category.get_slug()) & category_filter
+
+    if fallback:
+        candidates = episodes.filter(reduce(operator.or_, [
+            Q(category_name__iexact=slug) for slug in fallback
+        ]))
+        visible |= Q(id__in=[e.id for e in candidates if e.visible_to(user)])
+    return visible
 
 
 def episodes_for_user(episodes, user):
@@ -66,10 +213,34 @@ def episodes_for_user(episodes, user):
     Given an iterable of EPISODES and a USER, return a filtered
     list of episodes that this user has the permissions to know
     about.
+
+    If EPISODES is a QuerySet, we return a QuerySet filtered by the
+    database wherever we can.
     """
+    if isinstance(episodes, djangomodels.QuerySet):
+        return episodes.filter(visibility_filter(episodes, user))
     return [e for e in episodes if e.visible_to(user)]
 
 
+def visibility_key(user):
+    """
+    Return a hashable value such that users with the same key can see
+    the same episodes.
+    """
+    return tuple(
+        (category.get_slug(), category.visibility_key(user))
+        for category in EpisodeCategory.list()
+    )
+
+
+COMBINATIONS = {
+    'and': operator.and_,
+    'or' : operator.or_,
+    # The episodes that match these criteria but not the ones before
+    'not': lambda working, q: q & ~working,
+}
+
+
 class QueryBackend(object):
     """
     Base class for search implementations to inherit from
@@ -77,6 +248,8 @@ class QueryBackend(object):
     def __init__(self, user, query):
         self.user = user
         self.query = query
+        # The QuerySet our last search ran, if any, for profiling
+        self.searched = None
 
     def fuzzy_query(self):
         raise NotImplementedError()
@@ -119,35 +292,34 @@ class DatabaseQuery(QueryBackend):
             so if you put in Anna Lisa, even though this is a first name split
             becasuse Anna and Lisa will both be found, this will rank higher
             than an Anna or a Lisa, although both of those will also be found
+
+            We return a lazy PatientSummaries, so that paging through the
+            results only counts and fetches the page we want.
         """
         some_query = self.query
         patients = models.Patient.objects.search(some_query)
         episodes = models.Episode.objects.filter(
             patient__id__in=patients.values_list("id", flat=True)
         )
-        patient_summaries = self._get_aggregate_patients_from_episodes(
-            episodes
-        )
-        return sorted(
-            patient_summaries,
-            key=lambda x: x["count"],
-            reverse=True
-        )
+        return PatientSummaries(episodes, order_by=("-count", "patient_id"))
 
-    def _episodes_for_filter_kwargs(self, filter_kwargs, model):
+    def _episodes_for_q(self, q, model):
         """
-        For a given MODEL, return the Episodes that match for FILTER_KWARGS,
+        For a given MODEL, return the Episodes that match the Q object Q,
         understanding how to handle both EpispdeSubrecord and PatientSubrecord
         appropriately.
         """
         if issubclass(model, models.EpisodeSubrecord):
-            return models.Episode.objects.filter(**filter_kwargs)
+            return models.Episode.objects.filter(q)
         elif issubclass(model, models.PatientSubrecord):
-            pats = models.Patient.objects.filter(**filter_kwargs)
-            eps = []
-            for p in pats:
-                eps += list(p.episode_set.all())
-            return eps
+            pats = models.Patient.objects.filter(q)
+            return models.Episode.objects.filter(patient__in=pats.values('id'))
+
+    def _episodes_for_filter_kwargs(self, filter_kwargs, model):
+        """
+        For a given MODEL, return the Episodes that match for FILTER_KWARGS.
+        """
+        return self._episodes_for_q(Q(**filter_kwargs), model)
 
     def _episodes_for_boolean_fields(self, query, field, contains):
         model = get_model_from_api_name(query['column'])
@@ -178,36 +350,39 @@ class DatabaseQuery(QueryBackend):
         return self._episodes_for_filter_kwargs(kwargs, model)
 
     def _episodes_for_fkorft_fields(self, query, field, contains, Mod):
+        """
+        Return a lazy QuerySet of the Episodes where FIELD of Mod matches
+        either the lookup list entry our query resolves to, or the free
+        text of our query.
+        """
         model = get_model_name_from_column_name(query['column'])
 
         # Look up to see if there is a synonym.
-        content_type = ContentType.objects.get_for_model(
-            getattr(Mod, field).foreign_model)
-        name = query['query']
-        try:
-            from opal.models import Synonym
-            synonym = Synonym.objects.get(content_type=content_type, name=name)
-            name = synonym.content_object.name
-        except Synonym.DoesNotExist: # maybe this is pointless exception bouncing?
-            pass # That's fine.
+        name, _ = lookuplists.cache.resolve(
+            getattr(Mod, field).foreign_model, query['query']
+        )
 
         kw_fk = {'{0}__{1}_fk__name{2}'.format(model.replace('_', ''), field, contains): name}
         kw_ft = {'{0}__{1}_ft{2}'.format(model.replace('_', ''), field, contains): query['query']}
 
-        if issubclass(Mod, models.EpisodeSubrecord):
+        return self._episodes_for_q(Q(**kw_fk) | Q(**kw_ft), Mod).distinct()
 
-            qs_fk = models.Episode.objects.filter(**kw_fk)
-            qs_ft = models.Episode.objects.filter(**kw_ft)
-            eps = set(list(qs_fk) + list(qs_ft))
+    def _resolve_lookuplist_queries(self):
+        """
+        Resolve the query of every criteria against a ForeignKeyOrFreeText
+        field, with one lookup per lookup list rather than per criteria,
+        so that _episodes_for_fkorft_fields finds them cached.
+        """
+        values = collections.defaultdict(set)
+        for criteria in self.query:
+            Mod = get_model_from_api_name(criteria['column'])
+            field = criteria['field'].replace(' ', '_').lower()
+            descriptor = getattr(Mod, field, None)
+            if isinstance(descriptor, fields.ForeignKeyOrFreeText):
+                values[descriptor.foreign_model].add(criteria['query'])
 
-        elif issubclass(Mod, models.PatientSubrecord):
-            qs_fk = models.Patient.objects.filter(**kw_fk)
-            qs_ft = models.Patient.objects.filter(**kw_ft)
-            pats = set(list(qs_fk) + list(qs_ft))
-            eps = []
-            for p in pats:
-                eps += list(p.episode_set.all())
-        return eps
+        for foreign_model, queries in values.items():
+            lookuplists.cache.resolve_many(foreign_model, queries)
 
     def episodes_for_criteria(self, criteria):
         """
@@ -249,81 +424,105 @@ class DatabaseQuery(QueryBackend):
                     tagging__value__iexact=tag_name
                 )
 
-            elif issubclass(Mod, models.EpisodeSubrecord):
-                eps = models.Episode.objects.filter(**kw)
-            elif issubclass(Mod, models.PatientSubrecord):
-                pats = models.Patient.objects.filter(**kw)
-                eps = []
-                for p in pats:
-                    eps += list(p.episode_set.all())
-        return eps
-
-    def _get_aggregate_patients_from_episodes(self, episodes):
-        # at the moment we use date_of_admission/discharge only if
-        # date_of_episode is null, because of this we can't do this
-        # in a vanilla orm query
-        patient_summaries = {}
-
-        for episode in episodes:
-            patient_id = episode.patient_id
-            if patient_id in patient_summaries:
-                patient_summaries[patient_id].update(episode)
             else:
-                patient_summaries[patient_id] = PatientSummary(episode)
-
-        patients = models.Patient.objects.filter(
-            id__in=patient_summaries.keys()
-        )
-        patients = patients.prefetch_related("demographics_set")
-
-        results = []
-
-        for patient_id, patient_summary in patient_summaries.iteritems():
-            patient = next(p for p in patients if p.id == patient_id)
-            demographic = patient.demographics_set.get()
-
-            result = {k: getattr(demographic, k) for k in [
-                "first_name", "surname", "hospital_number", "date_of_birth"
-                ]}
-
-            result.update(patient_summary.to_dict())
-            results.append(result)
+                eps = self._episodes_for_filter_kwargs(kw, Mod)
+        return eps
 
-        return results
+    def _criteria_to_q(self, criteria):
+        """
+        Return a Q object that matches the Episodes for one set of CRITERIA.
+        """
+        episodes = self.episodes_for_criteria(criteria)
+        if isinstance(episodes, djangomodels.QuerySet):
+            return Q(id__in=episodes.values('id'))
+        return Q(id__in=[e.id for e in episodes])
 
     def _episodes_without_restrictions(self):
-        all_matches = [(q['combine'], self.episodes_for_criteria(q))
-                       for q in self.query]
-        if not all_matches:
-            return []
+        """
+        Return a lazy QuerySet of the Episodes that match our criteria.
+
+        Each set of criteria becomes a subquery which we combine into a
+        single query, so only matching episodes leave the database.
+        """
+        if not self.query:
+            return models.Episode.objects.none()
 
-        working = set(all_matches[0][1])
-        rest = all_matches[1:]
+        self._resolve_lookuplist_queries()
+        working = self._criteria_to_q(self.query[0])
 
-        for combine, episodes in rest:
-            methods = {'and': 'intersection', 'or': 'union', 'not': 'difference'}
-            working = getattr(set(episodes), methods[combine])(working)
+        for criteria in self.query[1:]:
+            combine = COMBINATIONS[criteria['combine']]
+            working = combine(working, self._criteria_to_q(criteria))
 
-        return working
+        return models.Episode.objects.filter(working)
 
     def get_episodes(self):
+        """
+        Return a QuerySet of the Episodes that match our criteria and
+        that our user can see.
+        """
         return episodes_for_user(self._episodes_without_restrictions(), self.user)
 
-    def get_patient_summaries(self):
-        eps = self._episodes_without_restrictions()
-        episode_ids = [e.id for e in eps]
+    def _get_referenced_models(self):
+        """
+        Return the models whose data decides which episodes match our
+        criteria.
 
-        # get all episodes of patients, that have episodes that
-        # match the criteria
+        Changes to episodes and patients themselves are seen once the
+        cached result expires.
+        """
+        referenced = set()
+        for criteria in self.query:
+            Mod = get_model_from_api_name(criteria['column'])
+            referenced.add(Mod)
+            field = criteria['field'].replace(' ', '_').lower()
+            if hasattr(Mod, field) and isinstance(getattr(Mod, field), fields.ForeignKeyOrFreeText):
+                referenced.update([getattr(Mod, field).foreign_model, models.Synonym])
+            elif field in [f.name for f in Mod._meta.many_to_many]:
+                referenced.add(Mod._meta.get_field(field).related_model)
+        return sorted(referenced, key=lambda m: m._meta.db_table)
+
+    def _get_patient_episodes(self):
+        """
+        Return an ordered list of (patient_id, [episode_ids]) for every
+        episode our user can see of each patient with an episode that
+        matches our criteria.
+        """
+        eps = self._episodes_without_restrictions()
         all_eps = models.Episode.objects.filter(
-            patient__episode__in=episode_ids
+            patient__in=eps.values('patient_id')
+        ).order_by("patient_id", "id")
+        filtered_eps = episodes_for_user(
+            all_eps.only("id", "patient_id", "category_name"), self.user
+        ).values_list("patient_id", "id")
+        self.searched = filtered_eps
+        return [
+            (patient_id, [episode_id for _, episode_id in patient_eps])
+            for patient_id, patient_eps
+            in itertools.groupby(filtered_eps, lambda e: e[0])
+        ]
+
+    def get_patient_summaries(self):
+        """
+        Return the patient summaries for our criteria.
+
+        The matching ids are kept in the search result cache, so that
+        paging through them doesn't search again.
+        """
+        key = (
+            self.__class__,
+            results.normalise_criteria(self.query),
+            visibility_key(self.user)
+        )
+        patient_episodes = results.cache.get_or_set(
+            key, self._get_referenced_models(), self._get_patient_episodes
         )
-        filtered_eps = episodes_for_user(all_eps, self.user)
-        return self._get_aggregate_patients_from_episodes(filtered_eps)
+        return PatientSummaryPages(patient_episodes)
 
     def get_patients(self):
-        patients = set(e.patient for e in self.get_episodes())
-        return list(patients)
+        return list(models.Patient.objects.filter(
+            id__in=self.get_episodes().values('patient_id')
+        ))
 
     def description(self):
         """
@@ -0,0 +1,161 @@
+"""
+OPAL search result cache
+
+Paging through the results of an advanced search re-runs the same
+criteria for every page. We keep the ids each search matched, keyed by
+its criteria and the visibility of the user who ran it, so that other
+pages are a slice of those ids and a query for the patients on them.
+"""
+import collections
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connection
+from django.db.models.signals import post_save, post_delete
+
+from opal import models
+from opal.core import lookuplists, versions
+from opal.core.signals import connect_subclasses, subrecords_bulk_saved
+
+CachedResult = collections.namedtuple(
+    'CachedResult', ['expires', 'versions', 'value']
+)
+
+class SearchResultCache(object):
+    """
+    A bounded, process local cache of search results.
+
+    Entries expire after settings.OPAL_SEARCH_CACHE_TTL seconds, and are
+    evicted least recently used first once we hold more than
+    settings.OPAL_SEARCH_CACHE_SIZE of them. Setting the size to 0
+    turns the cache off.
+
+    Each entry records the versions of the models its search depends
+    on, and is stale as soon as any of them is bumped, which we do
+    whenever one of those models is saved or deleted in any process.
+    """
+    DEFAULT_SIZE = 100
+    DEFAULT_TTL = 300
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    @property
+    def max_size(self):
+        return getattr(settings, 'OPAL_SEARCH_CACHE_SIZE', self.DEFAULT_SIZE)
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'OPAL_SEARCH_CACHE_TTL', self.DEFAULT_TTL)
+
+    def get_or_set(self, key, models, compute):
+        """
+        Return the cached result for KEY, a search that depends on the
+        data in MODELS, or cache and return the result of COMPUTE().
+        """
+        if not self.max_size:
+            return compute()
+
+        current = versions.get_model_versions(models)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry.versions == current and \
+               entry.expires > time.time():
+                self.entries[key] = entry
+                return entry.value
+
+        value = compute()
+        with self.lock:
+            self.entries[key] = CachedResult(
+                expires=time.time() + self.ttl, versions=current, value=value
+            )
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+cache = SearchResultCache()
+
+
+def normalise_criteria(criteria):
+    """
+    Return a hashable version of CRITERIA with only the parts that
+    change which episodes match.
+    """
+    normalised = []
+    for position, query in enumerate(criteria):
+        normalised.append((
+            # We ignore how the first criteria combines with nothing
+            query['combine'].lower() if position else None,
+            query['column'],
+            query['field'].replace(' ', '_').lower(),
+            query['queryType'],
+            query['query'],
+        ))
+    return tuple(normalised)
+
+
+SEARCHABLE = (
+    models.Subrecord, models.Tagging, models.Synonym, lookuplists.LookupList
+)
+
+# The models written in transactions that may not have committed yet
+_uncommitted = threading.local()
+
+
+def _get_uncommitted():
+    if not hasattr(_uncommitted, 'models'):
+        _uncommitted.models = set()
+    return _uncommitted.models
+
+
+def bump_uncommitted(**kwargs):
+    """
+    Bump the versions of the models written in transactions that have
+    since finished, e.g. at the end of a request.
+    """
+    uncommitted = _get_uncommitted()
+    while uncommitted:
+        versions.bump_model_version(uncommitted.pop())
+
+
+def bump_version(sender, **kwargs):
+    """
+    Signal handler to mark cached searches that depend on SENDER as
+    stale when it changes.
+
+    Django 1.8 can't tell us when a transaction commits. If we are in
+    one, a search elsewhere could cache what it saw before we commit,
+    so we bump the version again once the request has finished.
+    """
+    if not cache.max_size:
+        return
+    versions.bump_model_version(sender)
+    if connection.in_atomic_block:
+        _get_uncommitted().add(sender)
+    else:
+        bump_uncommitted()
+
+
+for base in SEARCHABLE:
+    connect_subclasses(
+        post_save, bump_version, base,
+        dispatch_uid='OPAL.search_results_save'
+    )
+    connect_subclasses(
+        post_delete, bump_version, base,
+        dispatch_uid='OPAL.search_results_delete'
+    )
+subrecords_bulk_saved.connect(
+    bump_version, dispatch_uid='OPAL.search_results_bulk_save'
+)
+request_finished.connect(
+    bump_uncommitted, dispatch_uid='OPAL.search_results_request_finished'
+)
@@ -1,11 +1,44 @@
 from __future__ import absolute_import
 
+import shutil
+
 from celery import shared_task
 
 @shared_task
-def extract(user, criteria):
+def extract(user, criteria, format='zip'):
     from opal.core.search import queries, extract
     query = queries.create_query(user, criteria)
     episodes = query.get_episodes()
-    fname = extract.zip_archive(episodes, query.description(), user)
+    fname = extract.create_archive(
+        episodes, query.description(), user, format=format
+    )
+    return fname
+
+@shared_task
+def extract_file(user, criteria, name, file_name):
+    from opal.core.search import queries, extract
+    query = queries.create_query(user, criteria)
+    return extract.write_file(
+        extract.make_extract_directory(name), file_name,
+        query.get_episodes(), user
+    )
+
+@shared_task
+def assemble_extract(paths, user, criteria, name):
+    from opal.core.search import queries, extract
+    query = queries.create_query(user, criteria)
+    fname = extract.assemble_archive(paths, query.description(), user)
+    shutil.rmtree(extract.extract_directory(name), ignore_errors=True)
     return fname
+
+@shared_task
+def remove_extract(name):
+    from opal.core.search import extract
+    shutil.rmtree(extract.extract_directory(name), ignore_errors=True)
+
+@shared_task
+def incremental_extract(user, filter_id):
+    from opal import models
+    from opal.core.search import extract
+    saved_filter = models.Filter.objects.get(pk=filter_id)
+    return extract.incremental_zip_archive(saved_filter, user)
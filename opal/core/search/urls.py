@@ -19,6 +19,8 @@ urlpatterns = patterns(
     url(r'^search/extract/download$', views.DownloadSearchView.as_view(), name="extract_download"),
     url(r'^search/filters/?$', views.FilterView.as_view(), name="extract_filters"),
     url(r'^search/filters/(?P<pk>\d+)/?$', views.FilterDetailView.as_view(), name="extract_filters"),
+    url(r'^search/filters/(?P<pk>\d+)/extract$', views.FilterExtractView.as_view(),
+        name="extract_filter_download"),
     url(r'^search/extract/result/(?P<task_id>[a-zA-Z0-9-]*)', 
         views.ExtractResultView.as_view(), name='extract_result'),
     url(r'^search/extract/download/(?P<task_id>[a-zA-Z0-9-]*)', 
@@ -3,12 +3,15 @@ OPAL Search views
 """
 import datetime
 import json
+import os
+import time
 from copy import copy
 from functools import wraps
 
 from django.core.exceptions import PermissionDenied
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseNotFound
+from django.http import (FileResponse, HttpResponseNotFound,
+                         StreamingHttpResponse)
 from django.views.decorators.http import require_http_methods
 from django.views.generic import View, TemplateView
 from django.core.paginator import Paginator
@@ -16,10 +19,14 @@ from django.core.paginator import Paginator
 from opal import models
 from opal.core.views import (LoginRequiredMixin, _build_json_response,
                              _get_request_data, with_no_caching)
-from opal.core.search import queries
-from opal.core.search.extract import zip_archive, async_extract
+from opal.core.search import profiling, queries
+from opal.core.search.extract import (
+    FORMATS, stream_archive, sqlite_archive, read_and_remove, async_extract,
+    incremental_archive, async_incremental_extract
+)
 
 PAGINATION_AMOUNT = 10
+SLOW_SEARCH_SECONDS = 5
 
 
 class SaveFilterModalView(TemplateView):
@@ -53,12 +60,18 @@ def ajax_login_required_view(view):
 
 
 def _add_pagination(eps, page_number):
+    """
+    Return the page of EPS for PAGE_NUMBER.
+
+    EPS may be a lazy sequence such as a PatientSummaries, in which case
+    we count it once and only fetch the page we want.
+    """
     paginator = Paginator(eps, PAGINATION_AMOUNT)
     results = {
-        "object_list": paginator.page(page_number).object_list,
+        "object_list": list(paginator.page(page_number).object_list),
         "page_number": page_number,
         "total_pages": paginator.num_pages,
-        "total_count": len(eps),
+        "total_count": paginator.count,
     }
     return results
 
@@ -99,40 +112,118 @@ def simple_search_view(request):
 
 
 class ExtractSearchView(View):
+    """
+    Run an advanced search and return a page of patient summaries.
+
+    Staff may add ?debug=1 to have a profile of the search returned
+    alongside the results. Searches that take longer than
+    settings.OPAL_SLOW_SEARCH_SECONDS are logged to the
+    opal.search.slow logger.
+    """
     @ajax_login_required_view
     def post(self, *args, **kwargs):
+        debug = bool(self.request.GET.get("debug"))
+        if debug and not self.request.user.is_staff:
+            raise PermissionDenied
+
         request_data = _get_request_data(self.request)
         page_number = 1
 
         if "page_number" in request_data[0]:
             page_number = request_data[0].pop("page_number", 1)
 
+        started = time.time()
         query = queries.create_query(
             self.request.user,
             request_data,
         )
         eps = query.get_patient_summaries()
+        results = _add_pagination(eps, page_number)
+        elapsed = time.time() - started
+
+        threshold = getattr(
+            settings, "OPAL_SLOW_SEARCH_SECONDS", SLOW_SEARCH_SECONDS
+        )
+        if threshold is not None and elapsed > threshold:
+            profiling.log_slow_search(query, elapsed)
+
+        if debug and isinstance(query, queries.DatabaseQuery):
+            results["profile"] = profiling.profile(query)
 
-        return _build_json_response(_add_pagination(eps, page_number))
+        return _build_json_response(results)
 
 
 class DownloadSearchView(View):
     @ajax_login_required_view
     def post(self, *args, **kwargs):
+        """
+        Download the episodes matching the criteria as a zip of CSVs,
+        or as a SQLite database if the format is 'sqlite'.
+        """
         if getattr(settings, 'EXTRACT_ASYNC', None):
-            criteria = _get_request_data(self.request)['criteria']
+            data = _get_request_data(self.request)
+            extract_format = data.get('format', 'zip')
+            if extract_format not in FORMATS:
+                return _build_json_response(
+                    {'error': "Unknown extract format"}, 400
+                )
             extract_id = async_extract(
                 self.request.user,
-                json.loads(criteria)
+                json.loads(data['criteria']),
+                extract_format
             )
             return _build_json_response({'extract_id': extract_id})
 
+        extract_format = self.request.POST.get('format', 'zip')
+        if extract_format not in FORMATS:
+            return _build_json_response(
+                {'error': "Unknown extract format"}, 400
+            )
         query = queries.create_query(
             self.request.user, json.loads(self.request.POST['criteria'])
         )
         episodes = query.get_episodes()
-        fname = zip_archive(episodes, query.description(), self.request.user)
-        resp = HttpResponse(open(fname, 'rb').read())
+        if extract_format == 'sqlite':
+            chunks = read_and_remove(
+                sqlite_archive(episodes, query.description(), self.request.user)
+            )
+        else:
+            chunks = stream_archive(
+                episodes, query.description(), self.request.user
+            )
+        suffix, content_type = FORMATS[extract_format]
+        resp = StreamingHttpResponse(chunks, content_type=content_type)
+        disp = 'attachment; filename="{0}extract{1}{2}"'.format(
+            settings.OPAL_BRAND_NAME, datetime.datetime.now().isoformat(),
+            suffix)
+        resp['Content-Disposition'] = disp
+        return resp
+
+
+class FilterExtractView(View):
+    @ajax_login_required_view
+    def post(self, *args, **kwargs):
+        """
+        Download the changes to the episodes of one of the user's saved
+        filters since they last extracted it.
+        """
+        try:
+            saved_filter = models.Filter.objects.get(
+                pk=kwargs['pk'], user=self.request.user
+            )
+        except models.Filter.DoesNotExist:
+            return HttpResponseNotFound()
+
+        if getattr(settings, 'EXTRACT_ASYNC', None):
+            extract_id = async_incremental_extract(
+                self.request.user, saved_filter.id
+            )
+            return _build_json_response({'extract_id': extract_id})
+
+        resp = StreamingHttpResponse(
+            incremental_archive(saved_filter, self.request.user),
+            content_type='application/zip'
+        )
         disp = 'attachment; filename="{0}extract{1}.zip"'.format(
             settings.OPAL_BRAND_NAME, datetime.datetime.now().isoformat())
         resp['Content-Disposition'] = disp
@@ -203,10 +294,11 @@ class ExtractFileView(View):
         if result.state != 'SUCCESS':
             raise ValueError('Wrong Task Larry!')
         fname = result.get()
-        with open(fname, 'rb') as fh:
-            contents = fh.read()
-        resp = HttpResponse(contents)
-        disp = 'attachment; filename="{0}extract{1}.zip"'.format(
-            settings.OPAL_BRAND_NAME, datetime.datetime.now().isoformat())
+        suffix = os.path.splitext(fname)[1]
+        content_type = dict(FORMATS.values()).get(suffix, 'application/zip')
+        resp = FileResponse(open(fname, 'rb'), content_type=content_type)
+        disp = 'attachment; filename="{0}extract{1}{2}"'.format(
+            settings.OPAL_BRAND_NAME, datetime.datetime.now().isoformat(),
+            suffix)
         resp['Content-Disposition'] = disp
         return resp
@@ -0,0 +1,137 @@
+"""
+Write zip archives as a stream of bytes
+
+The standard library's zipfile seeks back to fill in the sizes of each
+entry once it has been written, so it needs a real file and each entry
+in full before it starts. We instead write an entry's sizes in a data
+descriptor after its contents, which lets us compress entries as their
+contents are generated and hand the archive on a chunk at a time.
+"""
+import struct
+import time
+import zipfile
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+
+DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+DATA_DESCRIPTOR = struct.Struct('<4sLLL')
+DATA_DESCRIPTOR_64 = struct.Struct('<4sLQQ')
+
+
+class _Buffer(object):
+    """
+    A write only file like object that keeps track of its position,
+    and hands over whatever has been written since it was last drained.
+    """
+    def __init__(self):
+        self.position = 0
+        self.pending = 0
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.position += len(data)
+        self.pending += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.pending = 0
+        return data
+
+
+class ZipStream(object):
+    """
+    A zip archive of entries whose contents are iterables of bytes.
+
+    Iterating over a ZipStream yields the archive in chunks of roughly
+    CHUNK_SIZE, consuming the contents of each entry as it goes, so only
+    a chunk of any entry is ever held in memory.
+
+        stream = ZipStream()
+        stream.add('rows.csv', generate_rows())
+        for chunk in stream:
+            output.write(chunk)
+    """
+    def __init__(self, compression=zipfile.ZIP_DEFLATED):
+        self.compression = compression
+        self.entries = []
+
+    def add(self, arcname, contents):
+        """
+        Add an entry named ARCNAME, with CONTENTS an iterable of bytes.
+        """
+        self.entries.append((arcname, contents))
+
+    def __iter__(self):
+        buf = _Buffer()
+        archive = zipfile.ZipFile(
+            buf, mode='w', compression=self.compression, allowZip64=True
+        )
+        for arcname, contents in self.entries:
+            for chunk in self._write_entry(archive, buf, arcname, contents):
+                yield chunk
+
+        archive.close()
+        yield buf.drain()
+
+    def _write_entry(self, archive, buf, arcname, contents):
+        zinfo = zipfile.ZipInfo(
+            arcname, date_time=time.localtime(time.time())[:6]
+        )
+        zinfo.compress_type = self.compression
+        zinfo.external_attr = 0o600 << 16
+        # Sizes and CRC follow the contents in a data descriptor
+        zinfo.flag_bits |= 0x08
+        zinfo.header_offset = buf.tell()
+        archive._writecheck(zinfo)
+        buf.write(zinfo.FileHeader(zip64=False))
+
+        compressor = None
+        if self.compression == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15
+            )
+
+        crc = file_size = compress_size = 0
+        for data in contents:
+            if not data:
+                continue
+            crc = zlib.crc32(data, crc) & 0xffffffff
+            file_size += len(data)
+            if compressor:
+                data = compressor.compress(data)
+            compress_size += len(data)
+            buf.write(data)
+            if buf.pending >= CHUNK_SIZE:
+                yield buf.drain()
+
+        if compressor:
+            data = compressor.flush()
+            compress_size += len(data)
+            buf.write(data)
+
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+
+        descriptor = DATA_DESCRIPTOR
+        if file_size > zipfile.ZIP64_LIMIT or \
+           compress_size > zipfile.ZIP64_LIMIT:
+            descriptor = DATA_DESCRIPTOR_64
+        buf.write(descriptor.pack(
+            DATA_DESCRIPTOR_SIGNATURE, crc, compress_size, file_size
+        ))
+
+        archive.filelist.append(zinfo)
+        archive.NameToInfo[zinfo.filename] = zinfo
+
+        if buf.pending >= CHUNK_SIZE:
+            yield buf.drain()
@@ -1,3 +1,36 @@
 """
-Make this a package.
+Custom OPAL Django signals
 """
+from django import dispatch
+from django.db.models.signals import class_prepared
+
+subrecords_bulk_saved = dispatch.Signal(providing_args=["created", "updated"])
+
+
+def _subclasses(klass):
+    for subclass in klass.__subclasses__():
+        yield subclass
+        for descendant in _subclasses(subclass):
+            yield descendant
+
+
+def connect_subclasses(signal, receiver, base, dispatch_uid):
+    """
+    Connect RECEIVER to SIGNAL for BASE and each of its concrete
+    subclasses, including those defined later, rather than for every
+    model in the system.
+    """
+    def connect(model):
+        if issubclass(model, base) and not model._meta.abstract:
+            signal.connect(receiver, sender=model, dispatch_uid=dispatch_uid)
+
+    connect(base)
+    for subclass in _subclasses(base):
+        connect(subclass)
+
+    def prepared(sender, **kwargs):
+        connect(sender)
+
+    class_prepared.connect(prepared, weak=False, dispatch_uid='{0}.{1}'.format(
+        dispatch_uid, base.__name__
+    ))
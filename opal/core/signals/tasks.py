@@ -25,3 +25,11 @@ def subrecord_post_save(sender, created, instance_id):
     instance = sender.objects.get(id=instance_id)
     subrecord_post_save.send(sender, created=created, instance=instance)
     return
+
+@shared_task
+def subrecord_bulk_post_save(sender, created_ids, updated_ids):
+    from opal.core.signals.worker import subrecord_bulk_post_save
+    created = list(sender.objects.filter(id__in=created_ids))
+    updated = list(sender.objects.filter(id__in=updated_ids))
+    subrecord_bulk_post_save.send(sender, created=created, updated=updated)
+    return
@@ -7,10 +7,12 @@ from django.dispatch import receiver
 from django.db.models.signals import post_save
 
 from opal import models
+from opal.core.signals import subrecords_bulk_saved
 
 patient_post_save   = dispatch.Signal(providing_args=["created", "instance"])
 episode_post_save   = dispatch.Signal(providing_args=["created", "instance"])
 subrecord_post_save = dispatch.Signal(providing_args=["created", "instance"])
+subrecord_bulk_post_save = dispatch.Signal(providing_args=["created", "updated"])
 
 def post_save_worker_forwarder(sender, created=None, instance=None, **kwargs):
     from django.conf import settings
@@ -25,3 +27,14 @@ def post_save_worker_forwarder(sender, created=None, instance=None, **kwargs):
     return
 
 post_save.connect(post_save_worker_forwarder, dispatch_uid='OPAL.async_signal_connector')
+
+def bulk_saved_worker_forwarder(sender, created=None, updated=None, **kwargs):
+    from django.conf import settings
+    if 'djcelery' in settings.INSTALLED_APPS:
+        from opal.core.signals import tasks
+        tasks.subrecord_bulk_post_save.delay(
+            sender, [s.id for s in created], [s.id for s in updated]
+        )
+    return
+
+subrecords_bulk_saved.connect(bulk_saved_worker_forwarder, dispatch_uid='OPAL.async_bulk_signal_connector')
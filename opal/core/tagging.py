@@ -3,12 +3,30 @@ Tagging OPAL episodes
 """
 from opal.core import patient_lists
 
+_SUBTAG_PARENTS = None
+
+
+def subtag_parents():
+    """
+    Return a dict of {subtag: tag} for every TaggedPatientList
+    with a subtag.
+
+    Patient lists are defined in code, so we only build this once.
+    """
+    global _SUBTAG_PARENTS
+    if _SUBTAG_PARENTS is None:
+        parents = {}
+        for tlist in patient_lists.TaggedPatientList.list():
+            subtag = getattr(tlist, 'subtag', None)
+            if subtag is not None:
+                parents.setdefault(subtag, tlist.tag)
+        _SUBTAG_PARENTS = parents
+    return _SUBTAG_PARENTS
+
+
 def parent(tag):
     """
     Returns the parent tag, or None if the current
     tag has no parent.
     """
-    for tlist in patient_lists.TaggedPatientList.list():
-        if getattr(tlist, 'subtag', None) == tag:
-            return tlist.tag
-    return
+    return subtag_parents().get(tag)
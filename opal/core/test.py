@@ -4,10 +4,12 @@ OPAL Test base classes
 import json
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.test import TestCase
 from django.test.client import RequestFactory
 from django.utils.functional import cached_property
 
+from opal.core import lookuplists
 from opal.core.views import OpalSerializer
 from opal.models import UserProfile, Patient
 
@@ -16,6 +18,12 @@ class OpalTestCase(TestCase):
     USERNAME = "testuser"
     PASSWORD = "password"
 
+    def _pre_setup(self):
+        super(OpalTestCase, self)._pre_setup()
+        # Data cached by previous tests has been rolled back
+        cache.clear()
+        lookuplists.cache.clear()
+
     @cached_property
     def rf(self):
         return RequestFactory()
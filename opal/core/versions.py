@@ -0,0 +1,54 @@
+"""
+OPAL cache versions
+
+A version is an opaque marker held in the Django cache that tells any
+process holding derived data (encoded payloads, cached metadata) whether
+that data is still current. Multi-process deployments should configure
+a cache backend that is shared between processes.
+"""
+import uuid
+
+from django.core.cache import cache
+
+
+def get_version(key):
+    """
+    Return the current version for KEY.
+    """
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(key):
+    """
+    Mark everything derived from the version for KEY as stale.
+    """
+    cache.set(key, uuid.uuid4().hex, None)
+
+
+def get_model_version_key(model):
+    return 'opal.core.versions.model.{0}.{1}'.format(
+        model._meta.app_label, model._meta.model_name
+    )
+
+
+def get_model_versions(models):
+    """
+    Return a tuple of the current versions of the data in MODELS with
+    a single cache lookup.
+    """
+    keys = [get_model_version_key(m) for m in models]
+    found = cache.get_many(keys)
+    return tuple(
+        found[k] if k in found else get_version(k) for k in keys
+    )
+
+
+def bump_model_version(model):
+    """
+    Mark everything derived from the data in MODEL as stale.
+    """
+    bump_version(get_model_version_key(model))
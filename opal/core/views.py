@@ -2,11 +2,12 @@
 Re-usable view components
 """
 import functools
+import hashlib
 import json
 import datetime
 
 from django.utils.dateformat import format
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
 from django.core.serializers.json import DjangoJSONEncoder
@@ -45,6 +46,32 @@ def _build_json_response(data, status_code=200):
     response.status_code = status_code
     return response
 
+def _encode_json(data):
+    """
+    Return DATA encoded as JSON, and an ETag for that content.
+
+    Keys are sorted so that equal DATA always gets the same ETag.
+    """
+    content = json.dumps(data, cls=OpalSerializer, sort_keys=True)
+    return content, hashlib.md5(content).hexdigest()
+
+def _build_cached_json_response(request, content, etag, cache_control='no-cache'):
+    """
+    Return a response for the already JSON encoded CONTENT with an ETag
+    of ETAG, or a 304 if the client sent us a matching If-None-Match.
+    """
+    etag = '"{0}"'.format(etag)
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+    client_etags = [e.strip() for e in if_none_match.split(',')]
+
+    if etag in client_etags or '*' in client_etags:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    return response
+
 def with_no_caching(view):
     @functools.wraps(view)
     def no_cache(*args, **kw):
@@ -0,0 +1,30 @@
+"""
+Write our record and extract schemas to disk, for static or CDN hosting.
+"""
+import os
+
+from django.core.management.base import BaseCommand
+
+from opal.core import schemas
+
+
+SCHEMAS = (
+    ('record', schemas.records),
+    ('extract-schema', schemas.extract),
+)
+
+
+class Command(BaseCommand):
+    args = "[directory]"
+    help = "Write the JSON record and extract schemas to DIRECTORY"
+
+    def handle(self, *args, **options):
+        directory = args[0] if args else os.getcwd()
+        for name, schema in SCHEMAS:
+            encoded = schema.get()
+            filename = os.path.join(
+                directory, "{0}.{1}.json".format(name, encoded.etag)
+            )
+            with open(filename, 'w') as fh:
+                fh.write(encoded.content)
+            self.stdout.write("Wrote {0}".format(filename))
@@ -0,0 +1,19 @@
+"""
+Rebuild the full text patient search index from Demographics.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from opal.core.search import fulltext
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full text patient search index"
+
+    def handle(self, *args, **options):
+        index = fulltext.get_index()
+        if index is None:
+            raise CommandError(
+                "No full text search index is available for this database"
+            )
+        index.build()
+        self.stdout.write("Rebuilt the patient search index")
@@ -29,6 +29,49 @@ class PatientQueryset(models.QuerySet):
             qs = qs.filter(reduce(operator.or_, q_objects))
         return qs
 
+    def serialised(self, user, patients):
+        """
+        Return a set of serialised PATIENTS.
+
+        All episodes for these patients are serialised in bulk via
+        EpisodeQueryset.serialised, so the number of queries this makes
+        is independent of the number of PATIENTS and their episodes.
+        """
+        from opal.models import Episode
+
+        patient_ids = [p.id for p in patients]
+        episodes = list(Episode.objects.filter(patient_id__in=patient_ids))
+        serialised_episodes = Episode.objects.serialised(
+            user, episodes, episode_history=True
+        )
+        patient_subs = Episode.objects.serialised_patient_subrecords(
+            patient_ids, user
+        )
+
+        patient_episodes = defaultdict(dict)
+        active_episode_ids = {}
+        for episode, as_dict in zip(episodes, serialised_episodes):
+            patient_episodes[episode.patient_id][episode.id] = as_dict
+            # Mirror Patient.get_active_episode(), the most recent wins
+            if episode.active:
+                if episode.id > active_episode_ids.get(episode.patient_id, 0):
+                    active_episode_ids[episode.patient_id] = episode.id
+
+        serialised = []
+
+        for patient_id in patient_ids:
+            d = {
+                'id': patient_id,
+                'episodes': patient_episodes[patient_id],
+                'active_episode_id': active_episode_ids.get(patient_id),
+            }
+            for model in patient_subrecords():
+                name = model.get_api_name()
+                d[name] = patient_subs[patient_id][name]
+            serialised.append(d)
+
+        return serialised
+
 
 class EpisodeQueryset(models.QuerySet):
 
@@ -39,6 +82,22 @@ class EpisodeQueryset(models.QuerySet):
         )
         return self.filter(patient_id__in=patients)
 
+    def _prefetch_subrecords(self, model, subrecords):
+        """
+        Given a subrecord MODEL and a queryset of SUBRECORDS, ensure that
+        serialising them will not hit the database once per row for
+        ForeignKeyOrFreeText or ManyToMany fields.
+        """
+        fk_names = [
+            f.name for f in model._meta.fields if f.attname.endswith('_fk_id')
+        ]
+        if fk_names:
+            subrecords = subrecords.select_related(*fk_names)
+
+        for related in model._meta.many_to_many:
+            subrecords = subrecords.prefetch_related(related.attname)
+        return subrecords
+
     def serialised_episode_subrecords(self, episodes, user):
         """
         Return all serialised subrecords for this set of EPISODES
@@ -49,46 +108,84 @@ class EpisodeQueryset(models.QuerySet):
 
         for model in episode_subrecords():
             name = model.get_api_name()
-            subrecords = model.objects.filter(episode__in=episodes)
-
-            for related in model._meta.many_to_many:
-                subrecords = subrecords.prefetch_related(related.attname)
+            subrecords = self._prefetch_subrecords(
+                model, model.objects.filter(episode__in=episodes)
+            )
 
             for sub in subrecords:
                 episode_subs[sub.episode_id][name].append(sub.to_dict(user))
         return episode_subs
 
-    def serialised(self, user, episodes, historic_tags=False, episode_history=False):
+    def serialised_patient_subrecords(self, patient_ids, user):
         """
-        Return a set of serialised EPISODES.
-
-        If HISTORIC_TAGS is Truthy, return deleted tags as well.
-        If EPISODE_HISTORY is Truthy return historic episodes as well.
+        Return all serialised subrecords for this set of PATIENT_IDS
+        in a nested hashtable where the outer key is the patient id,
+        the inner key the subrecord API name.
         """
-        patient_ids = [e.patient_id for e in episodes]
         patient_subs = defaultdict(lambda: defaultdict(list))
 
-        episode_subs = self.serialised_episode_subrecords(episodes, user)
         for model in patient_subrecords():
             name = model.get_api_name()
-            subrecords = model.objects.filter(patient__in=patient_ids)
+            subrecords = self._prefetch_subrecords(
+                model, model.objects.filter(patient__in=patient_ids)
+            )
 
             for sub in subrecords:
                 patient_subs[sub.patient_id][name].append(sub.to_dict(user))
+        return patient_subs
+
+    def serialised_episode_history(self, patient_ids, user):
+        """
+        Return the shallow serialised episode history for this set of
+        PATIENT_IDS in a hashtable keyed by patient id.
+
+        This is the bulk equivalent of Episode._episode_history_to_dict()
+        """
+        from opal.core.search.queries import episodes_for_user
+
+        order = 'date_of_episode', 'date_of_admission', 'discharge_date'
+        history = self.model.objects.filter(
+            patient_id__in=patient_ids
+        ).order_by(*order)
+
+        episode_history = defaultdict(list)
+        for episode in episodes_for_user(history, user):
+            episode_history[episode.patient_id].append(
+                episode.to_dict(user, shallow=True)
+            )
+        return episode_history
+
+    def serialised(self, user, episodes, historic_tags=False, episode_history=False):
+        """
+        Return a set of serialised EPISODES.
+
+        If HISTORIC_TAGS is Truthy, return deleted tags as well.
+        If EPISODE_HISTORY is Truthy return historic episodes as well.
+
+        The number of queries this makes is independent of the number
+        of EPISODES, their subrecords and their episode history.
+        """
+        patient_ids = set(e.patient_id for e in episodes)
+
+        episode_subs = self.serialised_episode_subrecords(episodes, user)
+        patient_subs = self.serialised_patient_subrecords(patient_ids, user)
 
         # We do this here because it's an order of magnitude quicker than hitting
         # episode.tagging_dict() for each episode in a loop.
         taggings = defaultdict(dict)
         from opal.models import Tagging
-        qs = Tagging.objects.filter(episode__in=episodes)
+        qs = Tagging.objects.filter(episode__in=episodes).filter(
+            Q(user=user) | Q(user=None)
+        )
 
         if not historic_tags:
             qs = qs.filter(archived=False)
 
-        for tag in qs:
-            if tag.value == 'mine' and tag.user != user:
-                continue
-            taggings[tag.episode_id][tag.value] = True
+        for episode_id, value in qs.values_list('episode_id', 'value'):
+            taggings[episode_id][value] = True
+
+        if episode_history:
+            histories = self.serialised_episode_history(patient_ids, user)
 
         serialised = []
 
@@ -105,7 +202,7 @@ class EpisodeQueryset(models.QuerySet):
             serialised.append(d)
 
             if episode_history:
-                d['episode_history'] = e._episode_history_to_dict(user)
+                d['episode_history'] = histories[e.patient_id]
 
         return serialised
 
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opal', '0026_extractwatermark_deletedrecord'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExtractedEpisode',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('episode_id', models.IntegerField()),
+                ('patient_id', models.IntegerField()),
+                ('watermark', models.ForeignKey(to='opal.ExtractWatermark')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='deletedrecord',
+            name='episode_id',
+            field=models.IntegerField(db_index=True, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='deletedrecord',
+            name='patient_id',
+            field=models.IntegerField(db_index=True, null=True, blank=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='extractedepisode',
+            index_together=set([('watermark', 'episode_id')]),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opal', '0027_extractedepisode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangedRecord',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('api_name', models.CharField(max_length=255)),
+                ('record_id', models.IntegerField()),
+                ('changed', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='changedrecord',
+            unique_together=set([('api_name', 'record_id')]),
+        ),
+    ]
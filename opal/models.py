@@ -1,6 +1,7 @@
 """
 OPAL Django Models
 """
+import collections
 import datetime
 import functools
 import itertools
@@ -10,8 +11,9 @@ import random
 
 from django.conf import settings
 from django.utils import timezone
-from django.db import models, transaction
-from django.db.models import Q
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Case, F, Func, Q, Value, When
+from django.db.models.sql import InsertQuery
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -21,11 +23,13 @@ from django.utils.functional import cached_property
 import reversion
 
 from opal.core import (
-    application, exceptions, lookuplists, plugins, patient_lists, tagging
+    application, exceptions, lookuplists, plugins, patient_lists, tagging,
+    versions
 )
 from opal import managers
 from opal.utils import camelcase_to_underscore, find_template
 from opal.core.fields import ForeignKeyOrFreeText
+from opal.core.signals import connect_subclasses, subrecords_bulk_saved
 from opal.core.subrecords import (
     episode_subrecords, patient_subrecords, get_subrecord_from_api_name
 )
@@ -54,11 +58,83 @@ def deserialize_date(value):
     return dt.date()
 
 
+PlannedField = collections.namedtuple(
+    'PlannedField',
+    ['name', 'type', 'getter', 'setter', 'many_to_many', 'fk_or_ft']
+)
+
+
+class FieldPlan(collections.namedtuple(
+        'FieldPlan',
+        ['fields', 'by_name', 'fieldnames', 'fieldnames_to_extract'])):
+    """
+    The precomputed, read only description of the fields we serialise
+    for a model class.
+
+    FIELDS is a tuple of PlannedField in serialisation order, BY_NAME a
+    dict of them by name, FIELDNAMES a frozenset of their names and
+    FIELDNAMES_TO_EXTRACT a tuple of those names that are not PID fields.
+    """
+    __slots__ = ()
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+
+def _plan_field(cls, name):
+    """
+    Return a PlannedField for the field NAME of CLS.
+
+    Fields we can't determine a type for (e.g. properties with a getter)
+    are planned with a type of None.
+    """
+    try:
+        field_type = cls._get_field_type(name)
+    except exceptions.UnexpectedFieldNameError:
+        field_type = None
+
+    getter = 'get_' + name
+    setter = 'set_' + name
+    return PlannedField(
+        name=name,
+        type=field_type,
+        getter=getter if hasattr(cls, getter) else None,
+        setter=setter if hasattr(cls, setter) else None,
+        many_to_many=field_type == models.fields.related.ManyToManyField,
+        fk_or_ft=field_type == ForeignKeyOrFreeText
+    )
+
+
 class SerialisableFields(object):
     """
     Mixin class that handles the getting of fields
     and field types for serialisation/deserialization
     """
+    @classmethod
+    def _get_field_plan(cls):
+        """
+        Return the FieldPlan for this class, building it the first time
+        it is used.
+
+        We look in the class __dict__ rather than using getattr() so that
+        subclasses never share their parent's plan.
+        """
+        plan = cls.__dict__.get('_field_plan')
+        if plan is None:
+            fieldnames = cls._get_fieldnames_to_serialize()
+            pid_fields = getattr(cls, 'pid_fields', ())
+            fields = tuple(_plan_field(cls, name) for name in fieldnames)
+            plan = FieldPlan(
+                fields=fields,
+                by_name={field.name: field for field in fields},
+                fieldnames=frozenset(fieldnames),
+                fieldnames_to_extract=tuple(
+                    f for f in fieldnames if f not in pid_fields
+                )
+            )
+            cls._field_plan = plan
+        return plan
+
     @classmethod
     def _get_fieldnames_to_serialize(cls):
         """
@@ -130,13 +206,14 @@ class SerialisableFields(object):
     @classmethod
     def build_field_schema(cls):
         field_schema = []
-        for fieldname in cls._get_fieldnames_to_serialize():
+        for planned in cls._get_field_plan().fields:
+            fieldname = planned.name
             if fieldname in ['id', 'patient_id', 'episode_id']:
                 continue
 
+            field = planned.type or cls._get_field_type(fieldname)
             getter = getattr(cls, 'get_field_type_for_' + fieldname, None)
             if getter is None:
-                field = cls._get_field_type(fieldname)
                 if field in [models.CharField, ForeignKeyOrFreeText]:
                     field_type = 'string'
                 else:
@@ -144,7 +221,7 @@ class SerialisableFields(object):
             else:
                 field_type = getter()
             lookup_list = None
-            if cls._get_field_type(fieldname) == ForeignKeyOrFreeText:
+            if planned.fk_or_ft:
                 fld = getattr(cls, fieldname)
                 lookup_list = camelcase_to_underscore(fld.foreign_model.__name__)
             title = cls._get_field_title(fieldname)
@@ -170,12 +247,7 @@ class UpdatesFromDictMixin(SerialisableFields):
         Return a list of fieldname to extract - which means dumping
         PID fields.
         """
-        fieldnames = cls._get_fieldnames_to_serialize()
-        if hasattr(cls, 'pid_fields'):
-            for fname in cls.pid_fields:
-                if fname in fieldnames:
-                    fieldnames.remove(fname)
-        return fieldnames
+        return list(cls._get_field_plan().fieldnames_to_extract)
 
     @classmethod
     def get_field_type_for_consistency_token(cls):
@@ -193,39 +265,39 @@ class UpdatesFromDictMixin(SerialisableFields):
             )
         )
 
-    def save_many_to_many(self, name, values, field_type):
-        field = getattr(self, name)
-        new_lookup_values = self.get_lookup_list_values_for_names(
-            field.model, values
-        )
+    def resolve_many_to_many(self, name, values):
+        """
+        Return the set of ids of the lookup list entries named by VALUES
+        for the many to many field NAME.
 
-        new_values = new_lookup_values.values_list("id", flat=True)
-        existing_values = field.all().values_list("id", flat=True)
+        Raise APIError if any of VALUES are not in the lookup list.
+        """
+        lookuplist = self._meta.get_field(name).rel.to
+        ids = set()
+        unknown_values = []
+
+        # Synonyms for the same entry resolve to the same id
+        for value in values:
+            _, pk = lookuplists.cache.resolve(lookuplist, value)
+            if pk is None:
+                unknown_values.append(value)
+            else:
+                ids.add(pk)
 
-        to_add = set(new_values) - set(existing_values)
-        to_remove = set(existing_values) - set(new_values)
+        if unknown_values:
+            error_msg = 'Unexpected fieldname(s): {}'.format(values)
+            raise exceptions.APIError(error_msg)
 
-        if len(set(new_values)) != len(set(values)):
-            # the only way this should happen is if one of the incoming
-            # values is a synonym for another incoming value so lets check this
-            synonym_found = False
-            new_names = new_lookup_values.filter(name__in=values)
-            values_set = set(values)
+        return ids
 
-            for new_name in new_names:
-                synonyms = set(new_name.synonyms.all().values_list(
-                    "name", flat=True)
-                )
-                if values_set.intersection(synonyms):
-                    synonym_found = True
-                    logging.info("found synonym {0} for {1}".format(
-                        synonyms, values_set)
-                    )
-                    break
+    def save_many_to_many(self, name, values, field_type):
+        field = getattr(self, name)
+        new_values = self.resolve_many_to_many(name, values)
+
+        existing_values = set(field.all().values_list("id", flat=True))
 
-            if not synonym_found:
-                error_msg = 'Unexpected fieldname(s): {}'.format(values)
-                raise exceptions.APIError(error_msg)
+        to_add = new_values - existing_values
+        to_remove = existing_values - new_values
 
         field.add(*to_add)
         field.remove(*to_remove)
@@ -235,9 +307,17 @@ class UpdatesFromDictMixin(SerialisableFields):
             self.__class__.__name__, data, user
         ))
 
-        if fields is None:
-            fields = set(self._get_fieldnames_to_serialize())
+        plan = self._get_field_plan()
 
+        if fields is None:
+            planned_fields = plan.fields
+            fields = plan.fieldnames
+        else:
+            planned_fields = [
+                plan.get(name) or _plan_field(self.__class__, name)
+                for name in fields
+            ]
+            fields = set(fields)
 
         if self.consistency_token and not force:
             try:
@@ -251,7 +331,24 @@ class UpdatesFromDictMixin(SerialisableFields):
             if consistency_token != self.consistency_token:
                 raise exceptions.ConsistencyError
 
-        post_save = []
+        many_to_many = self._set_values_from_dict(
+            data, user, planned_fields, fields
+        )
+
+        self.set_consistency_token()
+        self.save()
+
+        for name, values, field_type in many_to_many:
+            self.save_many_to_many(name, values, field_type)
+
+    def _set_values_from_dict(self, data, user, planned_fields, fields):
+        """
+        Set the values in DATA on this instance, without saving it.
+
+        Return a list of (name, values, field_type) for the many to many
+        fields in DATA, which can only be saved once we have an id.
+        """
+        many_to_many = []
 
         unknown_fields = set(data.keys()) - fields
 
@@ -259,20 +356,20 @@ class UpdatesFromDictMixin(SerialisableFields):
             raise exceptions.APIError(
                 'Unexpected fieldname(s): %s' % list(unknown_fields))
 
-        for name in fields:
+        for planned in planned_fields:
+            name = planned.name
             value = data.get(name, None)
 
             if name == 'consistency_token':
                 continue # shouldn't be needed - Javascripts bug?
-            setter = getattr(self, 'set_' + name, None)
-            if setter is not None:
-                setter(value, user, data)
+            if planned.setter is not None:
+                getattr(self, planned.setter)(value, user, data)
             else:
                 if name in data:
-                    field_type = self._get_field_type(name)
+                    field_type = planned.type or self._get_field_type(name)
 
-                    if field_type == models.fields.related.ManyToManyField:
-                        post_save.append(functools.partial(self.save_many_to_many, name, value, field_type))
+                    if planned.many_to_many:
+                        many_to_many.append((name, value, field_type))
                     else:
                         if value and field_type == models.fields.DateField:
                             value = deserialize_date(value)
@@ -281,11 +378,7 @@ class UpdatesFromDictMixin(SerialisableFields):
 
                         setattr(self, name, value)
 
-        self.set_consistency_token()
-        self.save()
-
-        for some_func in post_save:
-            some_func()
+        return many_to_many
 
 
 class ToDictMixin(SerialisableFields):
@@ -297,17 +390,26 @@ class ToDictMixin(SerialisableFields):
         Allow a subset of FIELDNAMES
         """
 
+        plan = self._get_field_plan()
+
         if fields is None:
-            fields = self._get_fieldnames_to_serialize()
+            planned_fields = plan.fields
+        else:
+            planned_fields = [
+                plan.get(name) or _plan_field(self.__class__, name)
+                for name in fields
+            ]
 
         d = {}
-        for name in fields:
-            getter = getattr(self, 'get_' + name, None)
-            if getter is not None:
-                value = getter(user)
+        for planned in planned_fields:
+            name = planned.name
+            if planned.getter is not None:
+                value = getattr(self, planned.getter)(user)
             else:
-                field_type = self._get_field_type(name)
-                if field_type == models.fields.related.ManyToManyField:
+                if planned.type is None:
+                    # Raises UnexpectedFieldNameError
+                    self._get_field_type(name)
+                if planned.many_to_many:
                     qs = getattr(self, name).all()
                     value = [i.to_dict(user) for i in qs]
                 else:
@@ -334,6 +436,34 @@ class Filter(models.Model):
         self.save()
 
 
+class ExtractWatermark(models.Model):
+    """
+    The time from which USER's next incremental extract of FILTER should
+    include changes.
+    """
+    user = models.ForeignKey(User)
+    filter = models.ForeignKey(Filter)
+    watermark = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        unique_together = (('user', 'filter'),)
+
+
+class ExtractedEpisode(models.Model):
+    """
+    An episode that was in the last incremental extract with WATERMARK.
+
+    We keep plain ids rather than foreign keys, so that we still know
+    about episodes that have since been deleted.
+    """
+    watermark = models.ForeignKey(ExtractWatermark)
+    episode_id = models.IntegerField()
+    patient_id = models.IntegerField()
+
+    class Meta:
+        index_together = (('watermark', 'episode_id'),)
+
+
 class ContactNumber(models.Model):
     name = models.CharField(max_length=255)
     number = models.CharField(max_length=255)
@@ -500,17 +630,7 @@ class Patient(models.Model):
 
 
     def to_dict(self, user):
-        active_episode = self.get_active_episode()
-        d = {
-            'id': self.id,
-            'episodes': {episode.id: episode.to_dict(user) for episode in self.episode_set.all()},
-            'active_episode_id': active_episode.id if active_episode else None,
-            }
-
-        for model in patient_subrecords():
-            subrecords = model.objects.filter(patient_id=self.id)
-            d[model.get_api_name()] = [subrecord.to_dict(user) for subrecord in subrecords]
-        return d
+        return Patient.objects.serialised(user, [self])[0]
 
     def update_from_demographics_dict(self, demographics_data, user):
         demographics = self.demographics_set.get()
@@ -677,11 +797,12 @@ class Episode(UpdatesFromDictMixin, TrackedModel):
     def set_tag_names(self, tag_names, user):
         """
         1. Set the episode.active status
-        2. Special case mine
-        3. Archive dangling tags not in our current list.
-        4. Add new tags.
-        5. Ensure that we're setting the parents of child tags
-        6. There is no step 6.
+        2. Work out the tags we want, including the parents of child tags
+        3. Lock this episode so concurrent edits of its tags run in turn
+        4. Diff against the tags we have, then archive, unarchive
+           and create in bulk
+        5. Special case mine, which belongs to USER
+        6. Bump the Tagging version for anything derived from tags
         """
         if len(tag_names) and not self.active:
             self.active = True
@@ -690,45 +811,71 @@ class Episode(UpdatesFromDictMixin, TrackedModel):
             self.active = False
             self.save()
 
-        if "mine" not in tag_names:
-            self.tagging_set.filter(user=user, value='mine').update(archived=True)
-        else:
-            tag, created = self.tagging_set.get_or_create(
-                value='mine', user=user
-            )
-            if not created:
-                tag.archived = False
-                tag.save()
-
-            tag_names = [t for t in tag_names if not t == 'mine']
-
-        # nuke everything and start from fresh so we don't have
-        # to deal with childless parents
-        self.tagging_set.exclude(value="mine").filter(archived=False).update(
-            archived=True,
-            updated_by=user,
-            updated=timezone.now()
+        tag_names = set(tag_names)
+        mine = 'mine' in tag_names
+        tag_names.discard('mine')
+
+        parents = tagging.subtag_parents()
+        wanted = tag_names | set(
+            parents[tag] for tag in tag_names if tag in parents
         )
-        parents = []
-        for tag in tag_names:
-            parent = tagging.parent(tag)
-            if parent:
-                parents.append(parent)
-        tag_names += parents
-
-        for tag in tag_names:
-            tagg, created = self.tagging_set.get_or_create(
-                value=tag, episode=self
-            )
-            if created:
-                tagg.created_by = user
-                tagg.created = timezone.now()
-            else:
-                tagg.archived = False
-                tagg.updated_by = user
-                tagg.updated = timezone.now()
 
-            tagg.save()
+        now = timezone.now()
+
+        with transaction.atomic():
+            # Row lock on the episode, where the database supports it
+            Episode.objects.select_for_update().get(pk=self.pk)
+
+            to_archive = []
+            to_unarchive = []
+            existing = set()
+            mine_tag = None
+
+            for pk, value, user_id, archived in self.tagging_set.values_list(
+                'id', 'value', 'user_id', 'archived'
+            ):
+                if value == 'mine':
+                    if user_id == user.id:
+                        mine_tag = (pk, archived)
+                    continue
+
+                existing.add(value)
+                if value in wanted and archived:
+                    to_unarchive.append(pk)
+                elif value not in wanted and not archived:
+                    to_archive.append(pk)
+
+            if to_archive:
+                Tagging.objects.filter(id__in=to_archive).update(
+                    archived=True, updated_by=user, updated=now
+                )
+            if to_unarchive:
+                Tagging.objects.filter(id__in=to_unarchive).update(
+                    archived=False, updated_by=user, updated=now
+                )
+
+            to_create = [
+                Tagging(
+                    value=tag, episode=self, created_by=user, created=now
+                ) for tag in wanted - existing
+            ]
+
+            if mine_tag is None:
+                if mine:
+                    to_create.append(Tagging(value='mine', episode=self, user=user))
+            elif mine_tag[1] == mine:
+                Tagging.objects.filter(id=mine_tag[0]).update(archived=not mine)
+
+            if to_create:
+                Tagging.objects.bulk_create(to_create)
+
+            if to_archive or to_unarchive or to_create or (
+                mine_tag is not None and mine_tag[1] == mine
+            ):
+                ChangedRecord.record('episode', [self.id])
+
+        # Bulk updates don't send signals, so say that tags have changed
+        versions.bump_model_version(Tagging)
 
     def tagging_dict(self, user):
         tag_names = self.get_tag_names(user)
@@ -760,8 +907,17 @@ class Episode(UpdatesFromDictMixin, TrackedModel):
     def to_dict(self, user, shallow=False):
         """
         Serialisation to JSON for Episodes
+
+        Unless SHALLOW, we defer to the batched
+        EpisodeQueryset.serialised() to include subrecords, tagging
+        and episode history.
         """
-        d = {
+        if not shallow:
+            return Episode.objects.serialised(
+                user, [self], episode_history=True
+            )[0]
+
+        return {
             'id'               : self.id,
             'category_name'    : self.category_name,
             'active'           : self.active,
@@ -773,28 +929,6 @@ class Episode(UpdatesFromDictMixin, TrackedModel):
             'end'              : self.end,
             'stage'            : self.stage,
             }
-        if shallow:
-            return d
-
-        for model in patient_subrecords():
-            subrecords = model.objects.filter(patient_id=self.patient.id)
-
-            if subrecords:
-                d[model.get_api_name()] = [
-                    subrecord.to_dict(user) for subrecord in subrecords
-                ]
-        for model in episode_subrecords():
-            subrecords = model.objects.filter(episode_id=self.id)
-
-            if subrecords:
-                d[model.get_api_name()] = [
-                    subrecord.to_dict(user) for subrecord in subrecords
-                ]
-
-        d['tagging'] = self.tagging_dict(user)
-
-        d['episode_history'] = self._episode_history_to_dict(user)
-        return d
 
 
 class Subrecord(UpdatesFromDictMixin, ToDictMixin, TrackedModel, models.Model):
@@ -931,6 +1065,244 @@ class Subrecord(UpdatesFromDictMixin, ToDictMixin, TrackedModel, models.Model):
 
             subrecord.update_from_dict(a_dict, user, force=force)
 
+    @classmethod
+    def _get_parent_field(cls):
+        if issubclass(cls, EpisodeSubrecord):
+            return cls._meta.get_field('episode')
+        return cls._meta.get_field('patient')
+
+    @classmethod
+    def bulk_write_from_dicts(cls, list_of_dicts, user, force=False):
+        """
+        Create or update many subrecords of this type in one transaction.
+
+        Dicts with an id update that subrecord, and must include its
+        consistency token unless FORCE is True.
+        Dicts without an id create a new subrecord, and must include the
+        id of its parent e.g. episode_id or patient_id.
+
+        Every dict is validated before we write anything, so either they
+        are all saved or none of them are. The subrecords we update are
+        locked while we check their consistency tokens.
+
+        Rows are written without calling save(), so custom save() methods
+        are not run. Rather than a post_save for each subrecord, we send
+        one opal.core.signals.subrecords_bulk_saved signal for the batch,
+        and add the subrecords to the current reversion revision, if any.
+
+        Return a list of the saved subrecords, in the order of LIST_OF_DICTS.
+        """
+        parent_field = cls._get_parent_field()
+        list_of_dicts = [dict(a_dict) for a_dict in list_of_dicts]
+
+        ids = [a_dict["id"] for a_dict in list_of_dicts if a_dict.get("id")]
+        if len(ids) != len(set(ids)):
+            raise exceptions.APIError(
+                'Duplicate {0} id(s)'.format(cls.get_api_name())
+            )
+
+        new_dicts = [a_dict for a_dict in list_of_dicts if not a_dict.get("id")]
+        if new_dicts and cls._is_singleton:
+            raise exceptions.APIError(
+                'attempted creation of a singleton {}'.format(cls.__name__)
+            )
+
+        parent_ids = set(a_dict.get(parent_field.attname) for a_dict in new_dicts)
+        known_parent_ids = set(parent_field.rel.to.objects.filter(
+            id__in=[i for i in parent_ids if i is not None]
+        ).values_list("id", flat=True))
+        if parent_ids - known_parent_ids:
+            raise exceptions.APIError('Nonexistant {0}(s): {1}'.format(
+                parent_field.name, sorted(parent_ids - known_parent_ids)
+            ))
+
+        with transaction.atomic():
+            existing = cls.objects.select_for_update().in_bulk(ids)
+            missing = set(ids) - set(existing.keys())
+            if missing:
+                raise exceptions.APIError('Nonexistant {0}(s): {1}'.format(
+                    cls.get_api_name(), sorted(missing)
+                ))
+
+            if not force:
+                to_check = [
+                    a_dict for a_dict in list_of_dicts
+                    if a_dict.get("id") and existing[a_dict["id"]].consistency_token
+                ]
+                if any("consistency_token" not in a_dict for a_dict in to_check):
+                    msg = 'Missing field (consistency_token) for {}'
+                    raise exceptions.APIError(msg.format(cls.__name__))
+
+                if any(
+                    a_dict["consistency_token"] != existing[a_dict["id"]].consistency_token
+                    for a_dict in to_check
+                ):
+                    raise exceptions.ConsistencyError
+
+            plan = cls._get_field_plan()
+            subrecords = []
+            many_to_many = []
+
+            for a_dict in list_of_dicts:
+                a_dict.pop("consistency_token", None)
+                if a_dict.get("id"):
+                    subrecord = existing[a_dict["id"]]
+                else:
+                    subrecord = cls()
+
+                for name, values, _ in subrecord._set_values_from_dict(
+                    a_dict, user, plan.fields, plan.fieldnames
+                ):
+                    many_to_many.append(
+                        (subrecord, name, subrecord.resolve_many_to_many(name, values))
+                    )
+
+                subrecord.set_consistency_token()
+                subrecords.append(subrecord)
+
+            created = [s for s in subrecords if s.id is None]
+            updated = [s for s in subrecords if s.id is not None]
+
+            cls._bulk_insert(created)
+            cls._bulk_update(updated)
+            cls._bulk_save_many_to_many(many_to_many)
+            cls._add_to_revision(subrecords)
+
+        subrecords_bulk_saved.send(cls, created=created, updated=updated)
+        return subrecords
+
+    @classmethod
+    def _bulk_insert(cls, subrecords):
+        """
+        Insert SUBRECORDS and set their ids.
+
+        Postgres gives us back the ids of a multi row insert. Elsewhere
+        we insert one row at a time.
+        """
+        if not subrecords:
+            return
+
+        manager = cls._base_manager
+        connection = connections[manager.db]
+        fields = [
+            f for f in cls._meta.concrete_fields
+            if not isinstance(f, models.AutoField)
+        ]
+
+        if connection.vendor != 'postgresql':
+            for subrecord in subrecords:
+                subrecord.id = manager._insert(
+                    [subrecord], fields=fields, return_id=True
+                )
+                subrecord._state.adding = False
+                subrecord._state.db = manager.db
+            return
+
+        batch_size = connection.ops.bulk_batch_size(fields, subrecords)
+        returning = ' RETURNING {0}'.format(
+            connection.ops.quote_name(cls._meta.pk.column)
+        )
+        with connection.cursor() as cursor:
+            for start in range(0, len(subrecords), batch_size):
+                batch = subrecords[start:start + batch_size]
+                query = InsertQuery(cls)
+                query.insert_values(fields, batch)
+                compiler = query.get_compiler(connection=connection)
+                ids = []
+                for sql, params in compiler.as_sql():
+                    cursor.execute(sql + returning, params)
+                    ids.extend(row[0] for row in cursor.fetchall())
+                # Postgres returns the rows of a VALUES list in order
+                for subrecord, pk in zip(batch, ids):
+                    subrecord.id = pk
+                    subrecord._state.adding = False
+                    subrecord._state.db = manager.db
+
+    @classmethod
+    def _add_to_revision(cls, subrecords):
+        """
+        Add SUBRECORDS to the current reversion revision, as its post_save
+        handler would have done for each of them.
+        """
+        context = reversion.revision_context_manager
+        if not context.is_active() or context.is_managing_manually():
+            return
+        if not reversion.is_registered(cls):
+            return
+
+        adapter = reversion.get_adapter(cls)
+        for subrecord in subrecords:
+            context.add_to_context(
+                reversion.default_revision_manager, subrecord,
+                functools.partial(
+                    adapter.get_version_data, subrecord, context.get_db()
+                )
+            )
+
+    @classmethod
+    def _bulk_update(cls, subrecords):
+        """
+        Write every field of SUBRECORDS with one UPDATE per batch.
+        """
+        if not subrecords:
+            return
+
+        connection = connections[cls.objects.db]
+        fields = [f for f in cls._meta.local_concrete_fields if not f.primary_key]
+
+        # Each subrecord needs its id and a value for every field
+        batch_size = connection.ops.bulk_batch_size(
+            [None] * (2 * len(fields) + 1), subrecords
+        )
+
+        for start in range(0, len(subrecords), batch_size):
+            batch = subrecords[start:start + batch_size]
+            values = {}
+            for field in fields:
+                value = Case(
+                    *[When(
+                        pk=s.pk,
+                        then=Value(getattr(s, field.attname), output_field=field)
+                    ) for s in batch],
+                    default=F(field.attname),
+                    output_field=field
+                )
+                if connection.vendor == 'postgresql':
+                    # Postgres types CASE from its untyped parameters
+                    value = Func(
+                        value,
+                        template='CAST(%(expressions)s AS %(db_type)s)',
+                        db_type=field.db_type(connection),
+                        output_field=field
+                    )
+                values[field.attname] = value
+
+            cls.objects.filter(pk__in=[s.pk for s in batch]).update(**values)
+
+    @classmethod
+    def _bulk_save_many_to_many(cls, many_to_many):
+        """
+        Set many to many fields from a list of (subrecord, name, ids),
+        replacing the existing values.
+        """
+        by_name = collections.defaultdict(list)
+        for subrecord, name, ids in many_to_many:
+            by_name[name].append((subrecord.id, ids))
+
+        for name, values in by_name.items():
+            field = cls._meta.get_field(name)
+            through = field.rel.through
+            source = field.m2m_field_name()
+            target = field.m2m_reverse_field_name()
+
+            through.objects.filter(
+                **{source + '__in': [subrecord_id for subrecord_id, _ in values]}
+            ).delete()
+            through.objects.bulk_create([
+                through(**{source + '_id': subrecord_id, target + '_id': pk})
+                for subrecord_id, ids in values for pk in ids
+            ])
+
 
 class PatientSubrecord(Subrecord):
     patient = models.ForeignKey(Patient)
@@ -992,6 +1364,142 @@ class Tagging(TrackedModel, models.Model):
                 patient_lists.TaggedPatientList.get_tag_names()]
 
 
+
+class DeletedRecord(models.Model):
+    """
+    A record of the deletion of an Episode or Subrecord, so that
+    incremental extracts can tell people which rows to remove.
+    """
+    api_name = models.CharField(max_length=255)
+    record_id = models.IntegerField()
+    episode_id = models.IntegerField(blank=True, null=True, db_index=True)
+    patient_id = models.IntegerField(blank=True, null=True, db_index=True)
+    deleted = models.DateTimeField(db_index=True)
+
+    def __unicode__(self):
+        return u'{0} {1} deleted {2}'.format(
+            self.api_name, self.record_id, self.deleted
+        )
+
+
+def record_deletion(sender, instance, **kwargs):
+    """
+    Signal handler to record the deletion of Episodes and Subrecords,
+    with the episode or patient they belonged to.
+    """
+    if issubclass(sender, Episode):
+        api_name = 'episode'
+        episode_id, patient_id = instance.pk, instance.patient_id
+    elif issubclass(sender, PatientSubrecord):
+        api_name = sender.get_api_name()
+        episode_id, patient_id = None, instance.patient_id
+    else:
+        api_name = sender.get_api_name()
+        episode_id, patient_id = instance.episode_id, None
+    DeletedRecord.objects.create(
+        api_name=api_name, record_id=instance.pk, episode_id=episode_id,
+        patient_id=patient_id, deleted=timezone.now()
+    )
+
+
+connect_subclasses(
+    models.signals.post_delete, record_deletion, Episode,
+    dispatch_uid='OPAL.record_deletion'
+)
+connect_subclasses(
+    models.signals.post_delete, record_deletion, Subrecord,
+    dispatch_uid='OPAL.record_deletion'
+)
+
+
+class ChangedRecord(models.Model):
+    """
+    When an Episode or Subrecord was last saved, so that incremental
+    extracts can tell which rows have changed.
+
+    We keep this apart from TrackedModel.created and .updated, which
+    only say when a row was last edited through the API.
+    """
+    api_name = models.CharField(max_length=255)
+    record_id = models.IntegerField()
+    changed = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = (('api_name', 'record_id'),)
+
+    def __unicode__(self):
+        return u'{0} {1} changed {2}'.format(
+            self.api_name, self.record_id, self.changed
+        )
+
+    @classmethod
+    def record(cls, api_name, record_ids):
+        """
+        Mark RECORD_IDS of the records with API_NAME as changed now.
+        """
+        now = timezone.now()
+        record_ids = set(record_ids)
+        changes = cls.objects.filter(api_name=api_name)
+        # Records that have changed before are the common case
+        updated = changes.filter(record_id__in=record_ids).update(changed=now)
+        if updated == len(record_ids):
+            return
+
+        known = set(changes.filter(
+            record_id__in=record_ids
+        ).values_list('record_id', flat=True))
+        new = [
+            cls(api_name=api_name, record_id=record_id, changed=now)
+            for record_id in record_ids - known
+        ]
+        try:
+            with transaction.atomic():
+                cls.objects.bulk_create(new)
+        except IntegrityError:
+            # Someone else recorded them first
+            changes.filter(
+                record_id__in=[change.record_id for change in new]
+            ).update(changed=now)
+
+
+def record_change(sender, instance, **kwargs):
+    """
+    Signal handler to record that an Episode or Subrecord has been saved,
+    or that the tags of an episode have changed.
+    """
+    if issubclass(sender, Episode):
+        ChangedRecord.record('episode', [instance.pk])
+    elif issubclass(sender, Tagging):
+        ChangedRecord.record('episode', [instance.episode_id])
+    else:
+        ChangedRecord.record(sender.get_api_name(), [instance.pk])
+
+
+def record_bulk_changes(sender, created, updated, **kwargs):
+    """
+    Signal handler to record the Subrecords saved by
+    Subrecord.bulk_write_from_dicts.
+    """
+    ChangedRecord.record(
+        sender.get_api_name(), [s.pk for s in itertools.chain(created, updated)]
+    )
+
+
+connect_subclasses(
+    models.signals.post_save, record_change, Episode,
+    dispatch_uid='OPAL.record_change'
+)
+connect_subclasses(
+    models.signals.post_save, record_change, Subrecord,
+    dispatch_uid='OPAL.record_change'
+)
+models.signals.post_save.connect(
+    record_change, sender=Tagging, dispatch_uid='OPAL.record_change'
+)
+subrecords_bulk_saved.connect(
+    record_bulk_changes, dispatch_uid='OPAL.record_bulk_changes'
+)
+
 """
 Base Lookup Lists
 """
@@ -1550,9 +2058,9 @@ class SymptomComplex(EpisodeSubrecord):
     details = models.TextField(blank=True, null=True)
 
     def to_dict(self, user):
-        field_names = self.__class__._get_fieldnames_to_serialize()
+        field_names = self._get_field_plan().fieldnames
         result = {
             i: getattr(self, i) for i in field_names if not i == "symptoms"
         }
-        result["symptoms"] = list(self.symptoms.values_list("name", flat=True))
+        result["symptoms"] = [s.name for s in self.symptoms.all()]
         return result
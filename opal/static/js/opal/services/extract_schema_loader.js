@@ -1,7 +1,11 @@
 angular.module('opal.services')
     .factory('extractSchemaLoader', function($q, $http, $window, Schema){
     var deferred = $q.defer();
-    $http.get('/api/v0.1/extract-schema/').then(function(response) {
+    var url = '/api/v0.1/extract-schema/';
+    if($window.settings && $window.settings.EXTRACT_SCHEMA_VERSION){
+        url += '?v=' + $window.settings.EXTRACT_SCHEMA_VERSION;
+    }
+    $http.get(url).then(function(response) {
 	    var columns = response.data;
 	    deferred.resolve(new Schema(columns));
     }, function() {
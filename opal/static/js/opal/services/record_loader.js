@@ -1,7 +1,11 @@
 angular.module('opal.services')
     .factory('recordLoader', function($q, $http, $rootScope, $window){
         var deferred = $q.defer();
-        $http.get('/api/v0.1/record/').then(function(response){
+        var url = '/api/v0.1/record/';
+        if($window.settings && $window.settings.RECORD_SCHEMA_VERSION){
+            url += '?v=' + $window.settings.RECORD_SCHEMA_VERSION;
+        }
+        $http.get(url).then(function(response){
             var fields = response.data;
             $rootScope.fields = fields;
             deferred.resolve(fields)
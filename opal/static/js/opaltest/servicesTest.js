@@ -146,6 +146,42 @@ describe('services', function() {
         });
     });
 
+    describe('extractSchemaLoader with a schema version', function(){
+        var extractSchemaLoader;
+
+        beforeEach(function(){
+            module(function($provide) {
+                $provide.value('$window', {
+                    alert: jasmine.createSpy(),
+                    settings: { EXTRACT_SCHEMA_VERSION: 'abc' }
+                });
+            });
+
+            module('opal.services', function($provide) {
+                $provide.value('UserProfile', function(){ return profile; });
+            });
+
+            inject(function($injector){
+                extractSchemaLoader = $injector.get('extractSchemaLoader');
+                $httpBackend       = $injector.get('$httpBackend');
+                $rootScope         = $injector.get('$rootScope');
+            });
+        });
+
+        it('should fetch the versioned schema', function(){
+            var result;
+
+            $httpBackend.whenGET('/api/v0.1/extract-schema/?v=abc').respond(columns);
+            extractSchemaLoader.then(
+                function(r){ result = r; }
+            );
+            $rootScope.$apply();
+            $httpBackend.flush();
+
+            expect(result.columns).toEqual(columns);
+        });
+    });
+
     describe('Schema', function() {
         var Schema, schema;
 
@@ -18,8 +18,9 @@ from opal import models
 from opal.tests.models import Colour, PatientColour, HatWearer, Hat, Demographics
 from opal.core import metadata
 from opal.core.test import OpalTestCase
-from opal.core.views import _build_json_response
+from opal.core.views import _build_json_response, _encode_json
 from opal.core.exceptions import APIError
+from opal.core.schemas import EncodedSchema
 
 # this is used just to import the class for
 # EpisodeListApiTestCase and OptionsViewSetTestCase
@@ -78,20 +79,47 @@ class OPALRouterTestCase(TestCase):
         self.assertEqual(api.OPALRouter().get_default_base_name(ColourViewSet), 'colour')
 
 
-class RecordTestCase(TestCase):
+class RecordTestCase(OpalTestCase):
 
     @patch('opal.core.api.schemas')
     def test_records(self, schemas):
-        schemas.list_records.return_value = [{}]
-        self.assertEqual([{}], api.RecordViewSet().list(None).data)
+        schemas.records.get.return_value = EncodedSchema('[{}]', 'abc')
+        response = api.RecordViewSet().list(self.rf.get('/'))
+        self.assertEqual([{}], json.loads(response.content))
+        self.assertEqual('"abc"', response['ETag'])
+        self.assertEqual('private, no-cache', response['Cache-Control'])
 
+    @patch('opal.core.api.schemas')
+    def test_records_versioned(self, schemas):
+        schemas.records.get.return_value = EncodedSchema('[{}]', 'abc')
+        response = api.RecordViewSet().list(self.rf.get('/?v=abc'))
+        self.assertEqual(
+            'private, max-age={0}, immutable'.format(api.SCHEMA_MAX_AGE),
+            response['Cache-Control']
+        )
 
-class ExtractSchemaTestCase(TestCase):
+    @patch('opal.core.api.schemas')
+    def test_records_wrong_version(self, schemas):
+        schemas.records.get.return_value = EncodedSchema('[{}]', 'abc')
+        response = api.RecordViewSet().list(self.rf.get('/?v=xyz'))
+        self.assertEqual('private, no-cache', response['Cache-Control'])
+
+    @patch('opal.core.api.schemas')
+    def test_records_not_modified(self, schemas):
+        schemas.records.get.return_value = EncodedSchema('[{}]', 'abc')
+        request = self.rf.get('/', HTTP_IF_NONE_MATCH='"abc"')
+        response = api.RecordViewSet().list(request)
+        self.assertEqual(304, response.status_code)
+
+
+class ExtractSchemaTestCase(OpalTestCase):
 
     @patch('opal.core.api.schemas')
     def test_records(self, schemas):
-        schemas.extract_schema.return_value = [{}]
-        self.assertEqual([{}], api.ExtractSchemaViewSet().list(None).data)
+        schemas.extract.get.return_value = EncodedSchema('[{}]', 'abc')
+        response = api.ExtractSchemaViewSet().list(self.rf.get('/'))
+        self.assertEqual([{}], json.loads(response.content))
+        self.assertEqual('"abc"', response['ETag'])
 
 
 class ReferenceDataViewSetTestCase(OpalTestCase):
@@ -115,16 +143,61 @@ class ReferenceDataViewSetTestCase(OpalTestCase):
 
     def test_list(self):
         self.response = self.viewset.list(self.request)
-        result = self.response.data
+        result = json.loads(self.response.content)
         self.assertIn("hat", result)
         self.assertEqual(set(result["hat"]), {"top", "bowler", "high"})
         self.assertEqual(self.response.status_code, 200)
 
+    def test_list_not_modified(self):
+        etag = self.viewset.list(self.request)['ETag']
+        self.request.META = {'HTTP_IF_NONE_MATCH': etag}
+        response = self.viewset.list(self.request)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(etag, response['ETag'])
+
+    def test_list_modified_after_lookuplist_change(self):
+        etag = self.viewset.list(self.request)['ETag']
+        Hat.objects.create(name="fez")
+        self.request.META = {'HTTP_IF_NONE_MATCH': etag}
+        response = self.viewset.list(self.request)
+        self.assertEqual(200, response.status_code)
+        self.assertIn("fez", json.loads(response.content)["hat"])
+
+    def test_list_modified_after_synonym_change(self):
+        etag = self.viewset.list(self.request)['ETag']
+        models.Synonym.objects.create(
+            content_type=ContentType.objects.get_for_model(Hat),
+            object_id=self.bowler.id,
+            name="derby"
+        )
+        self.request.META = {'HTTP_IF_NONE_MATCH': etag}
+        response = self.viewset.list(self.request)
+        self.assertEqual(200, response.status_code)
+        self.assertIn("derby", json.loads(response.content)["hat"])
+
+    def test_list_etag_matches_other_endpoints(self):
+        response = self.viewset.list(self.request)
+        _, etag = _encode_json(json.loads(response.content))
+        self.assertEqual('"{0}"'.format(etag), response['ETag'])
+
+    def test_list_is_cached(self):
+        self.viewset.list(self.request)
+        with self.assertNumQueries(0):
+            self.viewset.list(self.request)
+
     def test_get(self):
         response = self.viewset.retrieve(self.request, pk='hat')
-        self.assertEqual(set(response.data), {"top", "bowler", "high"})
+        self.assertEqual(
+            set(json.loads(response.content)), {"top", "bowler", "high"}
+        )
         self.assertEqual(response.status_code, 200)
 
+    def test_get_not_modified(self):
+        etag = self.viewset.retrieve(self.request, pk='hat')['ETag']
+        self.request.META = {'HTTP_IF_NONE_MATCH': etag}
+        response = self.viewset.retrieve(self.request, pk='hat')
+        self.assertEqual(304, response.status_code)
+
     def test_get_does_not_exist(self):
         response = self.viewset.retrieve(self.request, pk='notalookuplist')
         self.assertEqual(response.status_code, 404)
@@ -136,16 +209,41 @@ class MetadataViewSetTestCase(OpalTestCase):
         mock_request.user = self.user
         response = api.MetadataViewSet().list(mock_request)
         self.assertEqual(200, response.status_code)
+        data = json.loads(response.content)
         for s in metadata.Metadata.list():
             for key, value in s.to_dict(user=self.user).items():
-                self.assertEqual(response.data[key], value)
+                self.assertEqual(data[key], value)
+
+    def test_list_not_modified(self):
+        request = self.rf.get('/')
+        request.user = self.user
+        etag = api.MetadataViewSet().list(request)['ETag']
+        request = self.rf.get('/', HTTP_IF_NONE_MATCH=etag)
+        request.user = self.user
+        response = api.MetadataViewSet().list(request)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual('private, no-cache', response['Cache-Control'])
+
+    def test_list_modified_after_invalidation(self):
+        request = self.rf.get('/')
+        request.user = self.user
+        etag = api.MetadataViewSet().list(request)['ETag']
+        models.Macro.objects.create(title='hi', expanded='Hello')
+        request = self.rf.get('/', HTTP_IF_NONE_MATCH=etag)
+        request.user = self.user
+        response = api.MetadataViewSet().list(request)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            [{'label': 'hi', 'expanded': 'Hello'}],
+            json.loads(response.content)['macros']
+        )
 
     def test_retrieve(self):
         mock_request = MagicMock(name='mock request')
         mock_request.user = self.user
         response = api.MetadataViewSet().retrieve(mock_request, pk='macros')
         self.assertEqual(200, response.status_code)
-        self.assertIn('macros', response.data)
+        self.assertIn('macros', json.loads(response.content))
 
     def test_retrieve_nonexistent_metadata(self):
         mock_request = MagicMock(name='mock request')
@@ -302,6 +400,70 @@ class SubrecordTestCase(OpalTestCase):
         response = self.viewset().destroy(MagicMock(name='request'), pk=567)
         self.assertEqual(404, response.status_code)
 
+    def test_bulk(self):
+        colour = Colour.objects.create(name='blue', episode=self.episode)
+        mock_request = MagicMock(name='mock request')
+        mock_request.user = self.user
+        mock_request.data = [
+            {'name': 'green', 'id': colour.pk},
+            {'name': 'red', 'episode_id': self.episode.pk},
+        ]
+        response = self.viewset().bulk(mock_request)
+        self.assertEqual(202, response.status_code)
+        self.assertEqual(
+            ['green', 'red'], [c['name'] for c in json.loads(response.content)]
+        )
+        self.assertEqual(2, Colour.objects.count())
+
+    def test_bulk_url(self):
+        url = reverse("colour-bulk", request=self.rf.get("/"))
+        response = self.client.post(
+            url,
+            data=json.dumps([{'name': 'red', 'episode_id': self.episode.pk}]),
+            content_type='application/json'
+        )
+        self.assertEqual(202, response.status_code)
+        self.assertEqual('red', Colour.objects.get().name)
+
+    def test_bulk_patient_subrecord(self):
+        mock_request = MagicMock(name='mock request')
+        mock_request.user = self.user
+        mock_request.data = [{'name': 'blue', 'episode_id': self.episode.pk}]
+        response = self.patientviewset().bulk(mock_request)
+        self.assertEqual(202, response.status_code)
+        self.assertEqual(self.patient, PatientColour.objects.get().patient)
+
+    def test_bulk_not_a_list(self):
+        mock_request = MagicMock(name='mock request')
+        mock_request.user = self.user
+        mock_request.data = {'name': 'blue', 'episode_id': self.episode.pk}
+        response = self.viewset().bulk(mock_request)
+        self.assertEqual(400, response.status_code)
+
+    def test_bulk_unexpected_field(self):
+        mock_request = MagicMock(name='mock request')
+        mock_request.user = self.user
+        mock_request.data = [
+            {'name': 'blue', 'episode_id': self.episode.pk},
+            {'name': 'green', 'hue': 'sea', 'episode_id': self.episode.pk},
+        ]
+        response = self.viewset().bulk(mock_request)
+        self.assertEqual(400, response.status_code)
+        self.assertFalse(Colour.objects.exists())
+
+    def test_bulk_item_changed(self):
+        colour = Colour.objects.create(
+            name='blue', episode=self.episode, consistency_token='frist'
+        )
+        mock_request = MagicMock(name='mock request')
+        mock_request.user = self.user
+        mock_request.data = [
+            {'name': 'green', 'id': colour.pk, 'consistency_token': 'wat'}
+        ]
+        response = self.viewset().bulk(mock_request)
+        self.assertEqual(409, response.status_code)
+        self.assertEqual('blue', Colour.objects.get().name)
+
 
 class ManyToManyTestSubrecordWithLookupListTest(TestCase):
 
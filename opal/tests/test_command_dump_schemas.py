@@ -0,0 +1,42 @@
+"""
+Unittests for opal.management.commands.dump_schemas
+"""
+import json
+import os
+import shutil
+import tempfile
+
+from mock import patch
+
+from opal.core import schemas
+from opal.core.test import OpalTestCase
+
+from opal.management.commands import dump_schemas
+
+class DumpSchemasTestCase(OpalTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_handle(self):
+        c = dump_schemas.Command()
+        with patch.object(c.stdout, 'write') as writer:
+            c.handle(self.directory)
+            self.assertEqual(2, writer.call_count)
+
+        records = schemas.records.get()
+        filename = os.path.join(
+            self.directory, 'record.{0}.json'.format(records.etag)
+        )
+        with open(filename) as fh:
+            self.assertEqual(schemas.list_records(), json.load(fh))
+
+        extract = schemas.extract.get()
+        filename = os.path.join(
+            self.directory, 'extract-schema.{0}.json'.format(extract.etag)
+        )
+        with open(filename) as fh:
+            self.assertEqual(schemas.extract_schema(), json.load(fh))
@@ -4,9 +4,10 @@ Unittests for opal.core.episodes
 from django.contrib.auth.models import User
 
 from opal.core import test
-from opal.models import UserProfile, Patient
+from opal.models import Episode, UserProfile, Patient
 
 from opal.core import episodes
+from opal.tests.episodes import RestrictedEpisodeCategory
 
 class EpisodeCategoryTestCase(test.OpalTestCase):
 
@@ -31,5 +32,36 @@ class EpisodeCategoryTestCase(test.OpalTestCase):
                                                          self.restricted_user)
         )
 
+    def test_visibility_filter(self):
+        self.assertEqual(
+            [self.inpatient_episode],
+            list(Episode.objects.filter(
+                episodes.InpatientEpisode.visibility_filter(self.user)
+            ))
+        )
+
+    def test_visibility_filter_restricted_only(self):
+        self.assertEqual(
+            [],
+            list(Episode.objects.filter(
+                episodes.InpatientEpisode.visibility_filter(self.restricted_user)
+            ))
+        )
+
+    def test_visibility_filter_overridden_visible_to(self):
+        self.assertIsNone(RestrictedEpisodeCategory.visibility_filter(self.user))
+
+    def test_visibility_key(self):
+        self.assertFalse(episodes.InpatientEpisode.visibility_key(self.user))
+        self.assertTrue(
+            episodes.InpatientEpisode.visibility_key(self.restricted_user)
+        )
+
+    def test_visibility_key_overridden_visible_to(self):
+        self.assertEqual(
+            ('user', self.user.id),
+            RestrictedEpisodeCategory.visibility_key(self.user)
+        )
+
     def test_for_category(self):
         self.assertEqual(episodes.InpatientEpisode, episodes.EpisodeCategory.get('inpatient'))
@@ -1,6 +1,9 @@
 """
 Unittests for the opal.core.metadata module
 """
+from django.db.models.signals import post_save
+from mock import patch
+
 from opal import models
 from opal.core.test import OpalTestCase
 
@@ -25,3 +28,57 @@ class MicoTestDefaultsTestCase(OpalTestCase):
                 }
         as_dict = metadata.MicroTestDefaultsMetadata.to_dict()
         self.assertEqual(expected, as_dict['micro_test_defaults']['micro_test_serology'])
+
+
+class CachedToDictTestCase(OpalTestCase):
+
+    def test_global_is_cached(self):
+        metadata.MacrosMetadata.cached_to_dict(user=self.user)
+        with self.assertNumQueries(0):
+            metadata.MacrosMetadata.cached_to_dict(user=self.user)
+
+    def test_global_invalidated_by_model_changes(self):
+        metadata.MacrosMetadata.cached_to_dict(user=self.user)
+        macro = models.Macro.objects.create(title='hi', expanded='Hello')
+        expected = {'macros': [{'expanded': 'Hello', 'label': 'hi'}]}
+        self.assertEqual(
+            expected, metadata.MacrosMetadata.cached_to_dict(user=self.user)
+        )
+        macro.delete()
+        self.assertEqual(
+            {'macros': []},
+            metadata.MacrosMetadata.cached_to_dict(user=self.user)
+        )
+
+    def test_only_connected_to_invalidated_by(self):
+        self.assertIn(
+            metadata.invalidate_metadata,
+            post_save._live_receivers(models.Macro)
+        )
+        self.assertNotIn(
+            metadata.invalidate_metadata,
+            post_save._live_receivers(models.Episode)
+        )
+
+    def test_per_user(self):
+        other_user = self.make_user('password', username='other')
+        with patch.object(
+            metadata.MicroTestDefaultsMetadata, 'cache_scope',
+            metadata.Metadata.PER_USER
+        ):
+            with patch.object(
+                metadata.MicroTestDefaultsMetadata, 'to_dict'
+            ) as to_dict:
+                to_dict.return_value = {}
+                metadata.MicroTestDefaultsMetadata.cached_to_dict(self.user)
+                metadata.MicroTestDefaultsMetadata.cached_to_dict(self.user)
+                metadata.MicroTestDefaultsMetadata.cached_to_dict(other_user)
+                self.assertEqual(2, to_dict.call_count)
+
+    def test_uncached(self):
+        with patch.object(metadata.MacrosMetadata, 'cache_scope', None):
+            with patch.object(metadata.MacrosMetadata, 'to_dict') as to_dict:
+                to_dict.return_value = {}
+                metadata.MacrosMetadata.cached_to_dict(user=self.user)
+                metadata.MacrosMetadata.cached_to_dict(user=self.user)
+                self.assertEqual(2, to_dict.call_count)
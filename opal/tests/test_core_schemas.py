@@ -1,8 +1,10 @@
 """
 Tests for schema utilities
 """
+import json
+
 from django.test import TestCase
-from mock import patch
+from mock import patch, MagicMock
 
 from opal.core import schemas
 from opal.tests.models import Colour, HatWearer, FamousLastWords
@@ -99,3 +101,42 @@ class ExtractSchemaTestCase(TestCase):
         tagging.return_value = []
         self.assertEqual(tagging_serialized, schemas.extract_schema()[0])
         self.assertEqual(colour_serialized, schemas.extract_schema()[1])
+
+
+class PrecomputedSchemaTestCase(TestCase):
+    def test_get(self):
+        schema = schemas.PrecomputedSchema(lambda: [{'name': 'colour'}])
+        encoded = schema.get()
+        self.assertEqual([{'name': 'colour'}], json.loads(encoded.content))
+        self.assertEqual(32, len(encoded.etag))
+
+    def test_get_builds_once(self):
+        build = MagicMock(name='build', return_value=[])
+        schema = schemas.PrecomputedSchema(build)
+        self.assertIs(schema.get(), schema.get())
+        self.assertEqual(1, build.call_count)
+
+    def test_clear(self):
+        build = MagicMock(name='build', return_value=[])
+        schema = schemas.PrecomputedSchema(build)
+        schema.get()
+        schema.clear()
+        schema.get()
+        self.assertEqual(2, build.call_count)
+
+    def test_etag_changes_with_content(self):
+        one = schemas.PrecomputedSchema(lambda: [1]).get()
+        two = schemas.PrecomputedSchema(lambda: [2]).get()
+        self.assertNotEqual(one.etag, two.etag)
+
+    def test_records(self):
+        self.assertEqual(
+            schemas.list_records(),
+            json.loads(schemas.records.get().content)
+        )
+
+    def test_extract(self):
+        self.assertEqual(
+            schemas.extract_schema(),
+            json.loads(schemas.extract.get().content)
+        )
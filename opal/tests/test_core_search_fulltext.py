@@ -0,0 +1,207 @@
+"""
+Unittests for opal.core.search.fulltext
+"""
+from django.core.management.base import CommandError
+from django.test import override_settings
+from mock import patch
+
+from opal.core.test import OpalTestCase
+from opal.core.search import fulltext, queries
+from opal.management.commands import rebuild_search_index
+
+BACKEND = 'opal.core.search.fulltext.FullTextQuery'
+
+
+class FullTextTestCase(OpalTestCase):
+
+    def setUp(self):
+        # The last test's index was rolled back with its database
+        fulltext.forget_built()
+        self.index = fulltext.get_index()
+        self.patients = []
+        for first_name, surname, hospital_number in [
+            ('Anna', 'Lisa', '111'),
+            ('Anna', 'Smith', '222'),
+            ('Lisa', 'Jones', 'AB1'),
+        ]:
+            patient, episode = self.new_patient_and_episode_please()
+            demographics = patient.demographics_set.get()
+            demographics.first_name = first_name
+            demographics.surname = surname
+            demographics.hospital_number = hospital_number
+            demographics.save()
+            self.patients.append(patient)
+
+    def fuzzy_query(self, query):
+        return [
+            r['patient_id'] for r in
+            fulltext.FullTextQuery(self.user, query).fuzzy_query()
+        ]
+
+
+@override_settings(OPAL_SEARCH_BACKEND=BACKEND)
+class FullTextUnbuiltTestCase(FullTextTestCase):
+
+    def test_falls_back_until_built(self):
+        with patch.object(queries.DatabaseQuery, 'fuzzy_query') as fuzzy:
+            fulltext.FullTextQuery(self.user, 'anna').fuzzy_query()
+            self.assertTrue(fuzzy.called)
+        self.assertFalse(self.index.exists())
+
+    def test_only_looks_for_the_index_once(self):
+        fulltext.forget_built()
+        with patch.object(self.index.__class__, 'exists') as exists:
+            exists.return_value = False
+            self.assertFalse(self.index.is_built())
+            demographics = self.patients[2].demographics_set.get()
+            demographics.save()
+            self.fuzzy_query('anna')
+            self.assertEqual(1, exists.call_count)
+
+    def test_build(self):
+        self.index.build()
+        self.assertTrue(self.index.exists())
+        with patch.object(self.index.__class__, 'exists') as exists:
+            self.assertTrue(self.index.is_built())
+            self.assertFalse(exists.called)
+
+    def test_rebuild_search_index_command(self):
+        c = rebuild_search_index.Command()
+        with patch.object(c.stdout, 'write'):
+            c.handle()
+        self.assertTrue(self.index.exists())
+        self.assertEqual([self.patients[1].id], self.fuzzy_query('smith'))
+
+    def test_rebuild_search_index_command_unsupported(self):
+        with patch.object(fulltext, 'get_index') as get_index:
+            get_index.return_value = None
+            with self.assertRaises(CommandError):
+                rebuild_search_index.Command().handle()
+
+
+@override_settings(OPAL_SEARCH_BACKEND=BACKEND)
+class FullTextQueryTestCase(FullTextTestCase):
+
+    def setUp(self):
+        super(FullTextQueryTestCase, self).setUp()
+        self.index.build()
+
+    def test_create_query(self):
+        query = queries.create_query(self.user, 'anna')
+        self.assertIsInstance(query, fulltext.FullTextQuery)
+
+    def test_matches_all_tokens(self):
+        self.assertEqual([self.patients[0].id], self.fuzzy_query('anna lisa'))
+
+    def test_matches_substrings(self):
+        self.assertEqual([self.patients[1].id], self.fuzzy_query('mit'))
+
+    def test_matches_case_insensitively(self):
+        self.assertEqual([self.patients[2].id], self.fuzzy_query('jONES'))
+
+    def test_short_tokens(self):
+        self.assertEqual([self.patients[2].id], self.fuzzy_query('ab'))
+
+    def test_short_tokens_are_escaped(self):
+        self.assertEqual([], self.fuzzy_query('_'))
+
+    def test_hospital_number(self):
+        self.assertEqual([self.patients[1].id], self.fuzzy_query('222'))
+
+    def test_no_match(self):
+        self.assertEqual([], self.fuzzy_query('zzz'))
+
+    def test_ranked_best_match_first(self):
+        patients = self.fuzzy_query('lisa')
+        self.assertEqual(
+            set([self.patients[0].id, self.patients[2].id]), set(patients)
+        )
+        self.assertEqual(
+            patients, [r['patient_id'] for r in
+                       queries.create_query(self.user, 'lisa').fuzzy_query()]
+        )
+
+    def test_returns_patient_summaries(self):
+        result = fulltext.FullTextQuery(self.user, 'smith').fuzzy_query()
+        self.assertEqual(1, len(result))
+        self.assertEqual('Smith', result[0]['surname'])
+        self.assertEqual(1, result[0]['count'])
+        self.assertEqual(['Inpatient'], result[0]['categories'])
+
+    def test_index_updated_on_save(self):
+        demographics = self.patients[2].demographics_set.get()
+        demographics.surname = 'Watson'
+        demographics.save()
+        self.assertEqual([], self.fuzzy_query('jones'))
+        self.assertEqual([self.patients[2].id], self.fuzzy_query('watson'))
+
+    def test_index_updated_on_new_patient(self):
+        patient, _ = self.new_patient_and_episode_please()
+        demographics = patient.demographics_set.get()
+        demographics.surname = 'Holmes'
+        demographics.save()
+        self.assertEqual([patient.id], self.fuzzy_query('holmes'))
+
+    def test_index_updated_on_delete(self):
+        self.patients[1].delete()
+        self.assertEqual([self.patients[0].id], self.fuzzy_query('anna'))
+
+    def test_index_updated_on_bulk_write(self):
+        demographics = self.patients[2].demographics_set.get()
+        demographics.bulk_write_from_dicts([{
+            'id': demographics.id,
+            'surname': 'Watson',
+            'consistency_token': demographics.consistency_token,
+        }], self.user)
+        self.assertEqual([self.patients[2].id], self.fuzzy_query('watson'))
+
+    def test_does_not_use_icontains(self):
+        self.fuzzy_query('anna')
+        with patch.object(fulltext.models.Patient.objects, 'search') as search:
+            self.fuzzy_query('anna')
+            self.assertFalse(search.called)
+
+    def test_empty_query_falls_back(self):
+        with patch.object(queries.DatabaseQuery, 'fuzzy_query') as fuzzy:
+            fulltext.FullTextQuery(self.user, '  ').fuzzy_query()
+            self.assertTrue(fuzzy.called)
+
+    def test_unsupported_database_falls_back(self):
+        with patch.object(fulltext, 'get_index') as get_index:
+            get_index.return_value = None
+            self.assertEqual(
+                [self.patients[0].id, self.patients[1].id],
+                self.fuzzy_query('anna')
+            )
+
+
+class FullTextDisabledTestCase(FullTextTestCase):
+
+    def test_not_indexed_when_disabled(self):
+        self.index.build()
+        demographics = self.patients[2].demographics_set.get()
+        demographics.surname = 'Watson'
+        demographics.save()
+        self.assertEqual([self.patients[2].id], self.fuzzy_query('jones'))
+
+    def test_sqlite_without_fts5(self):
+        with patch.dict(fulltext._FTS5, clear=True):
+            with patch.object(fulltext.SqliteSearchIndex, '_probe') as probe:
+                probe.return_value = False
+                self.assertIsNone(fulltext.get_index())
+                self.assertIsNone(fulltext.get_index())
+                self.assertEqual(1, probe.call_count)
+
+    def test_sqlite_probe(self):
+        with patch.object(fulltext.sqlite3, 'sqlite_version_info', (3, 33, 0)):
+            self.assertFalse(fulltext.SqliteSearchIndex._probe())
+        self.assertTrue(fulltext.SqliteSearchIndex._probe())
+
+    def test_connected_per_sender(self):
+        from django.db.models.signals import post_save
+        receivers = post_save._live_receivers(fulltext.models.Episode)
+        self.assertNotIn(fulltext.index_demographics, receivers)
+
+    def test_get_index_unknown_vendor(self):
+        with patch.object(fulltext.connection, 'vendor', 'mysql'):
+            self.assertIsNone(fulltext.get_index())
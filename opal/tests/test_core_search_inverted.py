@@ -0,0 +1,209 @@
+"""
+Unittests for opal.core.search.inverted
+"""
+from datetime import date
+
+from django.core.cache import cache
+from django.test import override_settings
+from mock import patch
+
+from opal.core.test import OpalTestCase
+from opal.core.search import inverted, queries
+
+BACKEND = 'opal.core.search.inverted.InvertedIndexQuery'
+
+
+@override_settings(OPAL_SEARCH_BACKEND=BACKEND)
+@patch.object(inverted, 'SETTLE_SECONDS', 0)
+class InvertedIndexTestCase(OpalTestCase):
+
+    def setUp(self):
+        inverted.index.clear()
+        self.patients = []
+        for first_name, surname, hospital_number, dob in [
+            ('Anna', 'Lisa', '111', date(1972, 1, 27)),
+            ('Anna', 'Smith', '222', None),
+            ('Lisa', 'Jones', 'AB1', None),
+        ]:
+            patient, episode = self.new_patient_and_episode_please()
+            demographics = patient.demographics_set.get()
+            demographics.first_name = first_name
+            demographics.surname = surname
+            demographics.hospital_number = hospital_number
+            demographics.date_of_birth = dob
+            demographics.save()
+            self.patients.append(patient)
+
+    def tearDown(self):
+        inverted.index.clear()
+
+    def search(self, query):
+        return inverted.index.search(query.lower().split())
+
+    def test_builds_lazily(self):
+        self.assertFalse(inverted.index.built)
+        self.search('anna')
+        self.assertTrue(inverted.index.built)
+
+    def test_matches_all_tokens(self):
+        self.assertEqual(set([self.patients[0].id]), self.search('anna lisa'))
+
+    def test_matches_substrings(self):
+        self.assertEqual(set([self.patients[1].id]), self.search('mit'))
+
+    def test_matches_case_insensitively(self):
+        self.assertEqual(set([self.patients[2].id]), self.search('JoNeS'))
+
+    def test_short_tokens(self):
+        self.assertEqual(set([self.patients[2].id]), self.search('ab'))
+
+    def test_date_of_birth(self):
+        self.assertEqual(set([self.patients[0].id]), self.search('27/01/1972'))
+        self.assertEqual(set([self.patients[0].id]), self.search('1972-01-27'))
+
+    def test_no_match(self):
+        self.assertEqual(set(), self.search('zzz'))
+        self.assertEqual(set(), self.search(''))
+
+    def test_search_does_not_query_once_built(self):
+        self.search('anna')
+        with self.assertNumQueries(0):
+            self.search('anna')
+
+    def test_hospital_number(self):
+        self.assertEqual(
+            [self.patients[2].id], inverted.index.hospital_number('ab1')
+        )
+        self.assertEqual([], inverted.index.hospital_number('AB'))
+
+    def test_updated_on_save(self):
+        self.search('anna')
+        demographics = self.patients[2].demographics_set.get()
+        demographics.surname = 'Watson'
+        demographics.hospital_number = '333'
+        demographics.save()
+        with self.assertNumQueries(1):
+            self.search('anna')
+        with self.assertNumQueries(0):
+            self.assertEqual(set(), self.search('jones'))
+            self.assertEqual(set([self.patients[2].id]), self.search('watson'))
+            self.assertEqual([], inverted.index.hospital_number('AB1'))
+            self.assertEqual(
+                [self.patients[2].id], inverted.index.hospital_number('333')
+            )
+
+    def test_updated_on_delete(self):
+        self.search('anna')
+        self.patients[1].delete()
+        self.assertEqual(set([self.patients[0].id]), self.search('anna'))
+        self.assertEqual([], inverted.index.hospital_number('222'))
+
+    def test_updated_on_bulk_write(self):
+        self.search('anna')
+        demographics = self.patients[2].demographics_set.get()
+        demographics.bulk_write_from_dicts([{
+            'id': demographics.id,
+            'surname': 'Watson',
+            'consistency_token': demographics.consistency_token,
+        }], self.user)
+        self.assertEqual(set([self.patients[2].id]), self.search('watson'))
+
+    def test_reads_changes_logged_by_other_processes(self):
+        self.search('anna')
+        demographics = self.patients[2].demographics_set.get()
+        self.patients[2].demographics_set.update(surname='Watson')
+        self.assertEqual(set(), self.search('watson'))
+        inverted.log_changes([demographics.id])
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                set([self.patients[2].id]), self.search('watson')
+            )
+
+    def test_reads_pending_rows_until_they_settle(self):
+        self.search('anna')
+        demographics = self.patients[2].demographics_set.get()
+        with patch.object(inverted, 'SETTLE_SECONDS', 30):
+            inverted.log_changes([demographics.id])
+            self.search('anna')
+            # As though the transaction committed after we first read it
+            self.patients[2].demographics_set.update(surname='Watson')
+            self.assertEqual(
+                set([self.patients[2].id]), self.search('watson')
+            )
+        self.search('anna')
+        with self.assertNumQueries(0):
+            self.search('anna')
+
+    def test_rebuilds_when_the_log_has_expired(self):
+        self.search('anna')
+        demographics = self.patients[2].demographics_set.get()
+        self.patients[2].demographics_set.update(surname='Watson')
+        inverted.log_changes([demographics.id])
+        cache.delete(inverted._log_key(inverted._log_head()))
+        self.assertEqual(set([self.patients[2].id]), self.search('watson'))
+
+    @override_settings(OPAL_SEARCH_BACKEND='opal.core.search.queries.DatabaseQuery')
+    def test_not_maintained_when_disabled(self):
+        self.search('anna')
+        head = inverted._log_head()
+        demographics = self.patients[2].demographics_set.get()
+        demographics.surname = 'Watson'
+        demographics.save()
+        self.assertEqual(head, inverted._log_head())
+        self.assertEqual(set([self.patients[2].id]), self.search('jones'))
+
+
+@override_settings(OPAL_SEARCH_BACKEND=BACKEND)
+class InvertedIndexQueryTestCase(OpalTestCase):
+
+    def setUp(self):
+        inverted.index.clear()
+        self.patient, self.episode = self.new_patient_and_episode_please()
+        self.patient.create_episode()
+        demographics = self.patient.demographics_set.get()
+        demographics.first_name = 'Sherlock'
+        demographics.surname = 'Holmes'
+        demographics.hospital_number = 'X123'
+        demographics.save()
+        self.other, _ = self.new_patient_and_episode_please()
+
+    def tearDown(self):
+        inverted.index.clear()
+
+    def test_create_query(self):
+        query = queries.create_query(self.user, 'holmes')
+        self.assertIsInstance(query, inverted.InvertedIndexQuery)
+
+    def test_fuzzy_query(self):
+        result = inverted.InvertedIndexQuery(self.user, 'sher olm').fuzzy_query()
+        self.assertEqual(1, len(result))
+        self.assertEqual(self.patient.id, result[0]['patient_id'])
+        self.assertEqual(2, result[0]['count'])
+
+    def test_fuzzy_query_with_too_many_patients(self):
+        with patch.object(inverted, 'MAX_PATIENT_IDS', 0):
+            with patch.object(queries.DatabaseQuery, 'fuzzy_query') as fuzzy:
+                query = inverted.InvertedIndexQuery(self.user, 'holmes')
+                self.assertEqual(fuzzy.return_value, query.fuzzy_query())
+
+    def test_hospital_number_criteria(self):
+        criteria = [{
+            "queryType": "Equals",
+            "query": "x123",
+            "field": "Hospital Number",
+            'combine': 'and',
+            'column': u'demographics',
+        }]
+        query = inverted.InvertedIndexQuery(self.user, criteria)
+        self.assertEqual([self.patient], query.get_patients())
+
+    def test_other_criteria(self):
+        criteria = [{
+            "queryType": "Contains",
+            "query": "olm",
+            "field": "Surname",
+            'combine': 'and',
+            'column': u'demographics',
+        }]
+        query = inverted.InvertedIndexQuery(self.user, criteria)
+        self.assertEqual([self.patient], query.get_patients())
@@ -0,0 +1,109 @@
+"""
+Unittests for opal.core.search.profiling
+"""
+from django.db import connection
+from mock import patch
+
+from opal.core.test import OpalTestCase
+from opal.models import Episode
+from opal.tests import models as testmodels
+
+from opal.core.search import profiling, queries
+
+
+class ProfileTestCase(OpalTestCase):
+
+    def setUp(self):
+        self.patient, self.episode = self.new_patient_and_episode_please()
+        self.other, self.other_episode = self.new_patient_and_episode_please()
+        testmodels.HatWearer.objects.create(episode=self.episode, name='Jane')
+        testmodels.HatWearer.objects.create(episode=self.other_episode, name='Jane')
+        self.criteria = [
+            dict(column='hat_wearer', field='Name', combine='and',
+                 query='Jane', queryType='Equals'),
+            dict(column='hat_wearer', field='Name', combine='or',
+                 query='John', queryType='Equals'),
+        ]
+        self.query = queries.DatabaseQuery(self.user, self.criteria)
+
+    def test_criteria(self):
+        report = profiling.profile(self.query)
+        self.assertEqual(2, len(report['criteria']))
+        jane, john = report['criteria']
+        self.assertEqual(self.criteria[0], jane['criteria'])
+        self.assertEqual(2, jane['rows'])
+        self.assertEqual(0, john['rows'])
+        self.assertEqual(1, jane['queries'])
+        self.assertIn('tests_hatwearer', jane['sql'])
+        self.assertGreaterEqual(jane['seconds'], 0)
+
+    def test_only_fetches_ids(self):
+        with patch.object(Episode, '__init__') as init:
+            report = profiling.profile(self.query)
+            self.assertFalse(init.called)
+        self.assertEqual(2, report['combine']['rows'])
+
+    def test_combine(self):
+        report = profiling.profile(self.query)
+        self.assertEqual(2, report['combine']['rows'])
+        self.assertEqual(1, report['combine']['queries'])
+
+    def test_visibility(self):
+        self.user.profile.restricted_only = True
+        self.user.profile.save()
+        report = profiling.profile(self.query)
+        self.assertEqual(0, report['visibility']['rows'])
+
+    def test_explain(self):
+        report = profiling.profile(self.query)
+        self.assertTrue(len(report['explain']) > 0)
+
+    def test_explain_unknown_database(self):
+        with patch.object(connection, 'vendor', 'oracle'):
+            self.assertIsNone(profiling.explain(Episode.objects.all()))
+
+
+class LogSlowSearchTestCase(OpalTestCase):
+
+    def test_log_slow_search(self):
+        criteria = [dict(
+            column='hat_wearer', field='Name', combine='and',
+            query='Jane', queryType='Equals'
+        )]
+        query = queries.DatabaseQuery(self.user, criteria)
+        with patch.object(profiling.logger, 'warning') as warning:
+            profiling.log_slow_search(query, 7.5)
+            self.assertEqual(1, warning.call_count)
+            args = warning.call_args[0]
+            self.assertEqual(self.user.username, args[1])
+            self.assertEqual(7.5, args[2])
+            self.assertEqual(criteria, args[3])
+
+    def test_logs_the_plan_without_searching_again(self):
+        criteria = [dict(
+            column='hat_wearer', field='Name', combine='and',
+            query='Jane', queryType='Equals'
+        )]
+        query = queries.DatabaseQuery(self.user, criteria)
+        query.get_patient_summaries()
+        with patch.object(profiling.logger, 'warning') as warning:
+            # Just the EXPLAIN
+            with self.assertNumQueries(1):
+                profiling.log_slow_search(query, 7.5)
+            self.assertTrue(warning.call_args[0][4])
+
+    def test_no_plan_for_cached_results(self):
+        query = queries.DatabaseQuery(self.user, [])
+        with patch.object(profiling.logger, 'warning') as warning:
+            with self.assertNumQueries(0):
+                profiling.log_slow_search(query, 7.5)
+            self.assertEqual(u'', warning.call_args[0][4])
+
+
+class QueryCounterTestCase(OpalTestCase):
+
+    def test_counts_queries(self):
+        with profiling.QueryCounter(connection) as counted:
+            list(Episode.objects.all())
+            list(Episode.objects.all())
+        self.assertEqual(2, len(counted))
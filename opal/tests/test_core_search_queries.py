@@ -3,10 +3,17 @@ unittests for opal.core.search.queries
 """
 from datetime import date
 
-from django.db import transaction
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.db.models import QuerySet
+from django.test import override_settings
+from mock import patch
 import reversion
 
+from opal import models
 from opal.models import Episode, Patient, Team
+from opal.core import lookuplists
 from opal.core.test import OpalTestCase
 from opal.tests.episodes import RestrictedEpisodeCategory
 
@@ -14,26 +21,6 @@ from opal.core.search import queries
 
 from opal.tests import models as testmodels
 
-class PatientSummaryTestCase(OpalTestCase):
-
-    def test_update_sets_start(self):
-        patient, episode = self.new_patient_and_episode_please()
-        summary = queries.PatientSummary(episode)
-        self.assertEqual(None, summary.start)
-        the_date = date(day=27, month=1, year=1972)
-        episode2 = patient.create_episode(date_of_admission=the_date)
-        summary.update(episode2)
-        self.assertEqual(summary.start, the_date)
-
-    def test_update_sets_end(self):
-        patient, episode = self.new_patient_and_episode_please()
-        summary = queries.PatientSummary(episode)
-        self.assertEqual(None, summary.start)
-        the_date = date(day=27, month=1, year=1972)
-        episode2 = patient.create_episode(discharge_date=the_date)
-        summary.update(episode2)
-        self.assertEqual(summary.end, the_date)
-
 class QueryBackendTestCase(OpalTestCase):
 
     def test_fuzzy_query(self):
@@ -92,7 +79,7 @@ class DatabaseQueryTestCase(OpalTestCase):
             combine='and', query='false', queryType='Equals'
         )
         query = queries.DatabaseQuery(self.user, [criteria])
-        self.assertEqual([self.episode], query.get_episodes())
+        self.assertEqual([self.episode], list(query.get_episodes()))
 
     def test_episodes_for_boolean_fields_episode_subrecord(self):
         criteria = dict(
@@ -102,7 +89,7 @@ class DatabaseQueryTestCase(OpalTestCase):
         hatwearer = testmodels.HatWearer(episode=self.episode, wearing_a_hat=True)
         hatwearer.save()
         query = queries.DatabaseQuery(self.user, [criteria])
-        self.assertEqual([self.episode], query.get_episodes())
+        self.assertEqual([self.episode], list(query.get_episodes()))
 
     def test_episodes_for_date_fields(self):
         criteria = dict(
@@ -113,7 +100,7 @@ class DatabaseQueryTestCase(OpalTestCase):
             episode=self.episode, ownership_start_date=date(1999, 12, 1))
         dogowner.save()
         query = queries.DatabaseQuery(self.user, [criteria])
-        self.assertEqual([self.episode], query.get_episodes())
+        self.assertEqual([self.episode], list(query.get_episodes()))
 
     def test_episodes_for_date_fields_patient_subrecord(self):
         criteria = dict(
@@ -124,7 +111,7 @@ class DatabaseQueryTestCase(OpalTestCase):
             patient=self.patient, birth_date=date(1999, 12, 1))
         birthday.save()
         query = queries.DatabaseQuery(self.user, [criteria])
-        self.assertEqual([self.episode], query.get_episodes())
+        self.assertEqual([self.episode], list(query.get_episodes()))
 
     def test_episodes_for_date_fields_before(self):
         criteria = dict(
@@ -135,7 +122,7 @@ class DatabaseQueryTestCase(OpalTestCase):
             episode=self.episode, ownership_start_date=date(1999, 12, 1))
         dogowner.save()
         query = queries.DatabaseQuery(self.user, [criteria])
-        self.assertEqual([self.episode], query.get_episodes())
+        self.assertEqual([self.episode], list(query.get_episodes()))
 
     def test_episodes_for_date_fields_after(self):
         criteria = dict(
@@ -146,7 +133,7 @@ class DatabaseQueryTestCase(OpalTestCase):
             episode=self.episode, ownership_start_date=date(1999, 12, 1))
         dogowner.save()
         query = queries.DatabaseQuery(self.user, [criteria])
-        self.assertEqual([self.episode], query.get_episodes())
+        self.assertEqual([self.episode], list(query.get_episodes()))
 
     def test_episodes_for_m2m_fields(self):
         criteria = dict(
@@ -163,7 +150,7 @@ class DatabaseQueryTestCase(OpalTestCase):
         hatwearer.save()
 
         query = queries.DatabaseQuery(self.user, [criteria])
-        self.assertEqual([self.episode], query.get_episodes())
+        self.assertEqual([self.episode], list(query.get_episodes()))
 
     def test_episodes_for_m2m_fields_patient_subrecord(self):
         criteria = dict(
@@ -180,7 +167,7 @@ class DatabaseQueryTestCase(OpalTestCase):
         favouritedogs.dogs.add(dalmation)
         favouritedogs.save()
         query = queries.DatabaseQuery(self.user, [criteria])
-        self.assertEqual([self.episode], query.get_episodes())
+        self.assertEqual([self.episode], list(query.get_episodes()))
 
 
     def test_filter_restricted_only_user(self):
@@ -188,7 +175,7 @@ class DatabaseQueryTestCase(OpalTestCase):
         self.user.profile.save()
         self.patient.create_episode(category='Inpatient')
         query = queries.DatabaseQuery(self.user, self.name_criteria)
-        self.assertEqual([], query.get_episodes())
+        self.assertEqual([], list(query.get_episodes()))
 
     def test_filter_in_restricted_episode_types(self):
         self.user.profile.restricted_only   = True
@@ -197,7 +184,7 @@ class DatabaseQueryTestCase(OpalTestCase):
         self.assertEqual('Restricted', episode2.category_name)
 
         query = queries.DatabaseQuery(self.user, self.name_criteria)
-        self.assertEqual([episode2], query.get_episodes())
+        self.assertEqual([episode2], list(query.get_episodes()))
 
     def test_get_old_episode(self):
         # episode's with old tags that have subsequently been removed
@@ -218,16 +205,16 @@ class DatabaseQueryTestCase(OpalTestCase):
             other_episode.set_tag_names(['other_team'], self.user)
             query = queries.DatabaseQuery(self.user, team_query)
 
-        self.assertEqual([other_episode], query.get_episodes())
+        self.assertEqual([other_episode], list(query.get_episodes()))
 
         with transaction.atomic(), reversion.create_revision():
             other_episode.set_tag_names([], self.user)
 
-        self.assertEqual([other_episode], query.get_episodes())
+        self.assertEqual([other_episode], list(query.get_episodes()))
 
     def test_get_episodes(self):
         query = queries.DatabaseQuery(self.user, self.name_criteria)
-        self.assertEqual([self.episode], query.get_episodes())
+        self.assertEqual([self.episode], list(query.get_episodes()))
 
     def test_get_episodes_searching_ft_or_fk_field(self):
         criteria = [
@@ -240,11 +227,11 @@ class DatabaseQueryTestCase(OpalTestCase):
             }
         ]
         query = queries.DatabaseQuery(self.user, criteria)
-        self.assertEqual([self.episode], query.get_episodes())
+        self.assertEqual([self.episode], list(query.get_episodes()))
 
     def test_get_patient_summaries(self):
         query = queries.DatabaseQuery(self.user, self.name_criteria)
-        summaries = query.get_patient_summaries()
+        summaries = list(query.get_patient_summaries())
         expected = [{
             'id': self.patient.id,
             'count': 1,
@@ -272,7 +259,7 @@ class DatabaseQueryTestCase(OpalTestCase):
             date_of_episode=end_date
         )
         query = queries.DatabaseQuery(self.user, self.name_criteria)
-        summaries = query.get_patient_summaries()
+        summaries = list(query.get_patient_summaries())
         expected = [{
             'id': self.patient.id,
             'count': 3,
@@ -286,3 +273,446 @@ class DatabaseQueryTestCase(OpalTestCase):
             'categories': [u'Inpatient']
         }]
         self.assertEqual(expected, summaries)
+
+
+class SearchResultCacheTestCase(OpalTestCase):
+
+    def setUp(self):
+        self.patient, self.episode = self.new_patient_and_episode_please()
+        self.other, self.other_episode = self.new_patient_and_episode_please()
+        testmodels.HatWearer.objects.create(episode=self.episode, name='Jane')
+        self.criteria = [dict(
+            column='hat_wearer', field='Name', combine='and',
+            query='Jane', queryType='Equals'
+        )]
+
+    def summaries(self, criteria=None):
+        query = queries.DatabaseQuery(self.user, criteria or self.criteria)
+        return query.get_patient_summaries()
+
+    def patient_ids(self, criteria=None):
+        return [s['patient_id'] for s in self.summaries(criteria)]
+
+    def test_cached(self):
+        self.assertEqual([self.patient.id], self.patient_ids())
+        summaries = self.summaries()
+        with self.assertNumQueries(0):
+            self.assertEqual(1, len(summaries))
+
+    def test_page_is_hydrated_from_cache(self):
+        self.summaries()
+        summaries = self.summaries()
+        # Summaries for the page, then their categories
+        with self.assertNumQueries(2):
+            self.assertEqual(self.patient.id, summaries[0:10][0]['patient_id'])
+
+    def test_normalised_criteria_share_an_entry(self):
+        self.summaries()
+        criteria = [dict(self.criteria[0], field='name', combine='or')]
+        with patch.object(queries.DatabaseQuery, '_get_patient_episodes') as get:
+            self.summaries(criteria)
+            self.assertFalse(get.called)
+
+    def test_invalidated_by_criteria_model(self):
+        self.summaries()
+        testmodels.HatWearer.objects.create(episode=self.other_episode, name='Jane')
+        self.assertEqual([self.patient.id, self.other.id], self.patient_ids())
+
+    def test_invalidated_by_bulk_write(self):
+        self.summaries()
+        testmodels.HatWearer.bulk_write_from_dicts(
+            [dict(episode_id=self.other_episode.id, name='Jane')], self.user
+        )
+        self.assertEqual([self.patient.id, self.other.id], self.patient_ids())
+
+    def test_not_invalidated_by_episode(self):
+        self.summaries()
+        with patch.object(queries.DatabaseQuery, '_get_patient_episodes') as get:
+            self.episode.save()
+            self.summaries()
+            self.assertFalse(get.called)
+
+    def test_invalidated_by_tags(self):
+        criteria = [dict(
+            column='tagging', field='Eater', combine='and',
+            query='true', queryType='Equals'
+        )]
+        self.assertEqual([], self.patient_ids(criteria))
+        self.episode.set_tag_names(['eater'], self.user)
+        self.assertEqual([self.patient.id], self.patient_ids(criteria))
+
+    def test_not_invalidated_by_other_models(self):
+        self.summaries()
+        with patch.object(queries.DatabaseQuery, '_get_patient_episodes') as get:
+            testmodels.DogOwner.objects.create(episode=self.episode)
+            self.summaries()
+            self.assertFalse(get.called)
+
+    def test_keyed_by_visibility(self):
+        self.summaries()
+        self.user.profile.restricted_only = True
+        self.user.profile.save()
+        self.assertEqual([], self.patient_ids())
+
+    @override_settings(OPAL_SEARCH_CACHE_SIZE=0)
+    def test_disabled(self):
+        self.summaries()
+        with patch.object(queries.DatabaseQuery, '_get_patient_episodes') as get:
+            get.return_value = []
+            self.summaries()
+            self.assertTrue(get.called)
+
+    def test_referenced_models(self):
+        criteria = [
+            dict(column='demographics', field='Sex', combine='and',
+                 query='Female', queryType='Equals'),
+            dict(column='tagging', field='Eater', combine='or',
+                 query='true', queryType='Equals'),
+            dict(column='hound_owner', field='Dog', combine='and',
+                 query='Spot', queryType='Equals'),
+        ]
+        query = queries.DatabaseQuery(self.user, criteria)
+        self.assertEqual(set([
+            testmodels.Demographics, models.Gender,
+            models.Synonym, models.Tagging, testmodels.HoundOwner,
+            testmodels.Dog
+        ]), set(query._get_referenced_models()))
+
+
+class PatientSummaryPagesTestCase(OpalTestCase):
+
+    def setUp(self):
+        self.patient, self.episode = self.new_patient_and_episode_please()
+        self.other, self.other_episode = self.new_patient_and_episode_please()
+        self.pages = queries.PatientSummaryPages([
+            (self.patient.id, [self.episode.id]),
+            (self.other.id, [self.other_episode.id]),
+        ])
+
+    def test_count(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(2, len(self.pages))
+            self.assertEqual(2, self.pages.count())
+
+    def test_slice(self):
+        self.assertEqual(
+            [self.other.id], [s['patient_id'] for s in self.pages[1:]]
+        )
+
+    def test_index(self):
+        self.assertEqual(self.patient.id, self.pages[0]['patient_id'])
+        self.assertEqual(self.other.id, self.pages[-1]['patient_id'])
+
+    def test_iter(self):
+        self.assertEqual(
+            [self.patient.id, self.other.id],
+            [s['patient_id'] for s in self.pages]
+        )
+
+
+class EpisodesForUserTestCase(OpalTestCase):
+
+    def setUp(self):
+        self.patient, self.episode = self.new_patient_and_episode_please()
+        self.restricted = self.patient.create_episode(
+            category_name=RestrictedEpisodeCategory.display_name
+        )
+
+    def test_queryset(self):
+        episodes = queries.episodes_for_user(Episode.objects.all(), self.user)
+        self.assertIsInstance(episodes, QuerySet)
+        self.assertEqual([self.episode], list(episodes))
+
+    def test_list(self):
+        self.assertEqual(
+            [self.episode],
+            queries.episodes_for_user(list(Episode.objects.all()), self.user)
+        )
+
+    def test_restricted_only_user(self):
+        self.user.profile.restricted_only = True
+        self.user.profile.save()
+        episodes = queries.episodes_for_user(Episode.objects.all(), self.user)
+        self.assertEqual([self.restricted], list(episodes))
+
+    def test_query_count_is_constant(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as captured:
+                list(queries.episodes_for_user(Episode.objects.all(), self.user))
+            return len(captured)
+
+        # warm up the user profile
+        count_queries()
+        expected = count_queries()
+        for i in range(5):
+            self.patient.create_episode()
+        self.assertEqual(expected, count_queries())
+
+    def test_falls_back_to_episode_visible_to(self):
+        with patch.object(Episode, 'visible_to') as visible:
+            visible.return_value = True
+            episodes = queries.episodes_for_user(Episode.objects.all(), self.user)
+            self.assertEqual(
+                set([self.episode, self.restricted]), set(episodes)
+            )
+            # Only for the category that can't filter in the database
+            self.assertEqual(1, visible.call_count)
+
+
+class VisibilityKeyTestCase(OpalTestCase):
+
+    def test_visibility_key(self):
+        key = dict(queries.visibility_key(self.user))
+        self.assertEqual(False, key['inpatient'])
+        self.assertEqual(('user', self.user.id), key['restricted'])
+
+
+class CombineCriteriaTestCase(OpalTestCase):
+
+    def setUp(self):
+        self.patient, self.episode = self.new_patient_and_episode_please()
+        self.other_patient, self.other_episode = self.new_patient_and_episode_please()
+        testmodels.HatWearer.objects.create(episode=self.episode, name='Jane')
+        testmodels.HatWearer.objects.create(
+            episode=self.other_episode, name='John', wearing_a_hat=False
+        )
+        self.jane = dict(
+            column='hat_wearer', field='Name',
+            combine='and', query='Jane', queryType='Equals'
+        )
+        self.wearing = dict(
+            column='hat_wearer', field='Wearing A Hat',
+            combine='and', query='false', queryType='Equals'
+        )
+
+    def get_episodes(self, *criteria):
+        query = queries.DatabaseQuery(self.user, list(criteria))
+        return set(list(query.get_episodes()))
+
+    def test_and(self):
+        self.assertEqual(set(), self.get_episodes(self.jane, self.wearing))
+
+    def test_or(self):
+        self.wearing['combine'] = 'or'
+        self.assertEqual(
+            set([self.episode, self.other_episode]),
+            self.get_episodes(self.jane, self.wearing)
+        )
+
+    def test_not(self):
+        self.wearing['combine'] = 'not'
+        self.assertEqual(
+            set([self.other_episode]), self.get_episodes(self.jane, self.wearing)
+        )
+
+    def test_no_criteria(self):
+        self.assertEqual(set(), self.get_episodes())
+
+    def test_episodes_without_restrictions_is_lazy(self):
+        self.wearing['combine'] = 'or'
+        query = queries.DatabaseQuery(self.user, [self.jane, self.wearing])
+        with self.assertNumQueries(0):
+            episodes = query._episodes_without_restrictions()
+        with self.assertNumQueries(1):
+            self.assertEqual(2, len(episodes))
+
+
+class ForeignKeyOrFreeTextCriteriaTestCase(OpalTestCase):
+
+    def setUp(self):
+        self.patient, self.episode = self.new_patient_and_episode_please()
+        self.other, self.other_episode = self.new_patient_and_episode_please()
+        self.spot = testmodels.Dog.objects.create(name='Spot')
+        content_type = ContentType.objects.get_for_model(testmodels.Dog)
+        models.Synonym.objects.create(
+            content_type=content_type, object_id=self.spot.id, name='Spotty'
+        )
+        testmodels.DogOwner.objects.create(
+            episode=self.episode, dog='Spot', least_favourite_dog='Rex'
+        )
+        testmodels.DogOwner.objects.create(
+            episode=self.other_episode, dog='Fido'
+        )
+        lookuplists.cache.clear()
+
+    def criteria(self, field, query, combine='and'):
+        return dict(
+            column='dog_owner', field=field, combine=combine,
+            query=query, queryType='Equals'
+        )
+
+    def test_foreign_key(self):
+        query = queries.DatabaseQuery(self.user, [self.criteria('Dog', 'Spot')])
+        self.assertEqual([self.episode], list(query.get_episodes()))
+
+    def test_synonym(self):
+        query = queries.DatabaseQuery(
+            self.user, [self.criteria('Dog', 'Spotty')]
+        )
+        self.assertEqual([self.episode], list(query.get_episodes()))
+
+    def test_free_text(self):
+        query = queries.DatabaseQuery(self.user, [self.criteria('Dog', 'Fido')])
+        self.assertEqual([self.other_episode], list(query.get_episodes()))
+
+    def test_is_lazy(self):
+        criteria = self.criteria('Dog', 'Spot')
+        query = queries.DatabaseQuery(self.user, [criteria])
+        lookuplists.cache.resolve(testmodels.Dog, 'Spot')
+        with self.assertNumQueries(0):
+            episodes = query._episodes_for_fkorft_fields(
+                criteria, 'dog', '__iexact', testmodels.DogOwner
+            )
+        self.assertIsInstance(episodes, QuerySet)
+
+    def test_synonyms_resolved_together(self):
+        query = queries.DatabaseQuery(self.user, [
+            self.criteria('Dog', 'Spotty'),
+            self.criteria('Least Favourite Dog', 'Rex'),
+            self.criteria('Dog', 'Fido', combine='or'),
+        ])
+        # One for synonyms, one for dogs, then one for the episodes
+        with self.assertNumQueries(3):
+            episodes = list(query._episodes_without_restrictions())
+        self.assertEqual(
+            set([self.episode, self.other_episode]), set(episodes)
+        )
+
+
+class PatientSubrecordCriteriaTestCase(OpalTestCase):
+
+    def setUp(self):
+        self.episodes = []
+        for i in range(3):
+            patient, episode = self.new_patient_and_episode_please()
+            patient.create_episode()
+            demographics = patient.demographics_set.get()
+            demographics.surname = 'Stevens'
+            demographics.sex = 'Female'
+            demographics.save()
+            testmodels.Birthday.objects.create(
+                patient=patient, birth_date=date(1999, 12, 1)
+            )
+            favourite_dogs = testmodels.FavouriteDogs.objects.create(patient=patient)
+            favourite_dogs.dogs.add(testmodels.Dog.objects.get_or_create(name='Dalmation')[0])
+            self.episodes += list(patient.episode_set.all())
+        self.new_patient_and_episode_please()
+
+    def assertOneQuery(self, criteria):
+        query = queries.DatabaseQuery(self.user, [criteria])
+        with self.assertNumQueries(1):
+            episodes = set(query._episodes_without_restrictions())
+        self.assertEqual(set(self.episodes), episodes)
+
+    def test_string_field(self):
+        self.assertOneQuery(dict(
+            column='demographics', field='Surname',
+            combine='and', query='Stevens', queryType='Equals'
+        ))
+
+    def test_boolean_field(self):
+        testmodels.Demographics.objects.exclude(
+            surname='Stevens'
+        ).update(death_indicator=True)
+        self.assertOneQuery(dict(
+            column='demographics', field='Death Indicator',
+            combine='and', query='false', queryType='Equals'
+        ))
+
+    def test_date_field(self):
+        self.assertOneQuery(dict(
+            column='birthday', field='Birth Date',
+            combine='and', query='1/12/1999', queryType='Equals'
+        ))
+
+    def test_many_to_many_field(self):
+        self.assertOneQuery(dict(
+            column='favourite_dogs', field='Dogs',
+            combine='and', query='Dalmation', queryType='Equals'
+        ))
+
+    def test_fk_or_ft_field(self):
+        query = queries.DatabaseQuery(self.user, [dict(
+            column='demographics', field='Sex',
+            combine='and', query='Female', queryType='Equals'
+        )])
+        episodes = query._episodes_without_restrictions()
+        self.assertEqual(set(self.episodes), set(episodes))
+
+
+class PatientSummariesTestCase(OpalTestCase):
+
+    def setUp(self):
+        self.patients = []
+        for i in range(3):
+            patient, episode = self.new_patient_and_episode_please()
+            episode.date_of_admission = date(2015, 1, i + 1)
+            episode.discharge_date = date(2015, 2, i + 1)
+            episode.save()
+            patient.create_episode(
+                category_name='Outpatient', date_of_episode=date(2016, 1, 1)
+            )
+            demographics = patient.demographics_set.get()
+            demographics.surname = 'Stevens{0}'.format(i)
+            demographics.save()
+            self.patients.append(patient)
+
+    def test_summary(self):
+        summaries = queries.PatientSummaries(Episode.objects.all())
+        patient = self.patients[0]
+        self.assertEqual({
+            'id': patient.demographics_set.get().id,
+            'patient_id': patient.id,
+            'count': 2,
+            'start': date(2015, 1, 1),
+            'end': date(2016, 1, 1),
+            'first_name': None,
+            'surname': 'Stevens0',
+            'hospital_number': None,
+            'date_of_birth': None,
+            'categories': ['Inpatient', 'Outpatient'],
+        }, summaries[0])
+
+    def test_start_and_end_from_category(self):
+        category = self.patients[0].episode_set.get(
+            category_name='Outpatient'
+        ).category.__class__
+        start = property(lambda self: date(1999, 12, 31))
+        with patch.object(category, 'start', start):
+            summaries = queries.PatientSummaries(Episode.objects.all())[:]
+        self.assertEqual(
+            [date(1999, 12, 31)] * 3, [s['start'] for s in summaries]
+        )
+        self.assertEqual(
+            [date(2016, 1, 1)] * 3, [s['end'] for s in summaries]
+        )
+
+    def test_count(self):
+        summaries = queries.PatientSummaries(Episode.objects.all())
+        with self.assertNumQueries(1):
+            self.assertEqual(3, len(summaries))
+            self.assertEqual(3, summaries.count())
+
+    def test_slice_is_two_queries(self):
+        summaries = queries.PatientSummaries(Episode.objects.all())
+        with self.assertNumQueries(2):
+            page = summaries[1:3]
+        self.assertEqual(
+            [p.id for p in self.patients[1:3]], [s['patient_id'] for s in page]
+        )
+
+    def test_only_counts_given_episodes(self):
+        summaries = queries.PatientSummaries(
+            Episode.objects.filter(category_name='Outpatient')
+        )
+        self.assertEqual([1, 1, 1], [s['count'] for s in summaries])
+        self.assertEqual(
+            [['Outpatient']] * 3, [s['categories'] for s in summaries]
+        )
+
+    def test_order_by(self):
+        self.patients[2].create_episode()
+        summaries = queries.PatientSummaries(
+            Episode.objects.all(), order_by=('-count', 'patient_id')
+        )
+        self.assertEqual(self.patients[2].id, summaries[0]['patient_id'])
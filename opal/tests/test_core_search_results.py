@@ -0,0 +1,161 @@
+"""
+Unittests for opal.core.search.results
+"""
+from django.contrib.auth.models import User
+from django.core.signals import request_finished
+from django.db.models.signals import post_save
+from django.test import override_settings
+from mock import patch, MagicMock
+
+from opal.core import versions
+from opal.core.test import OpalTestCase
+from opal.models import Episode, Patient
+from opal.tests.models import HatWearer
+
+from opal.core.search import results
+
+
+class SearchResultCacheTestCase(OpalTestCase):
+
+    def setUp(self):
+        self.cache = results.SearchResultCache()
+        self.compute = MagicMock(return_value=[1, 2])
+
+    def test_get_or_set(self):
+        self.assertEqual(
+            [1, 2], self.cache.get_or_set('k', [Episode], self.compute)
+        )
+        self.assertEqual(
+            [1, 2], self.cache.get_or_set('k', [Episode], self.compute)
+        )
+        self.assertEqual(1, self.compute.call_count)
+
+    def test_stale_when_model_version_bumped(self):
+        self.cache.get_or_set('k', [Episode, HatWearer], self.compute)
+        versions.bump_model_version(HatWearer)
+        self.cache.get_or_set('k', [Episode, HatWearer], self.compute)
+        self.assertEqual(2, self.compute.call_count)
+
+    def test_not_stale_when_other_model_version_bumped(self):
+        self.cache.get_or_set('k', [Episode], self.compute)
+        versions.bump_model_version(Patient)
+        self.cache.get_or_set('k', [Episode], self.compute)
+        self.assertEqual(1, self.compute.call_count)
+
+    @override_settings(OPAL_SEARCH_CACHE_TTL=60)
+    def test_expires(self):
+        with patch.object(results.time, 'time') as now:
+            now.return_value = 1000
+            self.cache.get_or_set('k', [Episode], self.compute)
+            now.return_value = 1059
+            self.cache.get_or_set('k', [Episode], self.compute)
+            self.assertEqual(1, self.compute.call_count)
+            now.return_value = 1061
+            self.cache.get_or_set('k', [Episode], self.compute)
+            self.assertEqual(2, self.compute.call_count)
+
+    @override_settings(OPAL_SEARCH_CACHE_SIZE=2)
+    def test_least_recently_used_is_evicted(self):
+        self.cache.get_or_set('a', [Episode], self.compute)
+        self.cache.get_or_set('b', [Episode], self.compute)
+        self.cache.get_or_set('a', [Episode], self.compute)
+        self.cache.get_or_set('c', [Episode], self.compute)
+        self.assertEqual(['a', 'c'], list(self.cache.entries.keys()))
+
+    @override_settings(OPAL_SEARCH_CACHE_SIZE=0)
+    def test_disabled(self):
+        self.cache.get_or_set('k', [Episode], self.compute)
+        self.cache.get_or_set('k', [Episode], self.compute)
+        self.assertEqual(2, self.compute.call_count)
+        self.assertEqual(0, len(self.cache.entries))
+
+    def test_clear(self):
+        self.cache.get_or_set('k', [Episode], self.compute)
+        self.cache.clear()
+        self.assertEqual(0, len(self.cache.entries))
+
+
+class NormaliseCriteriaTestCase(OpalTestCase):
+
+    def test_normalise_criteria(self):
+        criteria = [
+            dict(column='demographics', field='First Name', combine='or',
+                 query='Jane', queryType='Equals', lookup_list=[]),
+            dict(column='demographics', field='Surname', combine='AND',
+                 query='Doe', queryType='Contains'),
+        ]
+        self.assertEqual((
+            (None, 'demographics', 'first_name', 'Equals', 'Jane'),
+            ('and', 'demographics', 'surname', 'Contains', 'Doe'),
+        ), results.normalise_criteria(criteria))
+
+
+class BumpVersionTestCase(OpalTestCase):
+
+    def setUp(self):
+        # Tests run in a transaction, so earlier tests leave these behind
+        results.bump_uncommitted()
+
+    def test_bumped_on_save(self):
+        patient, episode = self.new_patient_and_episode_please()
+        version = versions.get_model_versions([HatWearer])
+        HatWearer.objects.create(episode=episode, name='Jane')
+        self.assertNotEqual(version, versions.get_model_versions([HatWearer]))
+
+    def test_not_bumped_for_other_models(self):
+        with patch.object(results.versions, 'bump_model_version') as bump:
+            self.user.save()
+            self.assertFalse(bump.called)
+
+    def test_connected_per_sender(self):
+        self.assertNotIn(
+            results.bump_version, post_save._live_receivers(User)
+        )
+        self.assertIn(
+            results.bump_version, post_save._live_receivers(HatWearer)
+        )
+
+    def test_connected_for_the_models_criteria_name(self):
+        self.assertNotIn(
+            results.bump_version, post_save._live_receivers(Episode)
+        )
+        self.assertNotIn(
+            results.bump_version, post_save._live_receivers(Patient)
+        )
+
+    def test_bumped_again_after_the_request(self):
+        version = versions.get_model_versions([HatWearer])
+        with patch.object(results.connection, 'in_atomic_block', True):
+            results.bump_version(HatWearer)
+        bumped = versions.get_model_versions([HatWearer])
+        self.assertNotEqual(version, bumped)
+        request_finished.send(sender=None)
+        self.assertNotEqual(bumped, versions.get_model_versions([HatWearer]))
+        # Only once
+        bumped = versions.get_model_versions([HatWearer])
+        request_finished.send(sender=None)
+        self.assertEqual(bumped, versions.get_model_versions([HatWearer]))
+
+    def test_bumped_once_outside_a_transaction(self):
+        with patch.object(results.versions, 'bump_model_version') as bump:
+            with patch.object(results.connection, 'in_atomic_block', False):
+                results.bump_version(HatWearer)
+            request_finished.send(sender=None)
+            bump.assert_called_once_with(HatWearer)
+
+    def test_uncommitted_bumped_by_the_next_write(self):
+        with patch.object(results.connection, 'in_atomic_block', True):
+            results.bump_version(HatWearer)
+        with patch.object(results.versions, 'bump_model_version') as bump:
+            with patch.object(results.connection, 'in_atomic_block', False):
+                results.bump_version(Patient)
+            self.assertEqual(
+                set([HatWearer, Patient]),
+                set(c[0][0] for c in bump.call_args_list)
+            )
+
+    @override_settings(OPAL_SEARCH_CACHE_SIZE=0)
+    def test_not_bumped_when_disabled(self):
+        with patch.object(results.versions, 'bump_model_version') as bump:
+            Patient.objects.create()
+            self.assertFalse(bump.called)
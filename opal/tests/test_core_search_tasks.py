@@ -1,10 +1,16 @@
 """
 Unittests for the opal.core.search.tasks module
 """
+import os
+import shutil
+import tempfile
+
+from django.test import override_settings
 from mock import patch
+from opal import models
 from opal.core.test import OpalTestCase
 
-from opal.core.search import tasks
+from opal.core.search import extract, tasks
 
 
 class ExtractTestCase(OpalTestCase):
@@ -23,3 +29,66 @@ class ExtractTestCase(OpalTestCase):
         ]
         fname = tasks.extract(self.user, criteria)
         self.assertEqual('Help', fname)
+
+    @patch('opal.core.search.extract.sqlite_archive')
+    def test_extract_sqlite(self, sqlite_archive):
+        sqlite_archive.return_value = 'Help.sqlite3'
+        fname = tasks.extract(self.user, [], format='sqlite')
+        self.assertEqual('Help.sqlite3', fname)
+
+    @patch('opal.core.search.extract.write_file')
+    def test_extract_file(self, write_file):
+        patient, episode = self.new_patient_and_episode_please()
+        patient.demographics_set.update(surname='Stevens')
+        self.new_patient_and_episode_please()
+        criteria = [
+            {
+                u'column': u'demographics',
+                u'field': u'surname',
+                u'combine': u'and',
+                u'query': u'Stevens',
+                u'queryType': u'Equals'
+            }
+        ]
+        write_file.return_value = '/dir/episodes.csv'
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        with override_settings(OPAL_EXTRACT_DIR=root):
+            path = tasks.extract_file(
+                self.user, criteria, 'name', 'episodes.csv'
+            )
+            directory = extract.extract_directory('name')
+        self.assertEqual('/dir/episodes.csv', path)
+        self.assertTrue(os.path.isdir(directory))
+        self.assertEqual(directory, write_file.call_args[0][0])
+        self.assertEqual('episodes.csv', write_file.call_args[0][1])
+        self.assertEqual([episode], list(write_file.call_args[0][2]))
+
+    @patch('opal.core.search.extract.extract_directory')
+    @patch('shutil.rmtree')
+    @patch('opal.core.search.extract.assemble_archive')
+    def test_assemble_extract(self, assemble_archive, rmtree, extract_directory):
+        extract_directory.return_value = '/dir'
+        assemble_archive.return_value = 'Help'
+        fname = tasks.assemble_extract(['/dir/episodes.csv'], self.user, [], 'name')
+        self.assertEqual('Help', fname)
+        self.assertEqual(['/dir/episodes.csv'], assemble_archive.call_args[0][0])
+        rmtree.assert_called_once_with('/dir', ignore_errors=True)
+
+    @patch('opal.core.search.extract.extract_directory')
+    @patch('shutil.rmtree')
+    def test_remove_extract(self, rmtree, extract_directory):
+        extract_directory.return_value = '/dir'
+        tasks.remove_extract('name')
+        extract_directory.assert_called_once_with('name')
+        rmtree.assert_called_once_with('/dir', ignore_errors=True)
+
+    @patch('opal.core.search.extract.incremental_zip_archive')
+    def test_incremental_extract(self, incremental_zip_archive):
+        incremental_zip_archive.return_value = 'Help'
+        saved_filter = models.Filter.objects.create(
+            user=self.user, name='mine', criteria='[]'
+        )
+        fname = tasks.incremental_extract(self.user, saved_filter.id)
+        self.assertEqual('Help', fname)
+        incremental_zip_archive.assert_called_once_with(saved_filter, self.user)
@@ -7,6 +7,7 @@ from datetime import date
 from django.core.serializers.json import DjangoJSONEncoder
 from django.contrib.auth.models import AnonymousUser
 from django.core.exceptions import PermissionDenied
+from django.test import override_settings
 from mock import patch, MagicMock, mock_open
 
 from opal import models
@@ -197,6 +198,43 @@ class SimpleSearchViewTestCase(BaseSearchTestCase):
         self.assertEqual(data[0]["surname"], "Bond")
 
 
+    def test_pagination(self):
+        for i in range(12):
+            self.create_patient("Sean", "Bean{0}".format(i), str(i))
+        resp = self.get_response('{}/?query=Sean&page_number=2'.format(self.url))
+        data = json.loads(resp.content)
+        self.assertEqual(13, data["total_count"])
+        self.assertEqual(2, data["total_pages"])
+        self.assertEqual(3, len(data["object_list"]))
+
+    def test_only_fetches_the_page(self):
+        for i in range(12):
+            self.create_patient("Sean", "Bean{0}".format(i), str(i))
+        request = self.get_logged_in_request('{}/?query=Sean'.format(self.url))
+        # Count, the page of summaries, then their categories
+        with self.assertNumQueries(3):
+            self.view(request)
+
+
+class AddPaginationTestCase(OpalTestCase):
+
+    def test_lazy_sequence(self):
+        eps = MagicMock()
+        eps.count.return_value = 25
+        eps.__getitem__.return_value = ['a', 'b']
+        results = views._add_pagination(eps, 2)
+        self.assertEqual(25, results['total_count'])
+        self.assertEqual(3, results['total_pages'])
+        self.assertEqual(['a', 'b'], results['object_list'])
+        eps.__getitem__.assert_called_once_with(slice(10, 20))
+        self.assertFalse(eps.__len__.called)
+
+    def test_list(self):
+        results = views._add_pagination(range(12), 2)
+        self.assertEqual([10, 11], results['object_list'])
+        self.assertEqual(12, results['total_count'])
+
+
 class SearchTemplateTestCase(OpalTestCase):
 
     def test_search_template_view(self):
@@ -232,6 +270,93 @@ class ExtractSearchViewTestCase(BaseSearchTestCase):
             resp = json.loads(view.post().content)
             self.assertEqual(1, resp['total_count'])
             self.assertEqual(self.patient.id, resp['object_list'][0]['patient_id'])
+            self.assertNotIn('profile', resp)
+
+    def get_view(self, url='extract'):
+        data = json.dumps([
+            {
+                u'column': u'demographics',
+                u'field': u'Surname',
+                u'combine': u'and',
+                u'query': u'Connery',
+                u'queryType': u'Equals'
+            }
+        ])
+        request = self.rf.post(url)
+        request.user = self.user
+        request.read = MagicMock(return_value=data)
+        view = views.ExtractSearchView()
+        view.request = request
+        return view
+
+    def test_debug(self):
+        view = self.get_view('extract?debug=1')
+        resp = json.loads(view.post().content)
+        self.assertEqual(1, resp['total_count'])
+        self.assertEqual(1, resp['profile']['combine']['rows'])
+        self.assertEqual(1, len(resp['profile']['criteria']))
+
+    def test_debug_staff_only(self):
+        view = self.get_view('extract?debug=1')
+        view.request.user.is_staff = False
+        with self.assertRaises(PermissionDenied):
+            view.post()
+
+    def test_slow_search_logged(self):
+        view = self.get_view()
+        with self.settings(OPAL_SLOW_SEARCH_SECONDS=-1):
+            with patch.object(views.profiling, 'log_slow_search') as log:
+                view.post()
+                self.assertEqual(1, log.call_count)
+
+    def test_fast_search_not_logged(self):
+        view = self.get_view()
+        with patch.object(views.profiling, 'log_slow_search') as log:
+            view.post()
+            self.assertFalse(log.called)
+
+
+class FilterExtractViewTestCase(BaseSearchTestCase):
+
+    def setUp(self):
+        super(FilterExtractViewTestCase, self).setUp()
+        self.filt = models.Filter.objects.create(
+            user=self.user, name='testfilter', criteria='[]'
+        )
+
+    def post(self, pk):
+        view = views.FilterExtractView()
+        view.request = self.get_logged_in_request()
+        return view.post(pk=pk)
+
+    def test_not_logged_in(self):
+        view = views.FilterExtractView()
+        view.request = self.get_not_logged_in_request()
+        with self.assertRaises(PermissionDenied):
+            view.post(pk=self.filt.pk)
+
+    def test_post(self):
+        with patch.object(views, 'incremental_archive') as archive:
+            archive.return_value = iter(['zip'])
+            resp = self.post(self.filt.pk)
+            archive.assert_called_once_with(self.filt, self.user)
+        self.assertTrue(resp.streaming)
+        self.assertEqual('application/zip', resp['Content-Type'])
+        self.assertEqual(['zip'], list(resp.streaming_content))
+
+    def test_someone_elses_filter(self):
+        other = self.make_user('password', username='other')
+        self.filt.user = other
+        self.filt.save()
+        self.assertEqual(404, self.post(self.filt.pk).status_code)
+
+    @override_settings(EXTRACT_ASYNC=True)
+    def test_async(self):
+        with patch.object(views, 'async_incremental_extract') as async_extract:
+            async_extract.return_value = 'the id'
+            resp = self.post(self.filt.pk)
+            async_extract.assert_called_once_with(self.user, self.filt.pk)
+        self.assertEqual({'extract_id': 'the id'}, json.loads(resp.content))
 
 
 class FilterViewTestCase(BaseSearchTestCase):
@@ -351,6 +476,19 @@ class ExtractFileView(BaseSearchTestCase):
             resp = view.get(task_id=437878)
             self.assertEqual(200, resp.status_code)
 
+    @patch('celery.result.AsyncResult')
+    def test_get_sqlite(self, async_result):
+        view = views.ExtractFileView()
+        view.request = self.get_logged_in_request()
+        async_result.return_value.state = 'SUCCESS'
+        async_result.return_value.get.return_value = '/tmp/foo.sqlite3'
+
+        m = mock_open(read_data='This is a file')
+        with patch('opal.core.search.views.open', m, create=True) as m:
+            resp = view.get(task_id=437878)
+            self.assertEqual('application/x-sqlite3', resp['Content-Type'])
+            self.assertIn('.sqlite3"', resp['Content-Disposition'])
+
     @patch('celery.result.AsyncResult')
     def test_get_not_successful(self, async_result):
         view = views.ExtractFileView()
@@ -0,0 +1,60 @@
+"""
+Unittests for opal.core.search.zipstream
+"""
+import io
+import zipfile
+
+from mock import patch
+
+from opal.core.test import OpalTestCase
+
+from opal.core.search import zipstream
+
+
+class ZipStreamTestCase(OpalTestCase):
+
+    def read(self, stream):
+        return zipfile.ZipFile(io.BytesIO(b''.join(stream)))
+
+    def test_round_trip(self):
+        stream = zipstream.ZipStream()
+        stream.add('folder/a.csv', ['a,b\r\n', '1,2\r\n'])
+        stream.add('folder/b.txt', iter(['hello']))
+        archive = self.read(stream)
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(['folder/a.csv', 'folder/b.txt'], archive.namelist())
+        self.assertEqual('a,b\r\n1,2\r\n', archive.read('folder/a.csv'))
+        self.assertEqual('hello', archive.read('folder/b.txt'))
+
+    def test_stored(self):
+        stream = zipstream.ZipStream(compression=zipfile.ZIP_STORED)
+        stream.add('a.txt', ['hello', 'world'])
+        archive = self.read(stream)
+        self.assertEqual(zipfile.ZIP_STORED, archive.getinfo('a.txt').compress_type)
+        self.assertEqual('helloworld', archive.read('a.txt'))
+
+    def test_empty_entry(self):
+        stream = zipstream.ZipStream()
+        stream.add('empty.txt', [])
+        self.assertEqual('', self.read(stream).read('empty.txt'))
+
+    def test_no_entries(self):
+        self.assertEqual([], self.read(zipstream.ZipStream()).namelist())
+
+    @patch.object(zipstream, 'CHUNK_SIZE', 1024)
+    def test_yields_as_contents_are_generated(self):
+        consumed = []
+
+        def lines():
+            for i in range(1000):
+                consumed.append(i)
+                yield '{0}\r\n'.format(i) * 10
+
+        stream = zipstream.ZipStream(compression=zipfile.ZIP_STORED)
+        stream.add('a.txt', lines())
+        chunks = iter(stream)
+        first = next(chunks)
+        self.assertLess(len(consumed), 1000)
+        self.assertLess(len(first), 2048)
+        archive = self.read([first] + list(chunks))
+        self.assertIsNone(archive.testzip())
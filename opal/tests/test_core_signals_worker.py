@@ -46,3 +46,23 @@ class SubrecordPostSaveTestCase(OpalTestCase):
 
 
         self.assertEqual(1, mock_receiver.call_count)
+
+class SubrecordBulkPostSaveTestCase(OpalTestCase):
+    def test_sender(self):
+        mock_receiver = MagicMock(name='mock receiver')
+
+        @receiver(worker.subrecord_bulk_post_save, sender=Colour)
+        def rec(*a, **k):
+            mock_receiver(*a, **k)
+
+        p, e = self.new_patient_and_episode_please()
+        blue = Colour.objects.create(episode=e, name='Blue')
+        Colour.bulk_write_from_dicts([
+            {'id': blue.id, 'name': 'Navy'},
+            {'episode_id': e.id, 'name': 'Red'},
+        ], self.user)
+
+        self.assertEqual(1, mock_receiver.call_count)
+        args, kwargs = mock_receiver.call_args
+        self.assertEqual(['Red'], [c.name for c in kwargs['created']])
+        self.assertEqual([blue], kwargs['updated'])
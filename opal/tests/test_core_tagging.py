@@ -17,3 +17,14 @@ class ParentTestCase(OpalTestCase):
 
     def test_parentless(self):
         self.assertEqual(None, tagging.parent('carnivore'))
+
+
+class SubtagParentsTestCase(OpalTestCase):
+    def test_subtag_parents(self):
+        self.assertEqual(
+            {'herbivore': 'eater', 'omnivore': 'eater'},
+            tagging.subtag_parents()
+        )
+
+    def test_is_cached(self):
+        self.assertIs(tagging.subtag_parents(), tagging.subtag_parents())
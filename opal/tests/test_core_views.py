@@ -11,3 +11,33 @@ class SerializerTestCase(test.OpalTestCase):
         s = views.OpalSerializer()
         with self.assertRaises(TypeError):
             s.default(None)
+
+
+class BuildCachedJsonResponseTestCase(test.OpalTestCase):
+
+    def test_response(self):
+        request = self.rf.get('/')
+        response = views._build_cached_json_response(request, '[1]', 'abc')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('[1]', response.content)
+        self.assertEqual('"abc"', response['ETag'])
+        self.assertEqual('application/json', response['Content-Type'])
+        self.assertEqual('no-cache', response['Cache-Control'])
+
+    def test_not_modified(self):
+        request = self.rf.get('/', HTTP_IF_NONE_MATCH='"xyz", "abc"')
+        response = views._build_cached_json_response(request, '[1]', 'abc')
+        self.assertEqual(304, response.status_code)
+        self.assertEqual('"abc"', response['ETag'])
+
+    def test_modified(self):
+        request = self.rf.get('/', HTTP_IF_NONE_MATCH='"xyz"')
+        response = views._build_cached_json_response(request, '[1]', 'abc')
+        self.assertEqual(200, response.status_code)
+
+    def test_cache_control(self):
+        request = self.rf.get('/')
+        response = views._build_cached_json_response(
+            request, '[1]', 'abc', cache_control='max-age=60'
+        )
+        self.assertEqual('max-age=60', response['Cache-Control'])
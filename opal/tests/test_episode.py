@@ -58,6 +58,43 @@ class EpisodeTest(OpalTestCase):
             value='mine', user=self.user, archived=False).exists()
         )
 
+    def test_set_tag_names_archives_and_restores(self):
+        self.episode.set_tag_names(['herbivore'], self.user)
+        self.episode.set_tag_names(['carnivore'], self.user)
+        self.assertEqual(
+            set(['eater', 'herbivore']),
+            set(Tagging.objects.filter(archived=True).values_list('value', flat=True))
+        )
+        self.episode.set_tag_names(['herbivore'], self.user)
+        self.assertEqual(
+            set(['eater', 'herbivore']),
+            set(self.episode.get_tag_names(self.user))
+        )
+        self.assertEqual(3, Tagging.objects.count())
+        herbivore = Tagging.objects.get(value='herbivore')
+        self.assertEqual(self.user, herbivore.updated_by)
+
+    def test_set_tag_names_leaves_unchanged_tags_alone(self):
+        self.episode.set_tag_names(['carnivore'], self.user)
+        self.episode.set_tag_names(['carnivore', 'herbivore'], self.user)
+        self.assertIsNone(Tagging.objects.get(value='carnivore').updated)
+
+    def test_set_tag_names_mine(self):
+        self.episode.set_tag_names(['mine'], self.user)
+        self.episode.set_tag_names(['carnivore'], self.user)
+        self.assertTrue(Tagging.objects.get(value='mine').archived)
+        self.episode.set_tag_names(['mine'], self.user)
+        self.assertFalse(Tagging.objects.get(value='mine').archived)
+        self.assertEqual(['mine'], list(self.episode.get_tag_names(self.user)))
+
+    def test_set_tag_names_query_count(self):
+        user = self.user
+        self.episode.set_tag_names(['carnivore', 'mine'], user)
+        # savepoint, lock, existing, archive, archive mine, create,
+        # record the change, release
+        with self.assertNumQueries(8):
+            self.episode.set_tag_names(['herbivore', 'omnivore'], user)
+
     def test_user_cannot_see_other_users_mine_tag(self):
         other_user = User.objects.create(username='seconduser')
         self.episode.set_tag_names(['carnivore', 'mine'], self.user)
@@ -1,8 +1,15 @@
+from django.test import override_settings
+from mock import patch
+
 from opal.core.test import OpalTestCase
 from opal.models import Synonym
-from opal.tests.models import Hat
+from opal.tests.models import Hat, Dog
 from django.contrib.contenttypes.models import ContentType
-from opal.core.lookuplists import load_lookuplist
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from opal.core.lookuplists import (
+    bump_version, cache, invalidate_cache, load_lookuplist, LookupListCache
+)
 
 
 class AbstractLookupListTestCase(OpalTestCase):
@@ -68,3 +75,92 @@ class LookupListClassTestCase(AbstractLookupListTestCase):
     def test_save_normal(self):
         Hat.objects.create(name="Bowler")
         self.assertTrue(Hat.objects.filter(name="Bowler").exists())
+
+
+class LookupListCacheTestCase(AbstractLookupListTestCase):
+    def setUp(self):
+        super(LookupListCacheTestCase, self).setUp()
+        self.cache = LookupListCache()
+
+    def test_resolve_name(self):
+        self.assertEqual(
+            ("Cowboy", self.hat.id), self.cache.resolve(Hat, "Cowboy")
+        )
+
+    def test_resolve_synonym(self):
+        self.assertEqual(
+            ("Cowboy", self.hat.id), self.cache.resolve(Hat, "Stetson")
+        )
+
+    def test_resolve_unknown(self):
+        self.assertEqual(("Fez", None), self.cache.resolve(Hat, "Fez"))
+
+    def test_resolve_many(self):
+        with self.assertNumQueries(2):
+            self.assertEqual({
+                "Cowboy": ("Cowboy", self.hat.id),
+                "Stetson": ("Cowboy", self.hat.id),
+                "Fez": ("Fez", None),
+            }, self.cache.resolve_many(Hat, ["Cowboy", "Stetson", "Fez"]))
+
+    def test_resolve_many_only_looks_up_missing(self):
+        self.cache.resolve(Hat, "Stetson")
+        with patch.object(self.cache, '_lookup') as lookup:
+            lookup.return_value = {"Fez": ("Fez", None)}
+            self.cache.resolve_many(Hat, ["Stetson", "Fez"])
+            lookup.assert_called_once_with(Hat, ["Fez"])
+
+    def test_resolve_many_is_cached(self):
+        self.cache.resolve_many(Hat, ["Cowboy", "Stetson"])
+        with self.assertNumQueries(0):
+            self.cache.resolve_many(Hat, ["Cowboy", "Stetson"])
+
+    def test_resolve_is_cached(self):
+        self.cache.resolve(Hat, "Stetson")
+        with self.assertNumQueries(0):
+            self.cache.resolve(Hat, "Stetson")
+
+    @override_settings(OPAL_LOOKUPLIST_CACHE_SIZE=1)
+    def test_least_recently_used_is_evicted(self):
+        self.cache.resolve(Hat, "Cowboy")
+        self.cache.resolve(Hat, "Stetson")
+        self.assertEqual([(Hat, "Stetson")], list(self.cache.entries.keys()))
+
+    def test_invalidated_on_lookuplist_save(self):
+        self.assertEqual(("Fez", None), cache.resolve(Hat, "Fez"))
+        fez = Hat.objects.create(name="Fez")
+        self.assertEqual(("Fez", fez.id), cache.resolve(Hat, "Fez"))
+
+    def test_invalidated_on_lookuplist_delete(self):
+        cache.resolve(Hat, "Cowboy")
+        Synonym.objects.all().delete()
+        self.hat.delete()
+        self.assertEqual(("Cowboy", None), cache.resolve(Hat, "Cowboy"))
+
+    def test_invalidated_on_synonym_save(self):
+        self.assertEqual(("Ten Gallon", None), cache.resolve(Hat, "Ten Gallon"))
+        Synonym.objects.create(
+            content_type=ContentType.objects.get_for_model(Hat),
+            object_id=self.hat.id,
+            name="Ten Gallon"
+        )
+        self.assertEqual(
+            ("Cowboy", self.hat.id), cache.resolve(Hat, "Ten Gallon")
+        )
+
+    def test_invalidated_by_another_process(self):
+        self.cache.resolve(Hat, "Cowboy")
+        bump_version()
+        with self.assertNumQueries(2):
+            self.cache.resolve(Hat, "Cowboy")
+
+    def test_connected_per_sender(self):
+        self.assertIn(invalidate_cache, post_save._live_receivers(Hat))
+        self.assertIn(invalidate_cache, post_delete._live_receivers(Synonym))
+        self.assertNotIn(invalidate_cache, post_save._live_receivers(User))
+
+    def test_invalidate_only_drops_that_model(self):
+        self.cache.resolve(Hat, "Cowboy")
+        self.cache.resolve(Dog, "Spot")
+        self.cache.invalidate(Hat)
+        self.assertEqual([(Dog, "Spot")], list(self.cache.entries.keys()))
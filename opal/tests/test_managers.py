@@ -1,6 +1,9 @@
 """
 Unittests for opal.managers
 """
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
 from opal.core.test import OpalTestCase
 from opal.models import Patient, Episode
 from opal.tests.models import Hat, HatWearer, Dog, DogOwner
@@ -63,6 +66,39 @@ class PatientManagerTestCase(OpalTestCase):
         query = Patient.objects.search('je rien')
         self.assertEqual(query.get(), self.patient_1)
 
+    def test_serialised(self):
+        episode = self.patient_1.create_episode()
+        active = self.patient_1.create_episode(active=True)
+        as_dict = Patient.objects.serialised(self.user, [self.patient_1])[0]
+
+        self.assertEqual(self.patient_1.id, as_dict['id'])
+        self.assertEqual(active.id, as_dict['active_episode_id'])
+        self.assertEqual(
+            set([episode.id, active.id]), set(as_dict['episodes'].keys())
+        )
+        self.assertEqual(
+            episode.to_dict(self.user), as_dict['episodes'][episode.id]
+        )
+        self.assertEqual(
+            "regrette", as_dict['demographics'][0]['surname']
+        )
+
+    def test_serialised_query_count_is_constant(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                Patient.objects.serialised(self.user, [self.patient_1])
+            return len(queries)
+
+        self.patient_1.create_episode()
+        # warm up the user profile
+        count_queries()
+        expected = count_queries()
+
+        for i in range(3):
+            self.patient_1.create_episode()
+
+        self.assertEqual(expected, count_queries())
+
 
 
 class EpisodeManagerTestCase(OpalTestCase):
@@ -142,3 +178,25 @@ class EpisodeManagerTestCase(OpalTestCase):
             self.user, [self.episode], episode_history=False
         )
         self.assertEqual(as_dict[0]['tagging'][0], {'id': 1})
+
+    def test_serialised_query_count_is_constant(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                Episode.objects.serialised(
+                    self.user, [self.episode], episode_history=True
+                )
+            return len(queries)
+
+        # warm up the user profile
+        count_queries()
+        expected = count_queries()
+
+        hat = Hat.objects.get(name="top")
+        for i in range(3):
+            hw = HatWearer.objects.create(episode=self.episode)
+            hw.hats.add(hat)
+            do = DogOwner.objects.create(episode=self.episode)
+            do.dog = "Jemima"
+            do.save()
+
+        self.assertEqual(expected, count_queries())
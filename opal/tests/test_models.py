@@ -6,10 +6,13 @@ from mock import patch, MagicMock
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import connections
 from django.utils import timezone
+import reversion
 
 from opal import models
 from opal.core import exceptions
+from opal.core.signals import subrecords_bulk_saved
 from opal.models import (
     Subrecord, Tagging, Team, Patient, InpatientAdmission, Symptom,
     SymptomComplex, UserProfile
@@ -18,7 +21,7 @@ from opal.core.test import OpalTestCase
 import opal.tests.test_patient_lists # To make sure test tagged lists are pulled in
 from opal.tests.models import (
     FamousLastWords, PatientColour, ExternalSubRecord, SymptomComplex, PatientConsultation,
-    Birthday, DogOwner, HatWearer, HouseOwner
+    Birthday, DogOwner, HatWearer, HouseOwner, Hat
 )
 
 class PatientRecordAccessTestCase(OpalTestCase):
@@ -456,6 +459,236 @@ class BulkUpdateFromDictsTest(OpalTestCase):
         self.assertEqual(result.words, famous_last_words[0].values()[0])
 
 
+class BulkWriteFromDictsTestCase(OpalTestCase):
+
+    def setUp(self):
+        self.patient, self.episode = self.new_patient_and_episode_please()
+
+    def test_create(self):
+        dog_owners = DogOwner.bulk_write_from_dicts([
+            {"name": "Jane", "episode_id": self.episode.id, "dog": "Spot",
+             "ownership_start_date": "10/1/2000"},
+            {"name": "John", "episode_id": self.episode.id},
+        ], self.user)
+        self.assertEqual(2, DogOwner.objects.count())
+        jane = DogOwner.objects.get(id=dog_owners[0].id)
+        self.assertEqual("Jane", jane.name)
+        self.assertEqual("Spot", jane.dog)
+        self.assertEqual(datetime.date(2000, 1, 10), jane.ownership_start_date)
+        self.assertEqual(self.user, jane.created_by)
+        self.assertEqual(
+            jane.consistency_token, dog_owners[0].consistency_token
+        )
+        self.assertEqual("John", DogOwner.objects.get(id=dog_owners[1].id).name)
+
+    @patch('opal.models.subrecords_bulk_saved')
+    def test_create_without_returning(self, bulk_saved):
+        rows = [
+            {"name": str(i), "episode_id": self.episode.id} for i in range(20)
+        ]
+        user = self.user
+        # parent ids, savepoint, an insert per row, release
+        with self.assertNumQueries(23):
+            dog_owners = DogOwner.bulk_write_from_dicts(rows, user)
+        self.assertEqual(20, DogOwner.objects.count())
+        for i, dog_owner in enumerate(dog_owners):
+            self.assertEqual(str(i), DogOwner.objects.get(id=dog_owner.id).name)
+
+    @patch('opal.models.subrecords_bulk_saved')
+    def test_create_with_returning(self, bulk_saved):
+        rows = [
+            {"name": str(i), "episode_id": self.episode.id} for i in range(20)
+        ]
+        user = self.user
+        connection = connections[DogOwner.objects.db]
+        # SQLite has supported RETURNING since 3.35
+        with patch.object(connection, 'vendor', 'postgresql'):
+            # parent ids, savepoint, insert, release
+            with self.assertNumQueries(4):
+                dog_owners = DogOwner.bulk_write_from_dicts(rows, user)
+        for i, dog_owner in enumerate(dog_owners):
+            self.assertEqual(str(i), DogOwner.objects.get(id=dog_owner.id).name)
+
+    def test_adds_to_the_current_revision(self):
+        self.assertTrue(reversion.is_registered(DogOwner))
+        jane = DogOwner.objects.create(name="Jane", episode=self.episode)
+        with reversion.create_revision():
+            dog_owners = DogOwner.bulk_write_from_dicts([
+                {"id": jane.id, "name": "Janet"},
+                {"name": "John", "episode_id": self.episode.id},
+            ], self.user)
+        for dog_owner in dog_owners:
+            versions = reversion.get_for_object(dog_owner)
+            self.assertEqual(1, len(versions))
+            self.assertEqual(
+                dog_owner.name, versions[0].field_dict["name"]
+            )
+
+    def test_not_added_without_a_revision(self):
+        dog_owners = DogOwner.bulk_write_from_dicts([
+            {"name": "John", "episode_id": self.episode.id},
+        ], self.user)
+        self.assertEqual(0, len(reversion.get_for_object(dog_owners[0])))
+
+    def test_update(self):
+        jane = DogOwner.objects.create(
+            name="Jane", episode=self.episode, consistency_token="12345678"
+        )
+        john = DogOwner.objects.create(
+            name="John", episode=self.episode, consistency_token="87654321"
+        )
+        DogOwner.bulk_write_from_dicts([
+            {"id": jane.id, "name": "Janet", "consistency_token": "12345678",
+             "dog": "Spot"},
+            {"id": john.id, "name": "Jon", "consistency_token": "87654321"},
+        ], self.user)
+        jane = DogOwner.objects.get(id=jane.id)
+        self.assertEqual("Janet", jane.name)
+        self.assertEqual("Spot", jane.dog)
+        self.assertEqual(self.user, jane.updated_by)
+        self.assertNotEqual("12345678", jane.consistency_token)
+        self.assertEqual("Jon", DogOwner.objects.get(id=john.id).name)
+
+    @patch('opal.models.subrecords_bulk_saved')
+    def test_update_is_set_based(self, bulk_saved):
+        rows = []
+        for i in range(20):
+            dog_owner = DogOwner.objects.create(name=str(i), episode=self.episode)
+            rows.append({"id": dog_owner.id, "name": "new"})
+        user = self.user
+        # savepoint, lock existing, update, release
+        with self.assertNumQueries(4):
+            DogOwner.bulk_write_from_dicts(rows, user)
+        self.assertEqual(
+            ["new"], list(DogOwner.objects.values_list("name", flat=True).distinct())
+        )
+
+    def test_create_and_update(self):
+        jane = DogOwner.objects.create(name="Jane", episode=self.episode)
+        dog_owners = DogOwner.bulk_write_from_dicts([
+            {"id": jane.id, "name": "Janet"},
+            {"name": "John", "episode_id": self.episode.id},
+        ], self.user)
+        self.assertEqual(jane.id, dog_owners[0].id)
+        self.assertEqual(
+            set(["Janet", "John"]),
+            set(DogOwner.objects.values_list("name", flat=True))
+        )
+
+    def test_sends_one_signal(self):
+        receiver = MagicMock(name="receiver")
+        subrecords_bulk_saved.connect(receiver)
+        jane = DogOwner.objects.create(name="Jane", episode=self.episode)
+        try:
+            dog_owners = DogOwner.bulk_write_from_dicts([
+                {"id": jane.id, "name": "Janet"},
+                {"name": "John", "episode_id": self.episode.id},
+            ], self.user)
+        finally:
+            subrecords_bulk_saved.disconnect(receiver)
+        self.assertEqual(1, receiver.call_count)
+        _, kwargs = receiver.call_args
+        self.assertEqual(DogOwner, kwargs["sender"])
+        self.assertEqual([dog_owners[1]], kwargs["created"])
+        self.assertEqual([dog_owners[0]], kwargs["updated"])
+
+    def test_many_to_many(self):
+        Hat.objects.create(name="Bowler")
+        Hat.objects.create(name="Top")
+        wearer = HatWearer.objects.create(name="Jane", episode=self.episode)
+        wearer.hats.add(Hat.objects.get(name="Top"))
+        wearers = HatWearer.bulk_write_from_dicts([
+            {"id": wearer.id, "hats": ["Bowler"]},
+            {"name": "John", "episode_id": self.episode.id,
+             "hats": ["Bowler", "Top"]},
+        ], self.user)
+        self.assertEqual(
+            ["Bowler"], [h.name for h in wearers[0].hats.all()]
+        )
+        self.assertEqual(
+            ["Bowler", "Top"],
+            sorted(h.name for h in wearers[1].hats.all())
+        )
+
+    def test_unknown_many_to_many_writes_nothing(self):
+        with self.assertRaises(exceptions.APIError):
+            HatWearer.bulk_write_from_dicts([
+                {"name": "Jane", "episode_id": self.episode.id},
+                {"name": "John", "episode_id": self.episode.id,
+                 "hats": ["Fez"]},
+            ], self.user)
+        self.assertFalse(HatWearer.objects.exists())
+
+    def test_unexpected_field_writes_nothing(self):
+        with self.assertRaises(exceptions.APIError):
+            DogOwner.bulk_write_from_dicts([
+                {"name": "Jane", "episode_id": self.episode.id},
+                {"name": "John", "episode_id": self.episode.id, "cat": "Tom"},
+            ], self.user)
+        self.assertFalse(DogOwner.objects.exists())
+
+    def test_consistency_error_writes_nothing(self):
+        jane = DogOwner.objects.create(
+            name="Jane", episode=self.episode, consistency_token="12345678"
+        )
+        with self.assertRaises(exceptions.ConsistencyError):
+            DogOwner.bulk_write_from_dicts([
+                {"name": "John", "episode_id": self.episode.id},
+                {"id": jane.id, "name": "Janet", "consistency_token": "wrong"},
+            ], self.user)
+        self.assertEqual(["Jane"], [d.name for d in DogOwner.objects.all()])
+
+    def test_missing_consistency_token(self):
+        jane = DogOwner.objects.create(
+            name="Jane", episode=self.episode, consistency_token="12345678"
+        )
+        with self.assertRaises(exceptions.APIError):
+            DogOwner.bulk_write_from_dicts([
+                {"id": jane.id, "name": "Janet"},
+            ], self.user)
+
+    def test_force(self):
+        jane = DogOwner.objects.create(
+            name="Jane", episode=self.episode, consistency_token="12345678"
+        )
+        DogOwner.bulk_write_from_dicts([
+            {"id": jane.id, "name": "Janet", "consistency_token": "wrong"},
+        ], self.user, force=True)
+        self.assertEqual("Janet", DogOwner.objects.get().name)
+
+    def test_nonexistant_subrecord(self):
+        with self.assertRaises(exceptions.APIError):
+            DogOwner.bulk_write_from_dicts([{"id": 3492, "name": "Jane"}], self.user)
+
+    def test_duplicate_ids(self):
+        jane = DogOwner.objects.create(name="Jane", episode=self.episode)
+        with self.assertRaises(exceptions.APIError):
+            DogOwner.bulk_write_from_dicts([
+                {"id": jane.id, "name": "Janet"},
+                {"id": jane.id, "name": "Jan"},
+            ], self.user)
+
+    def test_nonexistant_parent(self):
+        with self.assertRaises(exceptions.APIError):
+            DogOwner.bulk_write_from_dicts([
+                {"name": "Jane", "episode_id": 3492}
+            ], self.user)
+        with self.assertRaises(exceptions.APIError):
+            DogOwner.bulk_write_from_dicts([{"name": "Jane"}], self.user)
+
+    def test_patient_subrecord(self):
+        colours = PatientColour.bulk_write_from_dicts([
+            {"name": "blue", "patient_id": self.patient.id}
+        ], self.user)
+        self.assertEqual(self.patient, PatientColour.objects.get(id=colours[0].id).patient)
+
+    def test_create_singleton(self):
+        with self.assertRaises(exceptions.APIError):
+            FamousLastWords.bulk_write_from_dicts([
+                {"words": "So long", "patient_id": self.patient.id}
+            ], self.user)
+
+
 class InpatientAdmissionTestCase(OpalTestCase):
     def test_updates_with_external_identifer(self):
         patient = models.Patient()
@@ -702,6 +935,106 @@ class TeamTestCase(OpalTestCase):
 
 
 
+class ChangedRecordTestCase(OpalTestCase):
+
+    def changed(self):
+        return set(models.ChangedRecord.objects.values_list(
+            'api_name', 'record_id'
+        ))
+
+    def test_saved(self):
+        patient, episode = self.new_patient_and_episode_please()
+        self.assertIn(('episode', episode.id), self.changed())
+        self.assertIn(
+            ('demographics', patient.demographics_set.get().id), self.changed()
+        )
+        self.assertIsNone(episode.updated)
+
+    def test_saved_again(self):
+        patient, episode = self.new_patient_and_episode_please()
+        before = models.ChangedRecord.objects.get(
+            api_name='episode', record_id=episode.id
+        ).changed
+        episode.active = True
+        episode.save()
+        change = models.ChangedRecord.objects.get(
+            api_name='episode', record_id=episode.id
+        )
+        self.assertGreaterEqual(change.changed, before)
+        self.assertIsNone(models.Episode.objects.get().updated)
+
+    def test_bulk_saved(self):
+        patient, episode = self.new_patient_and_episode_please()
+        wearers = HatWearer.bulk_write_from_dicts(
+            [{'episode_id': episode.id, 'name': 'Jane'}], self.user
+        )
+        self.assertIn(('hat_wearer', wearers[0].id), self.changed())
+
+    def test_tags_changed(self):
+        patient, episode = self.new_patient_and_episode_please()
+        models.ChangedRecord.objects.all().delete()
+        episode.set_tag_names(['mine'], self.user)
+        self.assertEqual(set([('episode', episode.id)]), self.changed())
+
+    def test_tags_unchanged(self):
+        patient, episode = self.new_patient_and_episode_please()
+        episode.set_tag_names(['mine'], self.user)
+        models.ChangedRecord.objects.all().delete()
+        episode.set_tag_names(['mine'], self.user)
+        self.assertEqual(set(), self.changed())
+
+    def test_other_models_not_recorded(self):
+        Team.objects.create(name='a', title='A')
+        self.assertEqual(set(), self.changed())
+
+
+class DeletedRecordTestCase(OpalTestCase):
+
+    def test_subrecord_deleted(self):
+        patient, episode = self.new_patient_and_episode_please()
+        wearer = HatWearer.objects.create(episode=episode, name='Jane')
+        wearer_id = wearer.id
+        wearer.delete()
+        deleted = models.DeletedRecord.objects.get()
+        self.assertEqual('hat_wearer', deleted.api_name)
+        self.assertEqual(wearer_id, deleted.record_id)
+        self.assertEqual(episode.id, deleted.episode_id)
+        self.assertIsNone(deleted.patient_id)
+
+    def test_patient_subrecord_deleted(self):
+        patient, episode = self.new_patient_and_episode_please()
+        patient.demographics_set.get().delete()
+        deleted = models.DeletedRecord.objects.get()
+        self.assertIsNone(deleted.episode_id)
+        self.assertEqual(patient.id, deleted.patient_id)
+
+    def test_episode_deleted_with_its_subrecords(self):
+        patient, episode = self.new_patient_and_episode_please()
+        HatWearer.objects.create(episode=episode, name='Jane')
+        episode_id = episode.id
+        episode.delete()
+        deleted = models.DeletedRecord.objects.values_list(
+            'api_name', 'record_id'
+        )
+        self.assertIn(('episode', episode_id), deleted)
+        self.assertIn('hat_wearer', [api_name for api_name, _ in deleted])
+        self.assertEqual(
+            patient.id,
+            models.DeletedRecord.objects.get(api_name='episode').patient_id
+        )
+
+    def test_connected_per_sender(self):
+        from django.db.models.signals import post_delete
+        receivers = lambda sender: post_delete._live_receivers(sender)
+        self.assertNotIn(models.record_deletion, receivers(Team))
+        self.assertIn(models.record_deletion, receivers(HatWearer))
+        self.assertIn(models.record_deletion, receivers(models.Episode))
+
+    def test_other_models_not_recorded(self):
+        Team.objects.create(name='a', title='A').delete()
+        self.assertFalse(models.DeletedRecord.objects.exists())
+
+
 class AbstractDemographicsTestCase(OpalTestCase):
     def test_name(self):
         d = models.Demographics(first_name='Jane',
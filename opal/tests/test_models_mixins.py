@@ -76,6 +76,35 @@ class SerialisableFieldsTestCase(OpalTestCase):
         ]
         self.assertEqual(schema, expected)
 
+    def test_get_field_plan(self):
+        plan = SerialisableModel._get_field_plan()
+        self.assertEqual(
+            ['id', 'pid', 'hatty'], [f.name for f in plan.fields]
+        )
+        self.assertEqual(frozenset(['id', 'pid', 'hatty']), plan.fieldnames)
+        hatty = plan.get('hatty')
+        self.assertEqual(ForeignKeyOrFreeText, hatty.type)
+        self.assertTrue(hatty.fk_or_ft)
+        self.assertFalse(hatty.many_to_many)
+        self.assertIs(hatty, plan.by_name['hatty'])
+        self.assertIsNone(plan.get('nope'))
+
+    def test_get_field_plan_is_cached(self):
+        plan = SerialisableModel._get_field_plan()
+        self.assertIs(plan, SerialisableModel._get_field_plan())
+
+    def test_get_field_plan_is_per_class(self):
+        self.assertNotEqual(
+            SerialisableModel._get_field_plan(),
+            GetterModel._get_field_plan()
+        )
+
+    def test_get_field_plan_getters_and_setters(self):
+        plan = GetterModel._get_field_plan()
+        self.assertEqual('get_foo', plan.get('foo').getter)
+        self.assertIsNone(plan.get('foo').setter)
+        created = test_models.Colour._get_field_plan().get('created')
+        self.assertEqual('set_created', created.setter)
 
 
 
@@ -101,6 +130,10 @@ class UpdatesFromDictMixinTestCase(OpalTestCase):
         expected = ['id', 'foo', 'bar']
         self.assertEqual(expected, self.model._get_fieldnames_to_extract())
 
+    def test_get_fieldnames_to_extract_returns_a_copy(self):
+        self.model._get_fieldnames_to_extract().remove('id')
+        self.assertIn('id', self.model._get_fieldnames_to_extract())
+
     def test_get_fieldnames_to_extract_fkorft_438(self):
         # Regression test for https://github.com/opal/issues/438
         fnames = self.model._get_fieldnames_to_extract()
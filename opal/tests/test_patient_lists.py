@@ -6,10 +6,10 @@ from mock import MagicMock, PropertyMock, patch
 
 from opal.core import exceptions
 from opal.tests import models
-from opal.models import Patient, Team, UserProfile
+from opal.models import Patient, Role, Team, UserProfile
 from opal.core.test import OpalTestCase
 
-from opal.core import patient_lists
+from opal.core import patient_lists, versions
 from opal.core.patient_lists import PatientList, TaggedPatientList
 
 
@@ -126,6 +126,24 @@ class FirstListMetadataTestCase(OpalTestCase):
             slug = patient_lists.FirstListMetadata.to_dict(user=self.user)
             self.assertEqual({'first_list_slug': ''}, slug)
 
+    def cached_version(self):
+        return versions.get_version(
+            patient_lists.FirstListMetadata.get_version_key()
+        )
+
+    def test_invalidated_by_roles(self):
+        profile, _ = UserProfile.objects.get_or_create(user=self.user)
+        role = Role.objects.create(name='doctor')
+        version = self.cached_version()
+        profile.roles.add(role)
+        self.assertNotEqual(version, self.cached_version())
+
+    def test_invalidated_by_user(self):
+        version = self.cached_version()
+        self.user.is_superuser = True
+        self.user.save()
+        self.assertNotEqual(version, self.cached_version())
+
 
 class TestTaggedPatientList(OpalTestCase):
 
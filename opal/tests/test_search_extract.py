@@ -1,16 +1,30 @@
 """
 Unittests for opal.core.search.extract
 """
+import csv
 import datetime
+import decimal
+import io
+import itertools
 import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import zipfile
 from mock import mock_open, Mock, patch
 
+from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
 from opal.core.test import OpalTestCase
 from opal import models
-from opal.tests.models import Colour, PatientColour, Demographics
+from opal.tests.models import (Colour, PatientColour, Demographics, Dog,
+                               DogOwner, Hat, HatWearer)
 from opal.core.search import extract
 from opal.core import subrecords
 
@@ -41,6 +55,11 @@ class TestViewPOSTTestCase(OpalTestCase):
         response = self.client.post(url, post_data)
 
         self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual('application/zip', response['Content-Type'])
+        contents = io.BytesIO(b''.join(response.streaming_content))
+        with zipfile.ZipFile(contents) as archive:
+            self.assertIsNone(archive.testzip())
 
     @override_settings(EXTRACT_ASYNC=True)
     def test_check_view_with_sync_extract(self):
@@ -64,6 +83,61 @@ class TestViewPOSTTestCase(OpalTestCase):
         response = self.client.post(url, json.dumps(post_data), content_type='appliaction/json')
         self.assertEqual(response.status_code, 200)
 
+    def test_check_view_sqlite(self):
+        url = reverse("extract_download")
+        post_data = {
+            "criteria": json.dumps([{
+                "combine": "and",
+                "column": "demographics",
+                "field": "Surname",
+                "queryType": "Contains",
+                "query": "a",
+                "lookup_list": [],
+            }]),
+            "format": "sqlite",
+        }
+        self.assertTrue(
+            self.client.login(username=self.user.username, password=self.PASSWORD)
+        )
+        with patch('opal.core.search.views.sqlite_archive') as sqlite_archive:
+            handle, target = tempfile.mkstemp(suffix='.sqlite3')
+            with os.fdopen(handle, 'wb') as database:
+                database.write('SQLite format 3')
+            sqlite_archive.return_value = target
+            response = self.client.post(url, post_data)
+            self.assertEqual('application/x-sqlite3', response['Content-Type'])
+            self.assertIn('.sqlite3"', response['Content-Disposition'])
+            self.assertEqual(
+                'SQLite format 3', b''.join(response.streaming_content)
+            )
+        self.assertFalse(os.path.exists(target))
+
+    def test_check_view_unknown_format(self):
+        url = reverse("extract_download")
+        self.assertTrue(
+            self.client.login(username=self.user.username, password=self.PASSWORD)
+        )
+        response = self.client.post(
+            url, {"criteria": "[]", "format": "xlsx"}
+        )
+        self.assertEqual(400, response.status_code)
+
+    @override_settings(EXTRACT_ASYNC=True)
+    @patch.object(extract, 'async_extract')
+    def test_check_view_async_sqlite(self, async_extract):
+        async_extract.return_value = 'the id'
+        url = reverse("extract_download")
+        self.assertTrue(
+            self.client.login(username=self.user.username, password=self.PASSWORD)
+        )
+        with patch('opal.core.search.views.async_extract', async_extract):
+            response = self.client.post(
+                url, json.dumps({"criteria": "[]", "format": "sqlite"}),
+                content_type='application/json'
+            )
+        self.assertEqual(200, response.status_code)
+        async_extract.assert_called_with(self.user, [], 'sqlite')
+
 
 class PatientEpisodeTestCase(OpalTestCase):
     def setUp(self):
@@ -168,32 +242,716 @@ class PatientSubrecordCSVTestCase(PatientEpisodeTestCase):
         self.assertEqual(row, expected_row)
 
 
+class ChunkedCSVTestCase(PatientEpisodeTestCase):
+
+    def rows(self, lines):
+        return list(csv.reader(lines))
+
+    @patch.object(extract, 'CHUNK_SIZE', 2)
+    def test_subrecords_read_in_chunks(self):
+        for name in ['red', 'green', 'blue', 'pink', 'grey']:
+            Colour.objects.create(episode=self.episode, name=name)
+        episodes = models.Episode.objects.all()
+        # The header needs no queries, then one for each chunk
+        with self.assertNumQueries(3):
+            rows = self.rows(extract.subrecord_csv_lines(episodes, Colour))
+        self.assertEqual(
+            ['red', 'green', 'blue', 'pink', 'grey'],
+            [row[-1] for row in rows[1:]]
+        )
+
+    def test_foreign_key_or_free_text(self):
+        Dog.objects.create(name='Spot')
+        DogOwner.objects.create(episode=self.episode, dog='Spot')
+        DogOwner.objects.create(episode=self.episode, dog='Fido')
+        episodes = models.Episode.objects.all()
+        with self.assertNumQueries(1):
+            rows = self.rows(extract.subrecord_csv_lines(episodes, DogOwner))
+        dogs = [row[rows[0].index('dog')] for row in rows[1:]]
+        self.assertEqual(['Spot', 'Fido'], dogs)
+
+    def test_many_to_many(self):
+        bowler = Hat.objects.create(name='Bowler')
+        fez = Hat.objects.create(name='Fez')
+        wearer = HatWearer.objects.create(episode=self.episode, name='Jane')
+        wearer.hats.add(fez, bowler)
+        HatWearer.objects.create(episode=self.episode, name='John')
+        rows = self.rows(extract.subrecord_csv_lines(
+            models.Episode.objects.all(), HatWearer
+        ))
+        hats = [row[rows[0].index('hats')] for row in rows[1:]]
+        self.assertEqual(['Bowler;Fez', ''], hats)
+
+    def test_patient_subrecords_use_latest_episode(self):
+        latest = self.patient.create_episode()
+        rows = self.rows(extract.patient_subrecord_csv_lines(
+            models.Episode.objects.all(), Demographics
+        ))
+        self.assertEqual(2, len(rows))
+        self.assertEqual(str(latest.id), rows[1][0])
+
+    def test_patient_subrecords_only_for_extracted_patients(self):
+        other = models.Patient.objects.create()
+        other.create_episode()
+        rows = self.rows(extract.patient_subrecord_csv_lines(
+            models.Episode.objects.filter(patient=self.patient), Demographics
+        ))
+        self.assertEqual([str(self.episode.id)], [r[0] for r in rows[1:]])
+
+    def test_episodes_are_a_subquery(self):
+        Colour.objects.create(episode=self.episode, name='blue')
+        with CaptureQueriesContext(connection) as captured:
+            list(extract.subrecord_csv_lines(
+                models.Episode.objects.all(), Colour
+            ))
+        self.assertIn('IN (SELECT', captured[0]['sql'])
+
+
+class EpisodeCSVTestCase(PatientEpisodeTestCase):
+
+    def test_episode_csv_lines(self):
+        self.episode.set_tag_names(['inpatient'], self.user)
+        lines = list(extract.episode_csv_lines([self.episode], self.user))
+        self.assertEqual(2, len(lines))
+        self.assertTrue(lines[0].strip().endswith('tagging'))
+        self.assertTrue(lines[1].strip().endswith('inpatient'))
+
+
+    def rows(self, episodes):
+        rows = list(csv.reader(
+            extract.episode_csv_lines(episodes, self.user)
+        ))
+        return [dict(zip(rows[0], row)) for row in rows[1:]]
+
+    def test_constant_queries(self):
+        for i in range(3):
+            episode = self.patient.create_episode()
+            episode.set_tag_names(['inpatient', 'icu'], self.user)
+        episodes = models.Episode.objects.all()
+        # One for the episodes, one for their tags
+        with self.assertNumQueries(2):
+            rows = self.rows(episodes)
+        self.assertEqual(4, len(rows))
+        self.assertEqual(['', 'inpatient;icu', 'inpatient;icu', 'inpatient;icu'],
+                         [row['tagging'] for row in rows])
+
+    def test_other_users_tags(self):
+        self.episode.set_tag_names(['mine'], self.user)
+        self.episode.tagging_set.update(user=self.make_user('password', username='someone'))
+        self.assertEqual('', self.rows(models.Episode.objects.all())[0]['tagging'])
+
+    def test_start_and_end(self):
+        self.episode.date_of_admission = datetime.date(2016, 1, 1)
+        self.episode.discharge_date = datetime.date(2016, 1, 5)
+        self.episode.save()
+        row = self.rows(models.Episode.objects.all())[0]
+        self.assertEqual('2016-01-01', row['start'])
+        self.assertEqual('2016-01-05', row['end'])
+
+    def test_start_and_end_from_category(self):
+        self.episode.date_of_admission = datetime.date(2016, 1, 1)
+        self.episode.save()
+        category = self.episode.category.__class__
+        start = property(lambda self: datetime.date(1999, 12, 31))
+        with patch.object(category, 'start', start):
+            row = self.rows(models.Episode.objects.all())[0]
+        self.assertEqual('1999-12-31', row['start'])
+        self.assertEqual('None', row['end'])
+
 class ZipArchiveTestCase(PatientEpisodeTestCase):
 
-    @patch('opal.core.search.extract.zipfile')
-    def test_episode_subrecords(self, zipfile):
-        extract.zip_archive(models.Episode.objects.all(), 'this', self.user)
-        expected = len([i for i in subrecords.episode_subrecords()]) + 7
-        self.assertEqual(expected, zipfile.ZipFile.return_value.__enter__.return_value.write.call_count)
+    def names(self, target):
+        with zipfile.ZipFile(target) as archive:
+            return [os.path.basename(n) for n in archive.namelist()]
 
-    @patch('opal.core.search.extract.subrecord_csv')
-    @patch('opal.core.search.extract.zipfile')
-    def test_exclude_episode_subrecords(self, zipfile, subrecords):
-        extract.zip_archive(models.Episode.objects.all(), 'this', self.user)
+    def test_episode_subrecords(self):
+        target = extract.zip_archive(
+            models.Episode.objects.all(), 'this', self.user
+        )
+        self.addCleanup(os.remove, target)
+        names = self.names(target)
+        self.assertEqual('episodes.csv', names[0])
+        self.assertEqual('filter.txt', names[-1])
+        expected = len([
+            s for s in subrecords.subrecords()
+            if not getattr(s, '_exclude_from_extract', False)
+        ]) + 2
+        self.assertEqual(expected, len(names))
+
+    def test_contents(self):
+        Colour.objects.create(episode=self.episode, name='blue')
+        target = extract.zip_archive(
+            models.Episode.objects.all(), u'this \u2603', self.user
+        )
+        self.addCleanup(os.remove, target)
+        with zipfile.ZipFile(target) as archive:
+            self.assertIsNone(archive.testzip())
+            folder = '{0}.{1}'.format(
+                self.user.username, datetime.date.today()
+            )
+            self.assertEqual(
+                u'this \u2603',
+                archive.read(folder + '/filter.txt').decode('UTF-8')
+            )
+            demographics = archive.read(folder + '/demographics.csv')
+            self.assertIn('12345678', demographics)
+
+    def test_stream_archive_is_lazy(self):
+        with patch.object(extract, 'episode_csv_lines') as lines:
+            extract.stream_archive(models.Episode.objects.all(), 'this', self.user)
+            self.assertFalse(lines.return_value.__iter__.called)
+
+    @patch('opal.core.search.extract.subrecord_csv_lines')
+    def test_exclude_episode_subrecords(self, subrecords):
+        subrecords.return_value = []
+        os.remove(extract.zip_archive(models.Episode.objects.all(), 'this', self.user))
         subs = [a[0][1] for a in subrecords.call_args_list]
         self.assertFalse(Colour in subs)
 
-    @patch('opal.core.search.extract.patient_subrecord_csv')
-    @patch('opal.core.search.extract.zipfile')
-    def test_exclude_patient_subrecords(self, zipfile, subrecords):
-        extract.zip_archive(models.Episode.objects.all(), 'this', self.user)
+    @patch('opal.core.search.extract.patient_subrecord_csv_lines')
+    def test_exclude_patient_subrecords(self, subrecords):
+        subrecords.return_value = []
+        os.remove(extract.zip_archive(models.Episode.objects.all(), 'this', self.user))
         subs = [a[0][1] for a in subrecords.call_args_list]
         self.assertFalse(PatientColour in subs)
 
 
+class SQLiteArchiveTestCase(PatientEpisodeTestCase):
+
+    def setUp(self):
+        super(SQLiteArchiveTestCase, self).setUp()
+        self.episode.set_tag_names(['microbiology'], self.user)
+        wearer = HatWearer.objects.create(episode=self.episode, name='Jane')
+        wearer.hats.add(Hat.objects.create(name='Bowler'))
+        owner = DogOwner.objects.create(episode=self.episode, name='Jane')
+        owner.dog = 'Fido'
+        owner.save()
+        self.target = extract.sqlite_archive(
+            models.Episode.objects.all(), u'this \u2603', self.user
+        )
+        self.addCleanup(os.remove, self.target)
+        self.db = sqlite3.connect(self.target)
+        self.addCleanup(self.db.close)
+
+    def columns(self, table):
+        return {
+            row[1]: (row[2], row[5])
+            for row in self.db.execute('PRAGMA table_info("{0}")'.format(table))
+        }
+
+    def indexes(self, table):
+        return [
+            row[1] for row in
+            self.db.execute('PRAGMA index_list("{0}")'.format(table))
+        ]
+
+    def test_tables(self):
+        tables = [row[0] for row in self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        )]
+        self.assertEqual(['episodes', 'tagging'], tables[:2])
+        self.assertEqual('filter', tables[-1])
+        self.assertEqual(
+            [name[:-len('.csv')] for name in extract.archive_file_names()[1:]],
+            tables[2:-1]
+        )
+
+    def test_episodes(self):
+        columns = self.columns('episodes')
+        self.assertEqual(('INTEGER', 1), columns['id'])
+        self.assertEqual(('INTEGER', 0), columns['patient_id'])
+        self.assertEqual(('BOOLEAN', 0), columns['active'])
+        self.assertEqual(('DATE', 0), columns['start'])
+        self.assertNotIn('consistency_token', columns)
+        self.assertNotIn('tagging', columns)
+        self.assertEqual(
+            [(self.episode.id, self.patient.id)],
+            list(self.db.execute('SELECT id, patient_id FROM episodes'))
+        )
+        self.assertIn('episodes_patient_id', self.indexes('episodes'))
+
+    def test_tagging(self):
+        self.assertEqual(
+            [(self.episode.id, u'microbiology')],
+            list(self.db.execute('SELECT episode_id, value FROM tagging'))
+        )
+        self.assertIn('tagging_episode_id', self.indexes('tagging'))
+
+    def test_subrecords(self):
+        columns = self.columns('hat_wearer')
+        self.assertEqual(('INTEGER', 1), columns['id'])
+        self.assertEqual(('INTEGER', 0), columns['episode_id'])
+        self.assertEqual(('TIMESTAMP', 0), columns['created'])
+        self.assertEqual(('BOOLEAN', 0), columns['wearing_a_hat'])
+        self.assertEqual(
+            [(self.episode.id, u'Jane', 1)],
+            list(self.db.execute(
+                'SELECT episode_id, name, wearing_a_hat FROM hat_wearer'
+            ))
+        )
+        references = list(
+            self.db.execute('PRAGMA foreign_key_list("hat_wearer")')
+        )
+        self.assertEqual('episodes', references[0][2])
+        self.assertIn('hat_wearer_episode_id', self.indexes('hat_wearer'))
+
+    def test_many_to_many(self):
+        self.assertEqual(('TEXT', 0), self.columns('hat_wearer')['hats'])
+        self.assertEqual(
+            [(u'Bowler',)], list(self.db.execute('SELECT hats FROM hat_wearer'))
+        )
+
+    def test_foreign_key_or_free_text(self):
+        self.assertEqual(('TEXT', 0), self.columns('dog_owner')['dog'])
+        self.assertEqual(
+            [(u'Jane', u'Fido')],
+            list(self.db.execute('SELECT name, dog FROM dog_owner'))
+        )
+
+    def test_patient_subrecords(self):
+        self.assertIn('patient_id', self.columns('demographics'))
+        self.assertIn('demographics_patient_id', self.indexes('demographics'))
+        self.assertEqual(
+            [(u'1976-01-01',)],
+            list(self.db.execute('SELECT date_of_birth FROM demographics'))
+        )
+
+    def test_filter(self):
+        self.assertEqual(
+            [(u'this \u2603',)],
+            list(self.db.execute('SELECT description FROM filter'))
+        )
+
+    def test_decimals(self):
+        db = sqlite3.connect(':memory:')
+        extract._write_table(
+            db, 'prices', [('price', 'NUMERIC')],
+            [[[decimal.Decimal('1.10')]], [[None]]]
+        )
+        self.assertEqual(
+            [(1.1,), (None,)], list(db.execute('SELECT price FROM prices'))
+        )
+
+    def test_removed_on_failure(self):
+        handle, target = tempfile.mkstemp(suffix='.sqlite3')
+        with patch.object(extract, '_episode_chunks', side_effect=ValueError):
+            with patch.object(extract.tempfile, 'mkstemp') as mkstemp:
+                mkstemp.return_value = handle, target
+                with self.assertRaises(ValueError):
+                    extract.sqlite_archive(
+                        models.Episode.objects.all(), 'this', self.user
+                    )
+        self.assertFalse(os.path.exists(target))
+
+
+class CreateArchiveTestCase(OpalTestCase):
+
+    @patch.object(extract, 'zip_archive')
+    def test_zip(self, zip_archive):
+        extract.create_archive([], 'this', self.user)
+        zip_archive.assert_called_with([], 'this', self.user)
+
+    @patch.object(extract, 'sqlite_archive')
+    def test_sqlite(self, sqlite_archive):
+        extract.create_archive([], 'this', self.user, format='sqlite')
+        sqlite_archive.assert_called_with([], 'this', self.user)
+
+    def test_read_and_remove(self):
+        handle, target = tempfile.mkstemp()
+        with os.fdopen(handle, 'wb') as extract_file:
+            extract_file.write('hello')
+        self.assertEqual('hello', b''.join(extract.read_and_remove(target)))
+        self.assertFalse(os.path.exists(target))
+
+
+class SerialPool(object):
+    """
+    Stands in for a worker pool in tests, as other threads and processes
+    can't see the test database.
+    """
+    def imap(self, func, jobs):
+        return itertools.imap(func, jobs)
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class ArchiveFilesTestCase(PatientEpisodeTestCase):
+
+    def setUp(self):
+        super(ArchiveFilesTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def test_archive_file_names(self):
+        file_names = extract.archive_file_names()
+        self.assertEqual('episodes.csv', file_names[0])
+        self.assertIn('demographics.csv', file_names)
+        self.assertNotIn('colour.csv', file_names)
+        self.assertNotIn('patient_colour.csv', file_names)
+
+    def test_file_lines(self):
+        episodes = models.Episode.objects.all()
+        with patch.object(extract, 'subrecord_csv_lines') as lines:
+            extract.file_lines('hat_wearer.csv', episodes, self.user)
+            lines.assert_called_once_with(episodes, HatWearer, changes=None)
+        with patch.object(extract, 'patient_subrecord_csv_lines') as lines:
+            extract.file_lines('demographics.csv', episodes, self.user)
+            lines.assert_called_once_with(episodes, Demographics, changes=None)
+        with patch.object(extract, 'episode_csv_lines') as lines:
+            extract.file_lines('episodes.csv', episodes, self.user)
+            lines.assert_called_once_with(episodes, self.user, changes=None)
+
+    def test_write_file(self):
+        path = extract.write_file(
+            self.directory, 'demographics.csv',
+            models.Episode.objects.all(), self.user
+        )
+        self.assertEqual(os.path.join(self.directory, 'demographics.csv'), path)
+        with open(path) as demographics:
+            self.assertIn('12345678', demographics.read())
+
+    def test_assemble_archive(self):
+        episodes = models.Episode.objects.all()
+        paths = [
+            extract.write_file(self.directory, f, episodes, self.user)
+            for f in extract.archive_file_names()
+        ]
+        target = extract.assemble_archive(paths, 'this', self.user)
+        self.addCleanup(os.remove, target)
+        with zipfile.ZipFile(target) as archive:
+            names = [os.path.basename(n) for n in archive.namelist()]
+        self.assertEqual(extract.archive_file_names() + ['filter.txt'], names)
+        self.assertEqual([], os.listdir(self.directory))
+
+
+@patch.object(extract, 'connections')
+@patch.object(extract, '_make_pool', return_value=SerialPool())
+@override_settings(OPAL_EXTRACT_WORKERS=4)
+class ParallelArchiveTestCase(PatientEpisodeTestCase):
+
+    def read(self, chunks):
+        return zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+
+    def test_same_as_serial(self, make_pool, connections):
+        Colour.objects.create(episode=self.episode, name='blue')
+        episodes = models.Episode.objects.all()
+        parallel = self.read(extract.stream_archive(episodes, 'this', self.user))
+        with override_settings(OPAL_EXTRACT_WORKERS=1):
+            serial = self.read(extract.stream_archive(episodes, 'this', self.user))
+        self.assertEqual(serial.namelist(), parallel.namelist())
+        for name in serial.namelist():
+            self.assertEqual(serial.read(name), parallel.read(name))
+        make_pool.assert_called_once_with(4)
+
+    def test_workers_close_their_connections(self, make_pool, connections):
+        list(extract.stream_archive([self.episode], 'this', self.user))
+        self.assertEqual(
+            len(extract.archive_file_names()),
+            connections.close_all.call_count
+        )
+
+    def test_temporary_files_are_removed(self, make_pool, connections):
+        directory = tempfile.mkdtemp()
+        with patch.object(extract.tempfile, 'mkdtemp', return_value=directory):
+            chunks = extract.stream_archive([self.episode], 'this', self.user)
+            next(chunks)
+            self.assertTrue(os.path.exists(directory))
+            chunks.close()
+        self.assertFalse(os.path.exists(directory))
+
+
+class MakePoolTestCase(OpalTestCase):
+
+    def test_threads(self):
+        with patch.object(extract, 'ThreadPool') as pool:
+            extract._make_pool(3)
+            pool.assert_called_once_with(3)
+
+    @override_settings(OPAL_EXTRACT_POOL='process')
+    def test_processes(self):
+        with patch.object(extract.multiprocessing, 'Pool') as pool:
+            extract._make_pool(3)
+            pool.assert_called_once_with(
+                3, initializer=extract._forget_connections
+            )
+
+    def test_forget_connections(self):
+        wrapper = Mock()
+        with patch.object(extract, 'connections') as connections:
+            connections.all.return_value = [wrapper]
+            extract._forget_connections()
+        self.assertIsNone(wrapper.connection)
+
+
+class IncrementalExtractTestCase(PatientEpisodeTestCase):
+
+    def setUp(self):
+        super(IncrementalExtractTestCase, self).setUp()
+        self.since = timezone.now()
+        self.old = Colour.objects.create(episode=self.episode, name='red')
+        models.ChangedRecord.objects.update(
+            changed=self.since - datetime.timedelta(days=1)
+        )
+        self.new = Colour.objects.create(episode=self.episode, name='blue')
+        self.criteria = [{
+            "combine": "and", "column": "demographics", "field": "Surname",
+            "queryType": "Contains", "query": "Alderney", "lookup_list": [],
+        }]
+        self.filter = models.Filter.objects.create(
+            user=self.user, name='mine', criteria=json.dumps(self.criteria)
+        )
+        self.watermark = models.ExtractWatermark.objects.create(
+            user=self.user, filter=self.filter, watermark=self.since
+        )
+        models.ExtractedEpisode.objects.create(
+            watermark=self.watermark, episode_id=self.episode.id,
+            patient_id=self.patient.id
+        )
+        self.changes = extract.Changes(self.since, self.watermark.id)
+
+    def rows(self, lines):
+        return list(csv.reader(lines))[1:]
+
+    def test_subrecords_since(self):
+        self.old.save()
+        Colour.objects.create(episode=self.episode, name='grey')
+        rows = self.rows(extract.subrecord_csv_lines(
+            models.Episode.objects.all(), Colour, changes=self.changes
+        ))
+        self.assertEqual(['red', 'blue', 'grey'], [row[-1] for row in rows])
+
+    def test_patient_subrecords_since(self):
+        episodes = models.Episode.objects.all()
+        self.assertEqual([], self.rows(extract.patient_subrecord_csv_lines(
+            episodes, Demographics, changes=self.changes
+        )))
+        Demographics.objects.get().save()
+        self.assertEqual(1, len(self.rows(extract.patient_subrecord_csv_lines(
+            episodes, Demographics, changes=self.changes
+        ))))
+
+    def test_episodes_since(self):
+        episodes = models.Episode.objects.all()
+        lines = extract.episode_csv_lines(
+            episodes, self.user, changes=self.changes
+        )
+        self.assertEqual([], self.rows(lines))
+        self.episode.set_tag_names(['inpatient'], self.user)
+        lines = extract.episode_csv_lines(
+            episodes, self.user, changes=self.changes
+        )
+        self.assertEqual(1, len(self.rows(lines)))
+
+    def test_saved_without_the_api(self):
+        patient, episode = self.new_patient_and_episode_please()
+        models.ExtractedEpisode.objects.create(
+            watermark=self.watermark, episode_id=episode.id,
+            patient_id=patient.id
+        )
+        episodes = models.Episode.objects.all()
+        rows = self.rows(extract.patient_subrecord_csv_lines(
+            episodes, Demographics, changes=self.changes
+        ))
+        self.assertEqual([str(episode.id)], [row[0] for row in rows])
+        rows = self.rows(
+            extract.episode_csv_lines(episodes, self.user, changes=self.changes)
+        )
+        self.assertEqual([str(episode.id)], [row[0] for row in rows])
+
+    def test_newly_matching_episodes_in_full(self):
+        patient, episode = self.new_patient_and_episode_please()
+        Colour.objects.create(
+            episode=episode, name='green',
+            created=self.since - datetime.timedelta(days=1)
+        )
+        episodes = models.Episode.objects.all()
+        rows = self.rows(extract.subrecord_csv_lines(
+            episodes, Colour, changes=self.changes
+        ))
+        self.assertEqual(['blue', 'green'], [row[-1] for row in rows])
+        rows = self.rows(extract.patient_subrecord_csv_lines(
+            episodes, Demographics, changes=self.changes
+        ))
+        self.assertEqual([str(episode.id)], [row[0] for row in rows])
+        rows = self.rows(
+            extract.episode_csv_lines(episodes, self.user, changes=self.changes)
+        )
+        self.assertEqual([str(episode.id)], [row[0] for row in rows])
+
+    def test_deleted(self):
+        old_id = self.old.id
+        self.old.delete()
+        episodes = models.Episode.objects.all()
+        self.assertEqual(
+            [['colour', str(old_id), 'deleted']],
+            [[row[0], row[1], row[3]] for row in self.rows(
+                extract.deleted_csv_lines(episodes, self.changes)
+            )]
+        )
+        later = extract.Changes(
+            timezone.now() + datetime.timedelta(seconds=1), self.watermark.id
+        )
+        self.assertEqual(
+            [], self.rows(extract.deleted_csv_lines(episodes, later))
+        )
+
+    def test_deleted_only_for_extracted_episodes(self):
+        patient, episode = self.new_patient_and_episode_please()
+        Colour.objects.create(episode=episode, name='green').delete()
+        patient.demographics_set.get().delete()
+        self.assertEqual([], self.rows(extract.deleted_csv_lines(
+            models.Episode.objects.all(), self.changes
+        )))
+        self.patient.demographics_set.get().delete()
+        self.assertEqual(
+            ['demographics'],
+            [row[0] for row in self.rows(extract.deleted_csv_lines(
+                models.Episode.objects.all(), self.changes
+            ))]
+        )
+
+    def test_left_filter(self):
+        rows = self.rows(extract.deleted_csv_lines(
+            models.Episode.objects.none(), self.changes
+        ))
+        self.assertEqual(
+            [['episode', str(self.episode.id), '', 'left_filter']], rows
+        )
+
+    def test_archive_file_names(self):
+        self.assertNotIn('deleted.csv', extract.archive_file_names())
+        self.assertEqual(
+            'deleted.csv', extract.archive_file_names(self.changes)[-1]
+        )
+
+    def read(self, chunks):
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+        return {
+            os.path.basename(name): archive.read(name)
+            for name in archive.namelist()
+        }
+
+    def test_incremental_archive(self):
+        self.watermark.delete()
+        first = self.read(extract.incremental_archive(self.filter, self.user))
+        self.assertNotIn('deleted.csv', first)
+        self.assertIn('12345678', first['demographics.csv'])
+
+        watermark = models.ExtractWatermark.objects.get(
+            user=self.user, filter=self.filter
+        )
+        self.assertIsNotNone(watermark.watermark)
+
+        # As though the next extract were well after this one
+        models.ExtractWatermark.objects.update(watermark=timezone.now())
+        new_id = self.new.id
+        self.new.delete()
+        second = self.read(extract.incremental_archive(self.filter, self.user))
+        self.assertNotIn('12345678', second['demographics.csv'])
+        self.assertIn('colour,{0},'.format(new_id), second['deleted.csv'])
+        self.assertGreater(
+            models.ExtractWatermark.objects.get(pk=watermark.pk).watermark,
+            watermark.watermark
+        )
+
+    def test_watermark_margin(self):
+        self.watermark.delete()
+        list(extract.incremental_archive(self.filter, self.user))
+        watermark = models.ExtractWatermark.objects.get()
+        self.assertLess(
+            watermark.watermark, timezone.now() - extract.WATERMARK_MARGIN
+        )
+
+    def test_extracted_episodes(self):
+        self.watermark.delete()
+        list(extract.incremental_archive(self.filter, self.user))
+        self.assertEqual(
+            [(self.episode.id, self.patient.id)],
+            list(models.ExtractedEpisode.objects.values_list(
+                'episode_id', 'patient_id'
+            ))
+        )
+
+    def test_watermark_only_moves_once_read(self):
+        self.watermark.delete()
+        chunks = extract.incremental_archive(self.filter, self.user)
+        next(chunks)
+        chunks.close()
+        self.assertIsNone(models.ExtractWatermark.objects.get().watermark)
+
+    def test_watermark_per_user(self):
+        self.watermark.delete()
+        list(extract.incremental_archive(self.filter, self.user))
+        other = self.make_user('password', username='other')
+        list(extract.incremental_archive(self.filter, other))
+        self.assertEqual(2, models.ExtractWatermark.objects.count())
+
+    def test_incremental_zip_archive(self):
+        target = extract.incremental_zip_archive(self.filter, self.user)
+        self.addCleanup(os.remove, target)
+        with zipfile.ZipFile(target) as archive:
+            self.assertIsNone(archive.testzip())
+
+
 class AsyncExtractTestCase(OpalTestCase):
 
     @patch('opal.core.search.tasks.extract.delay')
     def test_async(self, delay):
         extract.async_extract(self.user, 'THIS')
-        delay.assert_called_with(self.user, 'THIS')
+        delay.assert_called_with(self.user, 'THIS', 'zip')
+
+    @override_settings(OPAL_EXTRACT_SUBTASKS=True)
+    @patch('opal.core.search.tasks.extract.delay')
+    def test_async_sqlite(self, delay):
+        extract.async_extract(self.user, 'THIS', 'sqlite')
+        delay.assert_called_with(self.user, 'THIS', 'sqlite')
+
+    @override_settings(OPAL_EXTRACT_SUBTASKS=True, OPAL_EXTRACT_DIR='/shared')
+    @patch('celery.group')
+    @patch('celery.chord')
+    def test_subtasks(self, chord, group):
+        chord.return_value.apply_async.return_value.id = 'the id'
+        with patch.object(extract.uuid, 'uuid4') as uuid4:
+            uuid4.return_value.hex = 'name'
+            self.assertEqual('the id', extract.async_extract(self.user, 'THIS'))
+        subtasks = list(group.call_args[0][0])
+        self.assertEqual(len(extract.archive_file_names()), len(subtasks))
+        self.assertEqual(
+            (self.user, 'THIS', 'name', 'episodes.csv'), subtasks[0].args
+        )
+        callback = chord.call_args[0][1]
+        self.assertEqual((self.user, 'THIS', 'name'), callback.args)
+        errback, = callback.options['link_error']
+        self.assertEqual(('name',), errback['args'])
+        self.assertTrue(errback['immutable'])
+
+    @override_settings(OPAL_EXTRACT_SUBTASKS=True)
+    @patch('celery.chord')
+    def test_subtasks_need_a_directory(self, chord):
+        with self.assertRaises(ImproperlyConfigured):
+            extract.async_extract(self.user, 'THIS')
+        self.assertFalse(chord.called)
+
+    @override_settings(OPAL_EXTRACT_DIR='/shared')
+    def test_extract_directory(self):
+        self.assertEqual(
+            '/shared/opal-extract-name', extract.extract_directory('name')
+        )
+
+    def test_make_extract_directory(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        with override_settings(OPAL_EXTRACT_DIR=root):
+            directory = extract.make_extract_directory('name')
+            self.assertTrue(os.path.isdir(directory))
+            # As the other subtasks of the extract will
+            self.assertEqual(directory, extract.make_extract_directory('name'))
+
+    @patch('opal.core.search.tasks.incremental_extract.delay')
+    def test_async_incremental(self, delay):
+        extract.async_incremental_extract(self.user, 3)
+        delay.assert_called_with(self.user, 3)
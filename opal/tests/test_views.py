@@ -234,6 +234,16 @@ class IndexViewTestCase(BaseViewTestCase):
         request = self.get_request('/index.html')
         self.should_200(views.IndexView, request)
 
+    @patch('opal.views.schemas')
+    def test_schema_versions(self, schemas):
+        schemas.records.get.return_value.etag = 'abc'
+        schemas.extract.get.return_value.etag = 'xyz'
+        view = views.IndexView()
+        view.request = self.get_request('/index.html')
+        context = view.get_context_data()
+        self.assertEqual('abc', context['record_schema_version'])
+        self.assertEqual('xyz', context['extract_schema_version'])
+
 
 class CheckPasswordResetViewTestCase(BaseViewTestCase):
 
@@ -11,7 +11,7 @@ from django.views.generic import TemplateView, View
 from django.views.decorators.http import require_http_methods
 
 from opal import models
-from opal.core import application, detail, episodes, exceptions
+from opal.core import application, detail, episodes, exceptions, schemas
 from opal.core.patient_lists import PatientList
 from opal.core.subrecords import (
     episode_subrecords, subrecords, get_subrecord_from_api_name
@@ -125,6 +125,8 @@ class IndexView(LoginRequiredMixin, TemplateView):
         context = super(IndexView, self).get_context_data(**kwargs)
         context['brand_name'] = getattr(settings, 'OPAL_BRAND_NAME', 'OPAL')
         context['settings'] = settings
+        context['record_schema_version'] = schemas.records.get().etag
+        context['extract_schema_version'] = schemas.extract.get().etag
         if hasattr(settings, 'OPAL_EXTRA_APPLICATION'):
             context['extra_application'] = settings.OPAL_EXTRA_APPLICATION
 